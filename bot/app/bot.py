@@ -8,12 +8,16 @@ from threading import Thread
 
 import settings
 from bot.app import locale
-from bot.libs.map_tools import MapParser, MapMath
+from bot.libs.map_tools import MapParser, MapCrawler, MapSectorCache, \
+    VillageDumpReader
 from bot.libs.common_tools import CookiesExtractor
 from bot.libs.request_management import RequestManager
-from bot.libs.village_management import VillageManager, Village
+from bot.libs.village_management import VillageManager
 from bot.libs.attack_management import AttackManager, AttackHelper
 from bot.libs.report_management import ReportManager
+from bot.libs.event_scheduler import EventScheduler
+from bot.libs.world_config import WorldConfig, WorldConfigCache
+from bot.libs.patterns import PATTERNS
 
 
 class Bot(Thread):
@@ -22,27 +26,39 @@ class Bot(Thread):
     farming logic.
     Upon initialization creates all needed manager-classes and performs
     basic setup.
-    Overrides threading.Thread.run() method: starts a loop which perform
-    'attack cycles' & tracks settings.FARM_DURATION 'counter'.
+    Overrides threading.Thread.run() method: starts a loop which waits
+    for scheduled events (arrivals, returns, etc.), reacts on them &
+    tracks settings.FARM_DURATION 'counter'.
     Provides .stop() method which saves the data collected during farm
     session to data storage & terminates farm process.
     """
 
+    # pages of reports requested in addition to guessed ones, if the
+    # last handled report is known (it stops paging earlier)
+    EXTRA_REPORT_PAGES = 2
+
     def __init__(self):
         Thread.__init__(self)
         self.map_parser = MapParser()
+        self.map_cache = None
+        # origins of sectors within settings.MAP_RADIUS of player's villages
+        self.map_origins = set()
         self.request_manager = None
         self.village_manager = None
         self.report_manager = None
         self.attack_manager = None
         self.attack_helper = None
+        self.world_config = None
         self.locale = None
         self.set_locale()
         self.setup_request_manager()
+        self.setup_world_config()
         self.setup_village_manager()
         self.setup_attack_manager()
         self.setup_report_manager()
         self.setup_attack_helper()
+        self.event_scheduler = None
+        self.setup_event_scheduler()
         self.active = False
         self.in_cycle = False
 
@@ -68,32 +84,85 @@ class Bot(Thread):
                                          reconnect=True,
                                          username=settings.USER,
                                          password=settings.PASSWORD,
-                                         antigate_key=settings.ANTIGATE_KEY)
+                                         antigate_key=settings.ANTIGATE_KEY,
+                                         pool_size=settings.CONNECTION_POOL_SIZE)
         self.request_manager = request_manager
 
+    def setup_world_config(self):
+        """
+        Takes settings of game world from WorldConfigCache or, on the first
+        run on host, loads them from settings.WORLD_SETTINGS_FILE (or world
+        settings page) & caches them. Falls back to settings.HOST_SPEED &
+        settings.UNIT_SPEED if world settings could not be parsed.
+        Stats of units of world are passed to managers which build units.
+        """
+        cache_filename = os.path.join(settings.DATA_FOLDER, settings.WORLD_CONFIG_FILE)
+        world_config_cache = WorldConfigCache(cache_filename)
+        world_config = world_config_cache.get(settings.HOST)
+        if world_config is None:
+            try:
+                if settings.WORLD_SETTINGS_FILE:
+                    world_config = WorldConfig.from_file(settings.WORLD_SETTINGS_FILE)
+                else:
+                    world_config = WorldConfig.\
+                        from_settings_page(self._get_world_settings())
+            except ValueError:
+                logging.warning("Unable to load world settings, using "
+                                "HOST_SPEED & UNIT_SPEED from settings.")
+                world_config = WorldConfig(speed=settings.HOST_SPEED,
+                                           unit_speed=settings.UNIT_SPEED)
+            else:
+                world_config_cache.save(settings.HOST, world_config)
+        logging.info(str(world_config))
+        self.world_config = world_config
+
     def setup_village_manager(self):
         """
         Performs basic setup of VillageManager:
         1. Initializes VillageManager
         2. Asks VM to create PlayerVillages from a specific game page
-        3. Collects map data around the player & asks VM to create &
-        update TargetVillages.
+        3. Collects map data around the player (or takes it from
+        MapSectorCache or world dump file) & asks VM to create & update
+        TargetVillages.
         4. Asks VM to prepare those PlayerVillages that will act as
         'farming' villages.
         """
         storage_filename = os.path.join(settings.DATA_FOLDER, settings.DATA_FILE)
         village_manager = VillageManager(storage_type=settings.DATA_TYPE,
-                                         storage_name=storage_filename)
+                                         storage_name=storage_filename,
+                                         speed_factor=self._get_speed_factor(),
+                                         unit_stats=self.world_config.get_unit_stats())
         overviews_html = self._get_overviews_screen()
         village_manager.build_player_villages(overviews_html)
         player_villages = village_manager.get_player_villages()
-        farming_centers = list(player_villages.values())
-        map_data = self._get_map_data(distinct_farming_centers=farming_centers,
-                                      map_depth=2)
+        map_cache_filename = os.path.join(settings.DATA_FOLDER, settings.MAP_CACHE_FILE)
+        self.map_cache = MapSectorCache(map_cache_filename, ttl=settings.MAP_CACHE_TTL)
+        # stale sectors are re-fetched later (see .on_map_refresh()), but
+        # cache is used only if it covers area around all player's villages
+        farming_centers = [pv.coords for pv in player_villages.values()]
+        origins = MapCrawler.get_sector_origins(farming_centers, settings.MAP_RADIUS)
+        self.map_origins = origins
+        map_data = {}
+        if self.map_cache.has_sectors(origins):
+            map_data = self.map_cache.get_area_data()
+        if not map_data and settings.WORLD_DATA_FILE:
+            dump_reader = VillageDumpReader(settings.WORLD_DATA_FILE)
+            map_data = dump_reader.get_map_data(centers=farming_centers,
+                                                radius=settings.MAP_RADIUS,
+                                                include=settings.TRUSTED_TARGETS)
+            # dump is saved as of the time it was made, so its sectors are
+            # re-fetched from map when they become stale
+            sectors = MapCrawler.split_to_sectors(map_data, origins)
+            self.map_cache.update_sectors(sectors,
+                                          t_of_fetch=dump_reader.get_t_of_dump())
+        if not map_data:
+            farming_centers = list(player_villages.values())
+            map_data = self._get_map_data(farming_centers=farming_centers,
+                                          radius=settings.MAP_RADIUS)
         village_manager.build_target_villages(map_data=map_data,
                                               trusted_targets=settings.TRUSTED_TARGETS,
                                               untrusted_targets=settings.UNTRUSTED_TARGETS,
-                                              server_speed=settings.HOST_SPEED)
+                                              server_speed=self.world_config.speed)
         if settings.FARM_WITH:
             farm_with = settings.FARM_WITH
         else:
@@ -104,7 +173,8 @@ class Bot(Thread):
             village_manager.set_farming_village(attacker_id=pv_id,
                                                 train_screen_html=train_screen,
                                                 use_def_to_farm=settings.USE_DEF_TO_FARM,
-                                                heavy_is_def=settings.HEAVY_IS_DEF)
+                                                heavy_is_def=settings.HEAVY_IS_DEF,
+                                                t_limit_to_leave=settings.T_LIMIT_TO_LEAVE)
 
         self.village_manager = village_manager
 
@@ -114,15 +184,25 @@ class Bot(Thread):
         queue of attack targets.
         """
         storage_filename = os.path.join(settings.DATA_FOLDER, settings.DATA_FILE)
+        journal_filename = os.path.join(settings.DATA_FOLDER, settings.JOURNAL_FILE)
         attack_manager = AttackManager(storage_type=settings.DATA_TYPE,
-                                       storage_name=storage_filename)
+                                       storage_name=storage_filename,
+                                       journal_name=journal_filename,
+                                       speed_factor=self._get_speed_factor(),
+                                       unit_stats=self.world_config.get_unit_stats())
         targets = self.village_manager.get_attack_targets()
         attack_manager.build_attack_queue(target_villages=targets,
                                           farm_frequency=settings.FARM_FREQUENCY)
         self.attack_manager = attack_manager
+        if attack_manager.journal_replayed:
+            # changes replayed from journal are saved, so journal is compacted
+            self._clean_up()
 
     def setup_report_manager(self):
-        self.report_manager = ReportManager(locale=self.locale)
+        storage_filename = os.path.join(settings.DATA_FOLDER, settings.DATA_FILE)
+        self.report_manager = ReportManager(locale=self.locale,
+                                            storage_type=settings.DATA_TYPE,
+                                            storage_name=storage_filename)
 
     def setup_attack_helper(self):
         """
@@ -135,16 +215,21 @@ class Bot(Thread):
 
     def run(self):
         """
-        The outer flow of farming process: tracks the FARM_DURATION
-        counter and re-iterates attack_cycle() method.
+        The outer flow of farming process: sends all possible attacks,
+        then sleeps until the next scheduled event (arrival, return,
+        end of target's rest, session refresh) & dispatches it to its
+        handler, until FARM_DURATION counter expires.
         """
         self.active = True
         now = time.mktime(time.gmtime())
         end = now + settings.FARM_DURATION * 3600
         try:
+            self.schedule_pending_events()
+            self.send_attacks()
             while self.active:
-                self.attack_cycle()
-                self.active = time.mktime(time.gmtime()) < end
+                self.event_scheduler.wait(until=end)
+                self.event_scheduler.run_pending()
+                self.active = self.active and time.mktime(time.gmtime()) < end
         except AttributeError:
             error_info = traceback.format_exception(*sys.exc_info())
             logging.error(error_info)
@@ -161,7 +246,134 @@ class Bot(Thread):
 
     def stop(self):
         self.active = False
+        self.event_scheduler.wake()
         self._clean_up()
+        self.village_manager.close()
+        self.attack_manager.close()
+        self.report_manager.close()
+        logging.info("Regex patterns cache: {}".format(PATTERNS.get_stats()))
+
+    def setup_event_scheduler(self):
+        scheduler = EventScheduler()
+        scheduler.set_handler(EventScheduler.ARRIVAL, self.on_arrival)
+        scheduler.set_handler(EventScheduler.RETURN, self.on_return)
+        scheduler.set_handler(EventScheduler.REST_EXPIRY, self.on_rest_expiry)
+        scheduler.set_handler(EventScheduler.SESSION_REFRESH, self.on_session_refresh)
+        scheduler.set_handler(EventScheduler.MAP_REFRESH, self.on_map_refresh)
+        self.event_scheduler = scheduler
+
+    def schedule_pending_events(self):
+        """
+        Schedules events for attacks restored from storage, for
+        visited villages that are still resting, the first session
+        refresh & refresh of map sectors.
+        """
+        arrivals, returns = self.attack_manager.get_registered_attacks()
+        for coords, t_of_arrival in arrivals.items():
+            self.event_scheduler.schedule(t_of_arrival, EventScheduler.ARRIVAL,
+                                          coords)
+        for attacker_id, returns_t in returns.items():
+            for t_of_return in returns_t:
+                self.event_scheduler.schedule(t_of_return, EventScheduler.RETURN,
+                                              attacker_id)
+        self._schedule_rest_expiry()
+        self._schedule_session_refresh()
+        self._schedule_map_refresh()
+
+    def on_arrival(self, coords):
+        """
+        Some troops have arrived to their targets: there are new
+        battle reports which provide updated info about attack targets.
+        All arrivals that are due are handled at once, so events of the
+        same batch find nothing to do.
+        """
+        new_arrivals = self.attack_manager.get_new_arrivals()
+        if new_arrivals:
+            new_reports = self.get_new_reports(new_arrivals)
+            self.attack_manager.update_attack_targets(new_reports)
+            self._schedule_rest_expiry([report.coords for report in new_reports])
+            self.send_attacks()
+
+    def on_return(self, attacker_id):
+        """
+        Some troops have returned to their origins: refresh troops
+        of returned attackers & try to send more attacks.
+        """
+        new_returns = self.attack_manager.get_new_returns()
+        if new_returns:
+            for pv_id in new_returns:
+                train_screen = self._get_train_screen(pv_id)
+                self.village_manager.refresh_village_troops(pv_id, train_screen)
+            self.send_attacks()
+
+    def on_rest_expiry(self, coords):
+        """
+        Some of visited villages have finished to rest: they are
+        returned to queue, so attackers that had no targets may attack.
+        """
+        self.attack_manager.refresh_attack_queue()
+        self.village_manager.enable_idle_villages()
+        self.send_attacks()
+
+    def on_session_refresh(self, payload=None):
+        rally_screen = self._get_rally_overview(settings.MAIN_VILLAGE_ID)
+        self.attack_helper.set_confirmation_token(rally_point_html=rally_screen)
+        self._schedule_session_refresh()
+
+    def on_map_refresh(self, payload=None):
+        """
+        Re-fetches stale map sectors & applies changes of map
+        (new / conquered barbarians, population) to attack targets.
+        """
+        changed, removed = {}, []
+        fetched, missing = set(), []
+        cached = self.map_cache.get_origins()
+        half = MapCrawler.SECTOR_SIZE // 2
+        for origin in self.map_cache.get_stale_origins():
+            if origin in fetched:
+                continue
+            # map overview contains 4 sectors around given point: it is
+            # requested at the center of stale sector (like MapCrawler
+            # does), so the sector itself is certainly among them
+            map_overview_html = self._get_map_overview(settings.MAIN_VILLAGE_ID,
+                                                       origin[0] + half,
+                                                       origin[1] + half)
+            sectors = self.map_parser.collect_sectors(map_overview_html)
+            # sectors around it are saved only if they are already cached
+            # or within farm area, so cached area doesn't grow with each
+            # refresh
+            sectors = {sector_origin: sector for sector_origin, sector in
+                       sectors.items() if sector_origin in cached or
+                       sector_origin in self.map_origins}
+            sectors_changed, sectors_removed = self.map_cache.update_sectors(sectors)
+            changed.update(sectors_changed)
+            removed.extend(sectors_removed)
+            fetched.update(sectors)
+            if origin not in sectors:
+                missing.append(origin)
+        if missing:
+            # e.g. beyond the edge of map: sector is not re-fetched until
+            # it becomes stale again
+            self.map_cache.touch_sectors(missing)
+        if changed or removed:
+            new_targets, removed_targets = self.village_manager.\
+                apply_map_delta(changed, removed,
+                                trusted_targets=settings.TRUSTED_TARGETS,
+                                untrusted_targets=settings.UNTRUSTED_TARGETS,
+                                server_speed=self.world_config.speed)
+            self.attack_manager.update_targets(new_targets, removed_targets)
+            if new_targets:
+                self.village_manager.enable_idle_villages()
+                self.send_attacks()
+        self._schedule_map_refresh()
+
+    def send_attacks(self):
+        """
+        Sends attacks until any of player's villages is able to attack.
+        """
+        while self.active and self.attack_next() is not None:
+            if not settings.DEBUG:
+                time.sleep(random.random() * 5)
 
     def attack_cycle(self):
         """
@@ -171,14 +383,8 @@ class Bot(Thread):
         about attack targets.
         2. We check if some troops have returned to their origins.
         If so, we could possibly send more new attacks.
-        3. We 'think' which village should attack next. If there no
-        villages that could attack, then we 'sleep'.
-        4. We 'decide' which target we'll attack next. If there no
-        target which our 'attacker' could attack, we 'disable' attacker
-        and 'sleep'..
-        5. We 'send' attack and if it was sent successfully, we 'register'
-        this attack to 'keep an eye' on it. Otherwise, we 'sleep' and
-        exit cycle.
+        3. We try to send the next attack (see .attack_next()) & 'sleep'
+        a bit after it.
         """
         self.in_cycle = True
         new_arrivals = self.attack_manager.get_new_arrivals()
@@ -192,70 +398,126 @@ class Bot(Thread):
                 train_screen = self._get_train_screen(pv_id)
                 self.village_manager.refresh_village_troops(pv_id, train_screen)
 
-        next_attacker = self.village_manager.get_next_attacking_village()
-        if not next_attacker:
-            # any of player's villages cannot attack
-            if not settings.DEBUG:
+        attack_status = self.attack_next()
+        if not settings.DEBUG:
+            if attack_status is None:
                 time.sleep(random.random() * 20)
-                return
+            elif attack_status is False:
+                time.sleep(random.random() * 10)
+            else:
+                time.sleep(random.random() * 5)
+        self.in_cycle = False
 
-        attacker_id = next_attacker.id
-        next_target = self.attack_manager.\
-            get_next_attack_target(next_attacker=next_attacker,
+    def attack_next(self):
+        """
+        1. We 'think' which village should attack next. If there no
+        villages that could attack, returns None. (With settings.PLAN_ATTACKS
+        both attacker & target are taken from schedule of AttackManager.)
+        2. We 'decide' which target we'll attack next. If there no
+        target which our 'attacker' could attack, we 'disable' attacker
+        and return False.
+        3. We 'send' attack and if it was sent successfully, we 'register'
+        this attack to 'keep an eye' on it (& schedule its arrival and
+        return). Returns True. If attack was not sent, we 'disable'
+        attacker and return False.
+        """
+        if settings.PLAN_ATTACKS:
+            attackers = self.village_manager.get_active_farming_villages()
+            planned_attack = self.attack_manager.\
+                get_planned_attack(attackers=attackers,
                                    t_limit_to_leave=settings.T_LIMIT_TO_LEAVE,
                                    insert_spy=True)
-        if not next_target:
-            # given attacker cannot attack any of its targets
-            self.village_manager.disable_farming_village(attacker_id)
-            event_msg = "Disabling player's village:{id}".format(id=attacker_id)
-            logging.info(event_msg)
-            if not settings.DEBUG:
-                time.sleep(random.random() * 10)
-                return
+            if not planned_attack:
+                # any of player's villages cannot attack
+                return None
+            attacker_id, next_target = planned_attack
+        else:
+            next_attacker = self.village_manager.get_next_attacking_village()
+            if not next_attacker:
+                # any of player's villages cannot attack
+                return None
+
+            attacker_id = next_attacker.id
+            next_target = self.attack_manager.\
+                get_next_attack_target(next_attacker=next_attacker,
+                                       t_limit_to_leave=settings.T_LIMIT_TO_LEAVE,
+                                       insert_spy=True)
+            if not next_target:
+                # given attacker cannot attack any of its targets: it is
+                # enabled again when targets return to queue
+                self.village_manager.disable_farming_village(attacker_id,
+                                                             no_targets=True)
+                event_msg = "Disabling player's village:{id}".format(id=attacker_id)
+                logging.info(event_msg)
+                return False
 
         troops_to_send, t_on_road, target_coords = \
             next_target[0], next_target[1], next_target[2]
         t_of_attack = self.send_attack(attacker_id, coords=target_coords,
                                        troops=troops_to_send)
         logging.info("Time of the last attack: {}".format(t_of_attack))
-        if t_of_attack:
-            self.attack_manager.register_attack(attacker_id=attacker_id,
-                                                target_coords=target_coords,
-                                                t_of_attack=t_of_attack,
-                                                t_on_the_road=t_on_road)
-            self.village_manager.update_troops_count(attacker_id, troops_to_send)
-            event_msg = "Attack sent at: {t1} from: {s} to: {c}. " \
-                        "Troops: {tr}".format(t1=t_of_attack, s=attacker_id,
-                                              c=target_coords, tr=troops_to_send)
-
-            logging.info(event_msg)
-        if not settings.DEBUG:
-            time.sleep(random.random() * 5)
-        self.in_cycle = False
+        if not t_of_attack:
+            # attack was not sent (e.g. troops count has changed): attacker
+            # is enabled again on return of its troops
+            self.village_manager.disable_farming_village(attacker_id)
+            event_msg = "Attack from: {s} to: {c} was not sent, disabling " \
+                        "player's village".format(s=attacker_id, c=target_coords)
+            logging.warning(event_msg)
+            return False
+        t_of_arrival, t_of_return = self.attack_manager.\
+            register_attack(attacker_id=attacker_id,
+                            target_coords=target_coords,
+                            t_of_attack=t_of_attack,
+                            t_on_the_road=t_on_road)
+        self.event_scheduler.schedule(t_of_arrival, EventScheduler.ARRIVAL,
+                                      target_coords)
+        self.event_scheduler.schedule(t_of_return, EventScheduler.RETURN,
+                                      attacker_id)
+        self.village_manager.update_troops_count(attacker_id, troops_to_send)
+        event_msg = "Attack sent at: {t1} from: {s} to: {c}. " \
+                    "Troops: {tr}".format(t1=t_of_attack, s=attacker_id,
+                                          c=target_coords, tr=troops_to_send)
+
+        logging.info(event_msg)
+        return True
 
     def get_new_reports(self, new_arrivals):
         """
-        Retrieves new battle reports from game basing on a given
-        count of arrived attacks.
+        Retrieves new battle reports from game: pages through reports
+        (from the newest to older ones) until the last handled report
+        is reached.
+        Number of pages is limited basing on a given count of arrived
+        attacks (the last handled report, if known, only stops paging
+        earlier).
         """
         new_battle_reports = []
         # 12 reports on 1 page
-        report_pages = new_arrivals // 12
         # sanity check: reports may be shifted due to user actions
         # (trade, support, etc.)
-        report_pages += 1
-        for report_page in range(report_pages):
+        max_pages = new_arrivals // 12 + 1
+        if self.report_manager.last_report_id is not None:
+            # the last handled report may have been deleted by user
+            max_pages += self.EXTRA_REPORT_PAGES
+        report_page = 0
+        while report_page < max_pages:
             from_page_param = report_page * 12
             html_report_page = self._get_reports_page(from_page_param)
-            report_urls = self.report_manager.get_report_urls(html_report_page)
-            for report_url in report_urls:
-                html_report = self._get_report(report_url)
-                attack_report = self.report_manager.build_report(html_report)
+            new_reports, reached_last = \
+                self.report_manager.get_new_report_urls(html_report_page)
+            html_reports = [self._get_report(report_url) for _, report_url
+                            in new_reports]
+            attack_reports = self.report_manager.build_reports(html_reports)
+            for (report_id, _), attack_report in zip(new_reports, attack_reports):
+                self.report_manager.mark_parsed(report_id)
                 if attack_report.status is not None:
                     # placeholder for specific actions: save bad reports, etc.
                     if attack_report.status in ['red', 'red_blue']:
                         pass
                     new_battle_reports.append(attack_report)
+            if reached_last:
+                break
+            report_page += 1
+        self.report_manager.save_last_report_id()
         return new_battle_reports
 
     def send_attack(self, attacker_id, coords, troops):
@@ -300,90 +562,55 @@ class Bot(Thread):
         Asks AttackManager for a TargetVillages in AttackQueue (since
         they were updated with new battle reports during farm)
         Asks VillageManager to save updated TargetVillages to storage.
+        Since everything is saved, journal of changes is cleared.
         """
         self.attack_manager.save_registered_attacks()
         recent_targets = self.attack_manager.get_recent_targets_info()
         self.village_manager.update_villages_in_storage(recent_targets)
+        self.attack_manager.clear_journal()
 
-    def _get_map_data(self, distinct_farming_centers, map_depth):
-        """
-        Tries to retrieve distinct sectors data for given
-        farming centers.
-        Takes map_depth parameter which allows to get additional
-        sectors_data recursively.
-        That is, if map_depth=1, sectors_data will be retrieved only once
-        (using farming center as a base).
-        If map_depth=2, additional sectors_data will be retrieved for "corners"
-        of 1st-level sectors_data, and so on.
-        (Note: Sectors data will be retrieved at least once (e.g. with zero/negative
-        initial value of map_depth).
+    def _schedule_rest_expiry(self, coords=None):
+        expiry_times = self.attack_manager.get_rest_expiry_times(coords)
+        for villa_coords, t_of_expiry in expiry_times.items():
+            self.event_scheduler.schedule(t_of_expiry, EventScheduler.REST_EXPIRY,
+                                          villa_coords)
+
+    def _schedule_session_refresh(self):
+        t_of_refresh = time.mktime(time.gmtime()) + \
+            settings.SESSION_REFRESH_INTERVAL * 3600
+        self.event_scheduler.schedule(t_of_refresh, EventScheduler.SESSION_REFRESH)
+
+    def _schedule_map_refresh(self):
+        t_of_refresh = self.map_cache.get_next_expiry()
+        if t_of_refresh is not None:
+            self.event_scheduler.schedule(t_of_refresh, EventScheduler.MAP_REFRESH)
+
+    def _get_speed_factor(self):
+        return self.world_config.get_speed_factor()
 
-        Merges data from all retrieved sectors and returns dictionary
-        of all found villages data in area: {(x,y): [village_data, ..], ...}
+    def _get_map_data(self, farming_centers, radius):
         """
-        map_depth -= 1
-        map_data = {}
-        while distinct_farming_centers:  # list of farming centers
-            check_center = distinct_farming_centers[0]
-            center_coords = check_center.coords
-            center_x, center_y = center_coords[0], center_coords[1]
-            center_id = check_center.id
-            map_overview_html = self._get_map_overview(center_id, center_x, center_y)
-
-            event_msg = "Retrieving map data from ({x},{y}) base point." \
-                        "Map depth={depth}".format(x=center_x, y=center_y, depth=map_depth)
-            logging.debug(event_msg)
-
-            sectors_data = self.map_parser.collect_sector_data(map_overview_html)
-            distinct_farming_centers = self._filter_distinct_centers(center_coords,
-                                                                     distinct_farming_centers,
-                                                                     sectors_data)
-            area_data = self._merge_sectors_data(sectors_data)
-            if map_depth > 0:
-                area_coords = area_data.keys()
-                area_corners = MapMath.get_area_corners(area_coords)
-
-                event_msg = "Calculated the next area corners: {}".format(area_corners)
-                logging.debug(event_msg)
-
-                for corner in area_corners:
-                    # area_data[(x, y)] - village data, 0 index = str(village_id)
-                    corner_id = int(area_data[corner][0])
-                    centers = [Village(corner_id, corner)]
-                    # Delay between "user" requests of map overview
-                    if not settings.DEBUG:
-                        time.sleep(random.random() * 6)
-                    area_data.update(self._get_map_data(centers, map_depth))
-
-            map_data.update(area_data)
-
-        return map_data
-
-    @staticmethod
-    def _filter_distinct_centers(current_coords, centers, sectors_data):
-        """
-        Checks to which sector current attacker belongs and
-        sorts out all attackers that also belong to the same sector.
-        Returns a list of attacking centers that are not "neighbors"
-        of a given attacker.
-        """
-        distinct_centers = []
-        for sector in sectors_data:
-            if current_coords in sector:
-                for center in centers:
-                    if center.coords not in sector:
-                        distinct_centers.append(center)
-        return distinct_centers
-
-    @staticmethod
-    def _merge_sectors_data(sectors_data):
-        """
-        Merges all given sectors to one area dictionary
-        """
-        area = {}
-        for sector in sectors_data:
-            area.update(sector)
-        return area
+        Asks MapCrawler to collect sectors around given farming centers
+        within a given radius (each sector is requested at most once).
+        Collected sectors are saved to MapSectorCache.
+        Returns dictionary of all found villages data in area:
+        {(x,y): [village_data, ..], ...}
+        """
+        def fetch_overview(village_id, x, y):
+            # Delay between "user" requests of map overview
+            if crawler.requests and not settings.DEBUG:
+                time.sleep(random.random() * 6)
+            return self._get_map_overview(village_id, x, y)
+
+        on_sectors = self.map_cache.update_sectors if self.map_cache else None
+        crawler = MapCrawler(self.map_parser, fetch_overview, on_sectors)
+        return crawler.crawl(farming_centers, radius)
+
+    def _get_world_settings(self):
+        if not settings.DEBUG:
+            time.sleep(random.random())
+        resp = self.request_manager.get_world_settings()
+        return resp['response_text']
 
     def _get_overviews_screen(self):
         if not settings.DEBUG:
@@ -1,13 +1,36 @@
 import time
-import re
+import heapq
+import bisect
 import logging
+from operator import itemgetter
+from itertools import islice
 from urllib.parse import urlencode
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from bot.libs.common_tools import Storage
+from bot.libs.common_tools import Storage, AttackJournal
+from bot.libs.patterns import PATTERNS
 
 
-__all__ = ['AttackManager', 'DecisionMaker', 'AttackObserver', 'AttackHelper',
-           'AttackQueue', 'Unit']
+__all__ = ['AttackManager', 'DecisionMaker', 'AttackPlanner', 'AttackObserver',
+           'AttackHelper', 'AttackQueue', 'Unit']
+
+
+# attack, speed (minutes per tile on x1 world) & haul of units that may
+# farm by default; stats of current world are given to Unit.build_units
+UNIT_STATS = {'spear': (10, 18, 25),
+              'sword': (25, 22, 15),
+              'archer': (15, 18, 10),
+              'axe': (40, 18, 10),
+              'spy': (0, 9, 0),
+              'light': (130, 10, 80),
+              'marcher': (120, 10, 50),
+              'heavy': (150, 11, 50)}
+DEF_UNIT_NAMES = ('spear', 'sword', 'archer', 'axe', 'spy',
+                  'light', 'marcher', 'heavy')
+OFF_UNIT_NAMES = ('axe', 'spy', 'light', 'marcher', 'heavy')
 
 
 class AttackManager:
@@ -16,19 +39,47 @@ class AttackManager:
     operations on attack targets.
     Collaborates with AttackObserver, AttackQueue &
     DecisionMaker classes.
+    Keeps a few ranked alternatives of the last decision per attacker,
+    so its next attacks are taken from them w/o scanning targets again
+    (for a short time, since troops needed were estimated for arrival
+    at that time).
     """
 
-    def __init__(self, storage_type, storage_name):
+    # number of ranked alternatives kept per attacker & for how long
+    # (seconds) alternatives & attack schedule are used
+    ALTERNATIVES = 3
+    ALTERNATIVES_TTL = 120
+
+    def __init__(self, storage_type, storage_name, journal_name=None,
+                 speed_factor=1, unit_stats=None):
         self.attack_observer = AttackObserver(storage_type, storage_name)
         self.attack_queue = AttackQueue()
-        self.decision_maker = DecisionMaker()
+        self.decision_maker = DecisionMaker(speed_factor, unit_stats)
+        self.attack_planner = AttackPlanner(unit_stats)
+        # {attacker_id: (t_of_decision, [[troops, t_on_road, coords], ...])}
+        self.alternatives = {}
+        # [(attacker_id, [troops, t_on_road, coords]), ...] & time when
+        # it was made
+        self.attack_schedule = []
+        self.t_of_schedule = None
+        self.journal = None
+        # whether records were replayed from journal (i.e. bot crashed)
+        self.journal_replayed = False
+        if journal_name:
+            self.journal = AttackJournal(journal_name)
+            self.attack_observer.journal = self.journal
+            self.attack_queue.journal = self.journal
 
     def build_attack_queue(self, target_villages, farm_frequency):
         """
         Asks AttackQueue to build a queue of attack targets considering
         the targets which wait for arrival of previously sent attacks.
+        Attacks & villages' updates from journal (i.e. made after the
+        last save to storage) are replayed on top of saved ones.
         """
         self.attack_observer.restore_saved_attacks()
+        if self.journal is not None:
+            self._replay_journal(target_villages)
         pending_arrival = self.attack_observer.get_targets_pending_arrival()
         self.attack_queue.build_queue(pending_arrival, target_villages,
                                       farm_frequency)
@@ -39,22 +90,72 @@ class AttackManager:
         battle reports
         """
         self.attack_queue.update_villages(new_reports)
+        self._drop_decisions()
 
     def get_next_attack_target(self, next_attacker, t_limit_to_leave, insert_spy):
         """
         Asks AttackQueue for a tuple of attack targets available
         for a given attacker.
         Asks DecisionMaker to provide next attack target & troops
-        needed to perform attack
+        needed to perform attack (together with a few alternatives,
+        which are used first next time, if they are still valid).
         """
+        attacker_troops = next_attacker.get_troops_count()
+        next_target = self._pop_alternative(next_attacker.id, attacker_troops)
+        if next_target:
+            return next_target
         available_targets = self.attack_queue.get_available_targets(next_attacker)
         if available_targets:
-            attacker_troops = next_attacker.get_troops_count()
-            next_target = self.decision_maker.get_next_attack_target(available_targets,
-                                                                     attacker_troops,
-                                                                     t_limit_to_leave,
-                                                                     insert_spy)
-            return next_target
+            ranked_targets = self.decision_maker.\
+                rank_attack_targets(available_targets, attacker_troops,
+                                    t_limit_to_leave, insert_spy,
+                                    limit=self.ALTERNATIVES + 1,
+                                    travel_times=next_attacker.travel_times)
+            if ranked_targets:
+                self.alternatives[next_attacker.id] = (time.mktime(time.gmtime()),
+                                                       ranked_targets[1:])
+                return ranked_targets[0]
+
+    def get_planned_attack(self, attackers, t_limit_to_leave, insert_spy):
+        """
+        Returns the next attack (tuple (attacker_id, [troops, t_on_road,
+        target_coords])) of schedule made by AttackPlanner for all given
+        attackers ({attacker_id: PlayerVillage}) at once. Schedule is made
+        again when it runs out, when attack targets were updated or when
+        it is older than ALTERNATIVES_TTL (troops needed were estimated
+        for arrival at the time of schedule).
+        Attacks which are not valid anymore (target has left queue or
+        there are not enough troops) are skipped; if none of them was
+        valid, schedule is made again once.
+        Returns None if none of attackers could attack.
+        """
+        now = time.mktime(time.gmtime())
+        if self.attack_schedule and now - self.t_of_schedule > self.ALTERNATIVES_TTL:
+            self.attack_schedule = []
+        is_new = not self.attack_schedule
+        if is_new:
+            self._make_schedule(attackers, t_limit_to_leave, insert_spy, now)
+        planned_attack = self._pop_planned_attack(attackers)
+        if planned_attack is None and not is_new:
+            # the rest of schedule was stale
+            self._make_schedule(attackers, t_limit_to_leave, insert_spy, now)
+            planned_attack = self._pop_planned_attack(attackers)
+        return planned_attack
+
+    def plan_attacks(self, attackers, t_limit_to_leave, insert_spy):
+        """
+        Asks DecisionMaker to rank available targets of each attacker &
+        AttackPlanner to assign targets to attackers.
+        """
+        candidates, troops = {}, {}
+        for attacker_id, attacker in attackers.items():
+            available_targets = self.attack_queue.get_available_targets(attacker)
+            troops[attacker_id] = attacker.get_troops_count()
+            candidates[attacker_id] = self.decision_maker.\
+                rank_attack_targets(available_targets, troops[attacker_id],
+                                    t_limit_to_leave, insert_spy,
+                                    travel_times=attacker.travel_times)
+        return self.attack_planner.plan(candidates, troops)
 
     def get_new_arrivals(self):
         new_arrivals = self.attack_observer.is_someone_arrived()
@@ -70,12 +171,33 @@ class AttackManager:
         Asks AttackObserver to place time_of_arrival & time_of_return
         to its queues.
         Asks AttackQueue to remove attack target from queue.
+        Returns tuple (t_of_arrival, t_of_return).
         """
         t_of_arrival, t_of_return = self._get_arrival_return_t(t_of_attack,
                                                                t_on_the_road)
         self.attack_observer.register_attack(attacker_id, target_coords,
                                              t_of_arrival, t_of_return)
         self.attack_queue.remove_villa_from_queue(target_coords)
+        return t_of_arrival, t_of_return
+
+    def get_registered_attacks(self):
+        """
+        Returns tuple of registered arrivals {(x, y): t_of_arrival} &
+        returns {attacker_id: [t_of_return, ...]}
+        """
+        return (self.attack_observer.arrival_queue,
+                self.attack_observer.return_queue)
+
+    def get_rest_expiry_times(self, coords=None):
+        return self.attack_queue.get_rest_expiry_times(coords)
+
+    def refresh_attack_queue(self):
+        """
+        Asks AttackQueue to return visited villages that have finished
+        to rest back to queue.
+        """
+        self.attack_queue.flush_visited_villages()
+        self._drop_decisions()
 
     def save_registered_attacks(self):
         self.attack_observer.save_registered_attacks()
@@ -83,6 +205,102 @@ class AttackManager:
     def get_recent_targets_info(self):
         return self.attack_queue.villages
 
+    def update_targets(self, new_targets, removed):
+        """
+        Asks AttackQueue to add new targets to queue & to forget
+        targets that were removed from map.
+        """
+        self.attack_queue.update_targets(new_targets, removed)
+        self._drop_decisions()
+
+    def clear_journal(self):
+        """
+        Should be called when registered attacks & recent targets
+        were saved to storage.
+        Untrusted villages are not saved to storage, so they are
+        written to journal again.
+        """
+        if self.journal is not None:
+            self.journal.clear()
+            for coords in self.attack_queue.untrusted_villages:
+                self.journal.append((AttackJournal.UNTRUSTED, coords))
+            self.journal.sync()
+            self.journal_replayed = False
+
+    def close(self):
+        """
+        Closes storage of attacks & journal (if any).
+        """
+        self.attack_observer.storage.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    def _drop_decisions(self):
+        """
+        Attack targets were updated: decisions made before are stale.
+        """
+        self.alternatives.clear()
+        self.attack_schedule = []
+
+    def _make_schedule(self, attackers, t_limit_to_leave, insert_spy, now):
+        self.attack_schedule = self.plan_attacks(attackers, t_limit_to_leave,
+                                                 insert_spy)
+        self.t_of_schedule = now
+
+    def _pop_planned_attack(self, attackers):
+        """
+        Pops attacks from schedule until the one which is still valid.
+        """
+        while self.attack_schedule:
+            attacker_id, next_target = self.attack_schedule.pop(0)
+            attacker = attackers.get(attacker_id)
+            if attacker is None or next_target[2] not in self.attack_queue.queue:
+                continue
+            attacker_troops = attacker.get_troops_count()
+            if all(attacker_troops.get(name, 0) >= count
+                   for name, count in next_target[0].items()):
+                return attacker_id, next_target
+
+    def _pop_alternative(self, attacker_id, attacker_troops):
+        """
+        Returns the first of saved alternatives for a given attacker,
+        which target is still in queue & troops are still available.
+        Alternatives older than ALTERNATIVES_TTL are dropped.
+        """
+        if attacker_id not in self.alternatives:
+            return
+        t_of_decision, alternatives = self.alternatives[attacker_id]
+        if time.mktime(time.gmtime()) - t_of_decision > self.ALTERNATIVES_TTL:
+            del self.alternatives[attacker_id]
+            return
+        while alternatives:
+            alternative = alternatives.pop(0)
+            troops_to_send, target_coords = alternative[0], alternative[2]
+            if target_coords in self.attack_queue.queue and \
+                    all(attacker_troops.get(name, 0) >= count
+                        for name, count in troops_to_send.items()):
+                return alternative
+
+    def _replay_journal(self, target_villages):
+        records = self.journal.replay()
+        logging.info("Replaying {} records from journal".format(len(records)))
+        untrusted = set()
+        for record in records:
+            if record[0] == AttackJournal.ATTACK:
+                _, attacker_id, coords, t_of_arrival, t_of_return = record
+                self.attack_observer.restore_attack(attacker_id, coords,
+                                                    t_of_arrival, t_of_return)
+            elif record[0] == AttackJournal.VILLAGE:
+                _, coords, village = record
+                if coords in target_villages:
+                    target_villages[coords] = village
+            elif record[0] == AttackJournal.UNTRUSTED:
+                untrusted.add(record[1])
+        for coords in untrusted:
+            if coords in target_villages:
+                self.attack_queue.untrusted_villages[coords] = target_villages[coords]
+        self.journal_replayed = bool(records)
+
     def _get_arrival_return_t(self, t_of_attack, t_on_road):
         t_of_attack = self._convert_t_to_seconds(t_of_attack)
         t_of_arrival = t_of_attack + t_on_road
@@ -108,15 +326,59 @@ class AttackQueue:
     1) get available attack targets from queue
     2) remove attack target from queue
     3) update attack targets in queue with new AttackReports
+    4) tell when visited villages will finish to rest
+    5) add / remove targets upon changes of map
     """
 
     def __init__(self):
+        self.journal = None
         self.villages = {}
         self.rest = None
-        self.queue = {}
-        self.visited_villages = {}
+        # {(x, y): village} of targets ready for farm;
+        # per attacker: sorted positions (in attacker.attack_targets, i.e.
+        # in order of distance) of targets that are in queue, & positions
+        # of each target in attack targets of attackers
+        self._ready_positions = {}
+        self._attacker_targets = {}
+        self._target_positions = {}
+        self._queue = {}
+        # changed on each change of queue (& its indexes), so generators
+        # of available targets notice that queue has changed under them
+        self._version = 0
+        # {(x, y): village} is backed by a heap of (t_ready, coords) -
+        # time when visited village may be farmed again (& index of
+        # these times to skip stale heap entries), so flush pops only
+        # villages that are ready.
+        self._visited = {}
+        self._ready_heap = []
+        self._ready_times = {}
         self.untrusted_villages = {}
 
+    @property
+    def queue(self):
+        return self._queue
+
+    @queue.setter
+    def queue(self, queue):
+        self._queue = queue
+        self._version += 1
+        # indexes of attackers are built again on demand
+        self._ready_positions = {}
+        self._attacker_targets = {}
+        self._target_positions = {}
+
+    @property
+    def visited_villages(self):
+        return self._visited
+
+    @visited_villages.setter
+    def visited_villages(self, villages):
+        self._visited = {}
+        self._ready_heap = []
+        self._ready_times = {}
+        for coords, village in villages.items():
+            self._add_visited(coords, village)
+
     def build_queue(self, pending_arrival, target_villages, farm_frequency):
         """
         Builds queue from villages that are ready for farm.
@@ -127,6 +389,8 @@ class AttackQueue:
 
         self.rest = farm_frequency
         self.villages = target_villages
+        # re-index villages, that were visited before rest was known
+        self.visited_villages = dict(self._visited)
         queue = {}
         for coords, village in target_villages.items():
             if coords not in pending_arrival and coords not in self.visited_villages:
@@ -139,19 +403,32 @@ class AttackQueue:
                     # has not finished to rest. We can enter to this condition
                     # if Village is untrusted, but it is still a visited
                     # Village, and it will not be placed to .attack_queue.
-                    self.visited_villages[coords] = village
+                    self._add_visited(coords, village)
 
         self.queue = queue
 
     def get_available_targets(self, attacker):
+        """
+        Returns generator of (village, distance, position) tuples of
+        attacker's targets that are in queue (nearest first), where
+        position is an index of target in attacker.attack_targets.
+        Targets are taken from queue lazily: generator raises
+        RuntimeError, if queue was changed while it was consumed.
+        """
         attack_targets = attacker.attack_targets
-        available_targets = ((self.queue[coords], dst) for
-                             coords, dst in attack_targets if
-                             coords in self.queue)
-        return available_targets
+        if self._attacker_targets.get(attacker.id) is not attack_targets:
+            self._index_attacker(attacker.id, attack_targets)
+        return self._iter_available_targets(self._ready_positions[attacker.id],
+                                            attack_targets)
 
     def remove_villa_from_queue(self, coords):
         self.queue.pop(coords)
+        self._version += 1
+        for attacker_id, position in self._target_positions.get(coords, {}).items():
+            ready_positions = self._ready_positions[attacker_id]
+            index = bisect.bisect_left(ready_positions, position)
+            if index < len(ready_positions) and ready_positions[index] == position:
+                del ready_positions[index]
 
     def update_villages(self, new_reports):
         """
@@ -177,15 +454,54 @@ class AttackQueue:
                     logging.info("Villa after update: "
                                  "{}".format(self.villages[coords]))
 
+                    if self.journal is not None:
+                        self.journal.append((AttackJournal.VILLAGE, coords,
+                                             village))
                     if attack_report.defended:
                         self.untrusted_villages[coords] = village
+                        if self.journal is not None:
+                            self.journal.append((AttackJournal.UNTRUSTED,
+                                                 coords))
                     # Avoid adding duplicate villages to visited
-                    # due to user-sent attacks, etc.
-                    if coords not in self.visited_villages:
-                        self.visited_villages[coords] = village
+                    # due to user-sent attacks, etc. (but time when
+                    # village is ready has changed)
+                    self._add_visited(coords, village)
 
         self._flush_visited_villages()
 
+    def get_rest_expiry_times(self, coords=None):
+        """
+        Returns {(x, y): t} - time when visited (and trusted) villages
+        will be ready for farm again (see ._get_t_ready): villages with
+        valuable loot are ready right away. Considers only given
+        coords, if any.
+        """
+        if coords is None:
+            coords = self.visited_villages.keys()
+        expiry_times = {}
+        for villa_coords in coords:
+            village = self.visited_villages.get(villa_coords)
+            if village is None:
+                continue
+            t_ready = self._get_t_ready(village)
+            if t_ready is not None:
+                expiry_times[villa_coords] = t_ready
+        return expiry_times
+
+    def update_targets(self, new_targets, removed):
+        for coords in removed:
+            self.villages.pop(coords, None)
+            if coords in self.queue:
+                self.remove_villa_from_queue(coords)
+            self._visited.pop(coords, None)
+            self._ready_times.pop(coords, None)
+        for coords, village in new_targets.items():
+            self.villages[coords] = village
+            self._add_to_queue(coords, village)
+
+    def flush_visited_villages(self):
+        self._flush_visited_villages()
+
     def _is_ready_for_farm(self, village):
         if not village.coords in self.untrusted_villages:
             if village.finished_rest(self.rest) or \
@@ -193,13 +509,80 @@ class AttackQueue:
                 return True
         return False
 
+    def _iter_available_targets(self, ready_positions, attack_targets):
+        version = self._version
+        queue = self.queue
+        for position in ready_positions:
+            coords, distance = attack_targets[position]
+            yield queue[coords], distance, position
+            if self._version != version:
+                raise RuntimeError("Attack queue has changed during iteration "
+                                   "over available targets")
+
+    def _add_to_queue(self, coords, village):
+        self._version += 1
+        if coords not in self.queue:
+            for attacker_id, position in self._target_positions.get(coords, {}).items():
+                bisect.insort(self._ready_positions[attacker_id], position)
+        self.queue[coords] = village
+
+    def _index_attacker(self, attacker_id, attack_targets):
+        old_targets = self._attacker_targets.get(attacker_id)
+        if old_targets is not None:
+            for coords, _ in old_targets:
+                self._target_positions.get(coords, {}).pop(attacker_id, None)
+        ready_positions = []
+        for position, (coords, _) in enumerate(attack_targets):
+            self._target_positions.setdefault(coords, {})[attacker_id] = position
+            if coords in self.queue:
+                ready_positions.append(position)
+        self._ready_positions[attacker_id] = ready_positions
+        self._attacker_targets[attacker_id] = attack_targets
+
+    def _add_visited(self, coords, village):
+        self._visited[coords] = village
+        t_ready = self._get_t_ready(village)
+        if t_ready is None:
+            self._ready_times.pop(coords, None)
+        elif self._ready_times.get(coords) != t_ready:
+            self._ready_times[coords] = t_ready
+            heapq.heappush(self._ready_heap, (t_ready, coords))
+
+    def _get_t_ready(self, village):
+        """
+        Returns time when village is ready for farm (see
+        ._is_ready_for_farm) or None, if it will not be ready by itself.
+        """
+        if self.rest is None or village.coords in self.untrusted_villages:
+            return None
+        if village.has_valuable_loot(self.rest):
+            return 0
+        if village.last_visited:
+            # .finished_rest() expects strictly longer rest
+            return village.last_visited + self.rest * 3600 + 1
+
     def _flush_visited_villages(self):
         """
-        Updates self.queue with villages that could be farmed again.
+        Updates self.queue with villages that could be farmed again:
+        pops villages which time has come from heap.
         """
-        ready_for_farm = {coords: villa for coords, villa in
-                          self.visited_villages.items() if
-                          self._is_ready_for_farm(villa)}
+        time_gmt = time.mktime(time.gmtime())
+        ready_heap = self._ready_heap
+        ready_for_farm = {}
+        while ready_heap and ready_heap[0][0] <= time_gmt:
+            t_ready, coords = heapq.heappop(ready_heap)
+            if self._ready_times.get(coords) != t_ready:
+                continue
+            del self._ready_times[coords]
+            village = self._visited[coords]
+            if self._is_ready_for_farm(village):
+                ready_for_farm[coords] = village
+            else:
+                # village was changed w/o re-indexing
+                t_ready = self._get_t_ready(village)
+                if t_ready is not None and t_ready > time_gmt:
+                    self._ready_times[coords] = t_ready
+                    heapq.heappush(ready_heap, (t_ready, coords))
         if ready_for_farm:
             logging.info("Going to flush the next villages: "
                          "{}".format(ready_for_farm))
@@ -207,8 +590,8 @@ class AttackQueue:
                          "{}".format(len(self.queue)))
 
             for coords, village in ready_for_farm.items():
-                self.queue[coords] = village
-                self.visited_villages.pop(coords)
+                self._add_to_queue(coords, village)
+                self._visited.pop(coords)
 
             logging.info("Queue length after flushing: "
                          "{}".format(len(self.queue)))
@@ -221,10 +604,17 @@ class DecisionMaker:
     2. Consider villages from nearest to outermost. Basing on information
     about village (distance, expected capacity) tries to form an attacking
     group from a given troops count.
+    3. May rank all available villages in one pass & return the best few
+    of them (see .rank_attack_targets).
     """
 
-    def __init__(self):
-        self.units = Unit.build_units()
+    # targets are ranked in chunks (nearest first), which grow from
+    # MIN_CHUNK to MAX_CHUNK targets, until 'limit' decisions are made
+    MIN_CHUNK = 16
+    MAX_CHUNK = 512
+
+    def __init__(self, speed_factor=1, unit_stats=None):
+        self.units = Unit.build_units(speed_factor, unit_stats)
 
     def get_next_attack_target(self, available_targets, attacker_troops,
                                t_limit, insert_spy):
@@ -233,32 +623,162 @@ class DecisionMaker:
         troops, if so - returns list [{"unit_to_send": int, ...},  t_on_road,,
         target_coords], otherwise - None.
         """
+        ranked_targets = self.rank_attack_targets(available_targets, attacker_troops,
+                                                  t_limit, insert_spy, limit=1)
+        if ranked_targets:
+            target_coords = ranked_targets[0][2]
+            logging.info("Attacker passed check, attack will be sent to "
+                         "{}".format(target_coords))
+            return ranked_targets[0]
+
+    def rank_attack_targets(self, available_targets, attacker_troops,
+                            t_limit, insert_spy, limit=None, travel_times=None):
+        """
+        Scores given targets ((target, distance) pairs in order of
+        distance) with the same troops: troops map & current time are
+        calculated once. Returns list of the first 'limit' (or all)
+        targets that may be attacked, nearest first:
+        [[{"unit_to_send": int, ...}, t_on_road, target_coords], ...].
+        Targets are taken in chunks, the rest of them is not scored once
+        'limit' targets are found. If targets of a chunk are attached to
+        TargetVillageStore, their capacities are estimated in a batch
+        (per unit type).
+        travel_times ({unit_name: travel times aligned with attacker's
+        attack targets}, see PlayerVillage.set_travel_times) are used
+        instead of calculation, if targets come with their positions
+        ((target, distance, position) tuples).
+        """
         t_limit *= 3600  # to seconds
+        troops_map = self._get_troops_map(attacker_troops)
+        now = time.mktime(time.gmtime())
+        available_targets = iter(available_targets)
+        ranked_targets = []
+        chunk_size = self.MIN_CHUNK
+        while limit is None or len(ranked_targets) < limit:
+            chunk = list(islice(available_targets, chunk_size))
+            if not chunk:
+                break
+            chunk_limit = limit - len(ranked_targets) if limit is not None else None
+            ranked_targets.extend(self._rank_chunk(chunk, troops_map, attacker_troops,
+                                                   t_limit, insert_spy, now,
+                                                   chunk_limit, travel_times))
+            chunk_size = min(chunk_size * 2, self.MAX_CHUNK)
+        return ranked_targets
+
+    def _rank_chunk(self, available_targets, troops_map, attacker_troops, t_limit,
+                    insert_spy, now, limit, travel_times):
+        if numpy is not None:
+            store = getattr(available_targets[0][0], '_store', None)
+            ids = self._get_store_ids(available_targets, store)
+            if ids is not None:
+                return self._rank_in_batch(available_targets, ids, store, troops_map,
+                                           attacker_troops, t_limit, insert_spy,
+                                           now, limit, travel_times)
+        ranked_targets = []
         for target in available_targets:
+            if limit is not None and len(ranked_targets) >= limit:
+                break
             attack_target = target[0]
             dst_from_attacker = target[1]
+            position = target[2] if travel_times is not None else None
             check = self._is_attack_possible(attack_target, dst_from_attacker,
-                                             t_limit, attacker_troops, insert_spy)
+                                             t_limit, attacker_troops, insert_spy,
+                                             troops_map=troops_map, now=now,
+                                             travel_times=travel_times,
+                                             position=position)
             if check:
-                target_coords = attack_target.coords
-                logging.info("Attacker passed check, attack will be sent to "
-                             "{}".format(target_coords))
-                check.append(target_coords)
-                return check
+                check.append(attack_target.coords)
+                ranked_targets.append(check)
+        return ranked_targets
+
+    @staticmethod
+    def _get_store_ids(available_targets, store):
+        """
+        Returns ids of targets, if all of them are attached to a given
+        store (otherwise - None).
+        """
+        if store is None:
+            return None
+        ids = []
+        for target in available_targets:
+            village = target[0]
+            if village._store is not store:
+                return None
+            ids.append(village.id)
+        return ids
+
+    def _rank_in_batch(self, available_targets, ids, store, troops_map, troops_count,
+                       t_limit, insert_spy_in_attack, now, limit, travel_times=None):
+        """
+        The same as ._is_attack_possible for each of targets, but each
+        unit type is checked against all undecided targets at once.
+        """
+        distances = numpy.array([target[1] for target in available_targets],
+                                dtype=float)
+        if travel_times is not None:
+            positions = numpy.array([target[2] for target in available_targets],
+                                    dtype=numpy.intp)
+        # index of unit in troops map & number of units, per target
+        chosen_units = numpy.full(len(available_targets), -1)
+        units_needed = numpy.zeros(len(available_targets), dtype=numpy.int64)
+        undecided = numpy.ones(len(available_targets), dtype=bool)
+        for unit_index, (unit, count) in enumerate(troops_map):
+            if travel_times is not None and unit.name in travel_times:
+                times_on_road = numpy.asarray(travel_times[unit.name])[positions]
+            else:
+                times_on_road = distances * unit.speed * 60
+            candidates = numpy.flatnonzero(undecided & (times_on_road <= t_limit))
+            if not len(candidates):
+                continue
+            t_of_arrival = numpy.round(now + times_on_road[candidates])
+            capacities = store.estimate_capacity([ids[index] for index in candidates],
+                                                 t_of_arrival)
+            candidates_needed = numpy.round(capacities / unit.haul)
+            possible = candidates_needed <= count
+            chosen = candidates[possible]
+            chosen_units[chosen] = unit_index
+            units_needed[chosen] = candidates_needed[possible]
+            undecided[chosen] = False
+
+        decided = numpy.flatnonzero(chosen_units >= 0)
+        if limit is not None:
+            decided = decided[:limit]
+        insert_spy = insert_spy_in_attack and troops_count.get('spy', 0) >= 1
+        ranked_targets = []
+        for index, unit_index, needed in zip(decided.tolist(),
+                                             chosen_units[decided].tolist(),
+                                             units_needed[decided].tolist()):
+            unit = troops_map[unit_index][0]
+            attack_target, distance = available_targets[index][0], available_targets[index][1]
+            troops_to_send = {unit.name: needed}
+            if insert_spy:
+                troops_to_send['spy'] = 1
+            if travel_times is not None and unit.name in travel_times:
+                time_on_road = float(travel_times[unit.name][available_targets[index][2]])
+            else:
+                time_on_road = self._get_time_on_the_road(distance, unit.speed)
+            ranked_targets.append([troops_to_send, time_on_road, attack_target.coords])
+        return ranked_targets
 
     def _is_attack_possible(self, attack_target, distance, t_limit,
-                            troops_count, insert_spy_in_attack):
+                            troops_count, insert_spy_in_attack,
+                            troops_map=None, now=None, travel_times=None,
+                            position=None):
         """
         Evaluates if there are enough troops to loot all village
         resources at the time of arrival with given troops count.
         Returns units needed for attack and time needed to arrive.
         """
-        troops_map = self._get_troops_map(troops_count)
+        if troops_map is None:
+            troops_map = self._get_troops_map(troops_count)
         for unit, count in troops_map:    # (Unit: count)
-            time_on_road = self._get_time_on_the_road(distance, unit.speed)
+            if travel_times is not None and unit.name in travel_times:
+                time_on_road = float(travel_times[unit.name][position])
+            else:
+                time_on_road = self._get_time_on_the_road(distance, unit.speed)
             if time_on_road > t_limit:
                 continue
-            t_of_arrival = self._estimate_arrival(time_on_road)
+            t_of_arrival = self._estimate_arrival(time_on_road, now)
             estimated_capacity = attack_target.estimate_capacity(t_of_arrival)
             units_needed = self._estimate_troops_needed(unit, estimated_capacity)
             if units_needed <= count:
@@ -285,8 +805,8 @@ class DecisionMaker:
         return round(estimated_capacity/unit.haul)
 
     @staticmethod
-    def _estimate_arrival(t_on_road):
-        time_gmt = time.mktime(time.gmtime())
+    def _estimate_arrival(t_on_road, now=None):
+        time_gmt = now if now is not None else time.mktime(time.gmtime())
         estimated_arrival = round(time_gmt + t_on_road)
         return estimated_arrival
 
@@ -296,6 +816,63 @@ class DecisionMaker:
         return distance*speed*60
 
 
+class AttackPlanner:
+    """
+    Assigns targets to all attackers at once (instead of letting each
+    attacker take its nearest target in turn):
+    all feasible (attacker, target) decisions are considered in order of
+    expected haul per second on the road, each target is given to the
+    first attacker that still has troops for it. So targets shared by
+    few attackers go to the one that reaches them faster & far targets
+    are served by attackers whose near targets were taken.
+
+    plan(candidates, troops):
+        takes mapping {attacker_id: [[troops_to_send, t_on_road,
+        target_coords], ...]} of feasible decisions (see
+        DecisionMaker.rank_attack_targets) & {attacker_id: troops_count}.
+        Returns list of attacks [(attacker_id, decision), ...] in order
+        they should be sent.
+    """
+
+    def __init__(self, unit_stats=None):
+        self.units = Unit.build_units(unit_stats=unit_stats)
+
+    def plan(self, candidates, troops):
+        hauls = {name: unit.haul for name, unit in self.units.items()}
+        scores = []
+        for attacker_id, decisions in candidates.items():
+            for index, (troops_to_send, t_on_road, _) in enumerate(decisions):
+                # expected haul per second on the road
+                haul = sum(hauls[name] * count for name, count in troops_to_send.items())
+                scores.append((haul / max(t_on_road, 1), attacker_id, index))
+        # stable: equal scores keep order of attackers & distance order
+        scores.sort(key=itemgetter(0), reverse=True)
+
+        troops_left = {attacker_id: dict(troops_count) for attacker_id, troops_count
+                       in troops.items()}
+        assigned_targets = set()
+        schedule = []
+        for _, attacker_id, index in scores:
+            decision = candidates[attacker_id][index]
+            troops_to_send, target_coords = decision[0], decision[2]
+            if target_coords in assigned_targets:
+                continue
+            attacker_troops = troops_left[attacker_id]
+            if not all(attacker_troops.get(name, 0) >= count
+                       for name, count in troops_to_send.items() if name != 'spy'):
+                continue
+            if troops_to_send.get('spy', 0) > attacker_troops.get('spy', 0):
+                # scout is optional, attack is sent w/o it
+                troops_to_send = {name: count for name, count in troops_to_send.items()
+                                  if name != 'spy'}
+                decision = [troops_to_send] + decision[1:]
+            for name, count in troops_to_send.items():
+                attacker_troops[name] -= count
+            assigned_targets.add(target_coords)
+            schedule.append((attacker_id, decision))
+        return schedule
+
+
 class AttackObserver:
     """
     Helper class that is responsible for keeping track of
@@ -320,6 +897,9 @@ class AttackObserver:
         places t_of_return in self.return_queue (appends t_of_return
         to list of registered returns for a given attacker_id).
         places (coords): t_of_arrival in self.arrival_queue.
+        Writes attack to self.journal (if any).
+    restore_attack(attacker_id, coords, t_of_arrival, t_of_return):
+        registers attack replayed from journal
     save_registered_attacks:
         asks self.storage to save self.arrival_queue & .return_queue
     """
@@ -327,8 +907,37 @@ class AttackObserver:
     def __init__(self, storage_type, storage_name):
         self.storage = Storage(storage_type=storage_type,
                                storage_name=storage_name)
-        self.arrival_queue = {}
-        self.return_queue = {}
+        # {(x, y): t_of_arrival} & {attacker_id: [t_of_return, ...]}
+        # are backed by heaps of (t, coords) & (t, attacker_id), so
+        # due attacks are popped w/o scanning all attacks in progress.
+        # Heaps may contain stale entries (e.g. coords were attacked
+        # again), these are skipped when popped.
+        self._arrival_index = {}
+        self._arrival_heap = []
+        self._returns = {}
+        self._return_heap = []
+        self.journal = None
+
+    @property
+    def arrival_queue(self):
+        return self._arrival_index
+
+    @arrival_queue.setter
+    def arrival_queue(self, arrivals):
+        self._arrival_index = arrivals
+        self._arrival_heap = [(t, coords) for coords, t in arrivals.items()]
+        heapq.heapify(self._arrival_heap)
+
+    @property
+    def return_queue(self):
+        return self._returns
+
+    @return_queue.setter
+    def return_queue(self, returns):
+        self._returns = returns
+        self._return_heap = [(t, attacker_id) for attacker_id, returns_t in
+                             returns.items() for t in returns_t]
+        heapq.heapify(self._return_heap)
 
     def restore_saved_attacks(self):
         self.arrival_queue = self.storage.get_saved_arrivals()
@@ -342,12 +951,14 @@ class AttackObserver:
                       "from storage: {}".format(registered_returns))
 
         now = time.mktime(time.gmtime())
+        return_queue = {}
         for attacker_id, returns_t in registered_returns.items():
             #
             pending_returns = [t for t in returns_t if t > now]
-            self.return_queue[attacker_id] = pending_returns
+            return_queue[attacker_id] = pending_returns
 
             logging.debug("Pending returns: ".format(registered_returns))
+        self.return_queue = return_queue
 
     def get_targets_pending_arrival(self):
         time_gmt = time.mktime(time.gmtime())
@@ -357,31 +968,65 @@ class AttackObserver:
 
     def is_someone_arrived(self):
         time_gmt = time.mktime(time.gmtime())
-        arrived = {coords: t for  coords, t in self.arrival_queue.items() if
-                   t <= time_gmt}
-        if arrived:
-            for coords in arrived.keys():
-                self.arrival_queue.pop(coords)
-        return len(arrived)
+        arrival_heap = self._arrival_heap
+        arrived = 0
+        while arrival_heap and arrival_heap[0][0] <= time_gmt:
+            t, coords = heapq.heappop(arrival_heap)
+            if self._arrival_index.get(coords) == t:
+                del self._arrival_index[coords]
+                arrived += 1
+        return arrived
 
     def is_someone_returned(self):
         time_gmt = time.mktime(time.gmtime())
+        return_heap = self._return_heap
+        returned = set()
+        while return_heap and return_heap[0][0] <= time_gmt:
+            _, attacker_id = heapq.heappop(return_heap)
+            returned.add(attacker_id)
+        if not returned:
+            return []
+
         return_ids = []
-        for attacker_id, returns in self.return_queue.items():
-            returned = [t for t in returns if t <= time_gmt]
-            if returned:
-                return_ids.append(attacker_id)
-                for t in returned:
-                    self.return_queue[attacker_id].remove(t)
+        # keeps order of attackers (their number is small, unlike
+        # number of attacks)
+        for attacker_id, returns in self._returns.items():
+            if attacker_id in returned:
+                pending = [t for t in returns if t > time_gmt]
+                if len(pending) < len(returns):
+                    return_ids.append(attacker_id)
+                    self._returns[attacker_id] = pending
 
         return return_ids
 
     def register_attack(self, attacker_id, coords, t_of_arrival, t_of_return):
-        self.arrival_queue[coords] = t_of_arrival
-        if attacker_id in self.return_queue:
-            self.return_queue[attacker_id].append(t_of_return)
+        self._add_attack(attacker_id, coords, t_of_arrival, t_of_return)
+        if self.journal is not None:
+            self.journal.append((AttackJournal.ATTACK, attacker_id, coords,
+                                 t_of_arrival, t_of_return))
+
+    def restore_attack(self, attacker_id, coords, t_of_arrival, t_of_return):
+        """
+        Registers attack replayed from journal, unless it was restored
+        from storage already. Returns, that are in past, are ignored.
+        """
+        if coords not in self._arrival_index or \
+                self._arrival_index[coords] < t_of_arrival:
+            self._arrival_index[coords] = t_of_arrival
+            heapq.heappush(self._arrival_heap, (t_of_arrival, coords))
+        returns = self._returns.setdefault(attacker_id, [])
+        if t_of_return > time.mktime(time.gmtime()) and t_of_return not in returns:
+            returns.append(t_of_return)
+            heapq.heappush(self._return_heap, (t_of_return, attacker_id))
+
+    def _add_attack(self, attacker_id, coords, t_of_arrival, t_of_return):
+        self._arrival_index[coords] = t_of_arrival
+        heapq.heappush(self._arrival_heap, (t_of_arrival, coords))
+        if attacker_id in self._returns:
+            self._returns[attacker_id].append(t_of_return)
         else:
-            self.return_queue[attacker_id] = [t_of_return]
+            self._returns[attacker_id] = [t_of_return]
+        heapq.heappush(self._return_heap, (t_of_return, attacker_id))
 
     def save_registered_attacks(self):
         self.storage.save_attacks(arrivals=self.arrival_queue,
@@ -420,8 +1065,7 @@ class AttackHelper:
         """
         # There are 2 hidden fields in rally point html.
         # The target one is a string of random alphanumeric characters
-        ptrn = re.compile(r'type=\Whidden\W name=\W([\w\d]+)\W value=\W([\w\d]+)\W')
-        match = re.search(ptrn, rally_point_html)
+        match = PATTERNS.get('confirmation_token').search(rally_point_html)
         self.confirmation_token = match.group(1), match.group(2)
 
     def get_confirmation_data(self, coords, troops):
@@ -483,7 +1127,7 @@ class AttackHelper:
         """
         Extracts csrf token from hidden field of confirmation screen HTML
         """
-        csrf_match = re.search(r'csrf\W:\W([\w\d]+)\W', html_data)
+        csrf_match = PATTERNS.get('csrf_token').search(html_data)
         csrf = csrf_match.group(1)
         return csrf
 
@@ -493,8 +1137,7 @@ class AttackHelper:
         Extracts unique value (ch token) from hidden field of
         confirmation screen HTML. Returns tuple ('ch', 'ch_value')
         """
-        ch_match = re.search(r'type=\Whidden\W name=\Wch\W value=\W([\w\d]+)\W',
-                             html_data)
+        ch_match = PATTERNS.get('ch_token').search(html_data)
         ch_token = ('ch', ch_match.group(1))
         return ch_token
 
@@ -504,8 +1147,7 @@ class AttackHelper:
         Extracts unique value (action_id token) from hidden field of
         confirmation screen HTML. Returns tuple ('action_id', 'value')
         """
-        actionid_match = re.search(r'type=\Whidden\W name=\Waction_id\W value=\W(\d+)\W',
-                                   html_data)
+        actionid_match = PATTERNS.get('action_id').search(html_data)
         action_id = ('action_id', actionid_match.group(1))
         return action_id
 
@@ -535,6 +1177,8 @@ class Unit:
     Represents TW unit.
     """
 
+    __slots__ = ('name', 'attack', 'speed', 'haul')
+
     def __init__(self, name, attack, speed, haul):
         self.name = name
         self.attack = attack
@@ -542,28 +1186,31 @@ class Unit:
         self.haul = haul
 
     @classmethod
-    def build_units(cls):
-        """
-        Pre-defines Unit objects for each TribalWars unit.
-        """
-        units = {'spear': Unit('spear', 10, 18, 25),
-                 'sword': Unit('sword', 25, 22, 15),
-                 'archer': Unit('archer', 15, 18, 10),
-                 'axe': Unit('axe', 40, 18, 10),
-                 'spy': Unit('spy', 0, 9, 0),
-                 'light': Unit('light', 130, 10, 80),
-                 'marcher': Unit('marcher', 120, 10, 50),
-                 'heavy': Unit('heavy', 150, 11, 50)}
+    def build_units(cls, speed_factor=1, unit_stats=None):
+        """
+        Pre-defines Unit objects for each TribalWars unit that may farm
+        (see UNIT_STATS). Given stats ({unit_name: (attack, speed, haul)},
+        e.g. of current world, see WorldConfig.get_unit_stats) replace
+        default ones. Speeds (minutes per tile) are divided by
+        speed_factor (world speed * unit speed).
+        """
+        units = {}
+        for name, stats in UNIT_STATS.items():
+            if unit_stats and name in unit_stats:
+                stats = unit_stats[name]
+            attack, speed, haul = stats
+            if speed_factor != 1:
+                speed /= speed_factor
+            units[name] = cls(name, attack, speed, haul)
         return units
 
     @staticmethod
     def get_def_names():
-        return ['spear', 'sword', 'archer', 'axe', 'spy',
-                'light', 'marcher', 'heavy']
+        return list(DEF_UNIT_NAMES)
 
     @staticmethod
     def get_off_names():
-        return ['axe', 'spy', 'light', 'marcher', 'heavy']
+        return list(OFF_UNIT_NAMES)
 
     def __str__(self):
         return "Unit:=>{0}, speed:=>{1}, haul:=>{2}".format(self.name,
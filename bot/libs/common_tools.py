@@ -1,16 +1,21 @@
+import dbm
 import shelve
 import shutil
 import sqlite3
+import pickle
+import copy
 import sys
 import os
-import re
 import time
 import base64
+import logging
 from urllib.request import urlopen, Request
 from urllib.parse import urlencode
 
 import requests
 
+from bot.libs.patterns import PATTERNS
+
 
 class Storage:
     """
@@ -20,6 +25,10 @@ class Storage:
     def __init__(self, storage_type, storage_name):
         if storage_type == 'local_file':
             self.storage_processor = LocalStorage(storage_name)
+        elif storage_type == 'sqlite':
+            # shelve file of the same name is migrated on the first run
+            self.storage_processor = SQLiteStorage(storage_name + SQLiteStorage.EXTENSION,
+                                                   shelve_name=storage_name)
         else:
             raise NotImplementedError("Specified storage type for map data"
                                       "is not implemented yet!")
@@ -32,6 +41,11 @@ class Storage:
                 return getattr(self.storage_processor, name)(*args, **kwargs)
         return wrapper
 
+    def close(self):
+        close = getattr(self.storage_processor, 'close', None)
+        if close is not None:
+            close()
+
 
 class LocalStorage:
     """
@@ -50,6 +64,10 @@ class LocalStorage:
         returns arrivals that were saved in a local shelve file
     get_saved_returns:
         returns 'returns', ye.
+    get_last_report_id:
+        returns id of the newest report that was handled (or None)
+    save_last_report_id(report_id):
+        saves id of the newest handled report
     """
 
     def __init__(self, storage_name):
@@ -89,6 +107,273 @@ class LocalStorage:
         storage.close()
         return returns
 
+    def get_last_report_id(self):
+        storage = shelve.open(self.storage_name)
+        report_id = storage.get('last_report_id')
+        storage.close()
+        return report_id
+
+    def save_last_report_id(self, report_id):
+        storage = shelve.open(self.storage_name)
+        storage['last_report_id'] = report_id
+        storage.close()
+
+
+class SQLiteStorage:
+    """
+    Keeps the same data as LocalStorage in a sqlite file, one row per
+    village/attack, so villages could be updated (upserted) one by one
+    instead of re-writing all of them.
+
+    Tables:
+        villages(x, y, data) - pickled TargetVillage (w/o visits history)
+        visits(x, y, t_of_attack, looted) - villages' visits history
+        arrivals(x, y, t_of_arrival)
+        returns(attacker_id, t_of_return)
+        settings(name, value) - e.g. last_report_id
+
+    Provides the same methods as LocalStorage plus:
+
+    migrate_from_shelve(shelve_name):
+        copies villages, arrivals & returns from a LocalStorage file
+        (called automatically, if sqlite file does not exist yet &
+        shelve_name is given)
+    close:
+        closes connection to database
+    """
+
+    # shelve may add '.db' to its file name, so sqlite file has its own
+    EXTENSION = '.sqlite'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS villages (
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (x, y));
+        CREATE TABLE IF NOT EXISTS visits (
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            t_of_attack REAL NOT NULL,
+            looted INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS visits_coords ON visits (x, y);
+        CREATE TABLE IF NOT EXISTS arrivals (
+            x INTEGER NOT NULL,
+            y INTEGER NOT NULL,
+            t_of_arrival REAL NOT NULL,
+            PRIMARY KEY (x, y));
+        CREATE TABLE IF NOT EXISTS returns (
+            attacker_id INTEGER NOT NULL,
+            t_of_return REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS returns_attacker ON returns (attacker_id);
+        CREATE TABLE IF NOT EXISTS settings (
+            name TEXT PRIMARY KEY,
+            value);
+    """
+
+    def __init__(self, storage_name, shelve_name=None):
+        self.storage_name = storage_name
+        self.shelve_name = shelve_name
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            is_new = not os.path.exists(self.storage_name)
+            # Bot is created in one thread & runs in another one
+            connection = sqlite3.connect(self.storage_name,
+                                         check_same_thread=False)
+            connection.executescript(self.SCHEMA)
+            self._connection = connection
+            if is_new and self.shelve_name and dbm.whichdb(self.shelve_name):
+                logging.info("Migrating data from {shelve} to {name}".format(
+                    shelve=self.shelve_name, name=self.storage_name))
+                self.migrate_from_shelve(self.shelve_name)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def get_saved_villages(self):
+        villages = {}
+        for x, y, data in self.connection.execute("SELECT x, y, data "
+                                                  "FROM villages"):
+            village = pickle.loads(data)
+            village.visits_history = []
+            villages[(x, y)] = village
+        visits = self.connection.execute("SELECT x, y, t_of_attack, looted "
+                                         "FROM visits ORDER BY t_of_attack DESC")
+        for x, y, t_of_attack, looted in visits:
+            if (x, y) in villages:
+                villages[(x, y)].visits_history.append((t_of_attack, looted))
+        return villages
+
+    def update_villages(self, villages):
+        """
+        Upserts given villages. Only visits that are newer than the
+        saved ones are inserted; visits that were dropped from (limited)
+        visits history are deleted.
+        """
+        connection = self.connection
+        # {(x, y): t_of_attack} of the latest saved visit of each village
+        last_visits = {(x, y): t_of_attack for x, y, t_of_attack in
+                       connection.execute("SELECT x, y, MAX(t_of_attack) "
+                                          "FROM visits GROUP BY x, y")}
+        village_rows, visit_rows, outdated_rows = [], [], []
+        for (x, y), village in villages.items():
+            visits_history = getattr(village, 'visits_history', [])
+            if visits_history:
+                village = copy.copy(village)
+                village.visits_history = []
+                t_of_last_visit = last_visits.get((x, y))
+                visit_rows.extend((x, y, t_of_attack, looted) for
+                                  t_of_attack, looted in visits_history
+                                  if t_of_last_visit is None or
+                                  t_of_attack > t_of_last_visit)
+                outdated_rows.append((x, y, min(t_of_attack for t_of_attack, _
+                                                in visits_history)))
+            village_rows.append((x, y, pickle.dumps(village)))
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO villages "
+                                   "(x, y, data) VALUES (?, ?, ?)",
+                                   village_rows)
+            connection.executemany("INSERT INTO visits (x, y, t_of_attack, "
+                                   "looted) VALUES (?, ?, ?, ?)", visit_rows)
+            connection.executemany("DELETE FROM visits WHERE x=? AND y=? "
+                                   "AND t_of_attack < ?", outdated_rows)
+
+    def save_attacks(self, arrivals=None, returns=None):
+        with self.connection:
+            if arrivals:
+                self.connection.execute("DELETE FROM arrivals")
+                self.connection.executemany("INSERT INTO arrivals (x, y, "
+                                            "t_of_arrival) VALUES (?, ?, ?)",
+                                            [(x, y, t) for (x, y), t in
+                                             arrivals.items()])
+            if returns:
+                self.connection.execute("DELETE FROM returns")
+                self.connection.executemany("INSERT INTO returns (attacker_id, "
+                                            "t_of_return) VALUES (?, ?)",
+                                            [(attacker_id, t) for attacker_id,
+                                             returns_t in returns.items()
+                                             for t in returns_t])
+
+    def get_saved_arrivals(self):
+        rows = self.connection.execute("SELECT x, y, t_of_arrival FROM arrivals")
+        return {(x, y): t for x, y, t in rows}
+
+    def get_saved_returns(self):
+        returns = {}
+        rows = self.connection.execute("SELECT attacker_id, t_of_return "
+                                       "FROM returns ORDER BY rowid")
+        for attacker_id, t in rows:
+            returns.setdefault(attacker_id, []).append(t)
+        return returns
+
+    def get_last_report_id(self):
+        row = self.connection.execute("SELECT value FROM settings "
+                                      "WHERE name='last_report_id'").fetchone()
+        if row is not None:
+            return row[0]
+
+    def save_last_report_id(self, report_id):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO settings (name, value) "
+                                    "VALUES ('last_report_id', ?)", (report_id,))
+
+    def migrate_from_shelve(self, shelve_name):
+        local_storage = LocalStorage(shelve_name)
+        self.update_villages(local_storage.get_saved_villages())
+        self.save_attacks(arrivals=local_storage.get_saved_arrivals(),
+                          returns=local_storage.get_saved_returns())
+        last_report_id = local_storage.get_last_report_id()
+        if last_report_id is not None:
+            self.save_last_report_id(last_report_id)
+
+
+class AttackJournal:
+    """
+    Append-only file of pickled records, that keeps changes made
+    between two saves of storage (snapshots), so they survive crash
+    of the bot.
+
+    Records are flushed after each append, but fsync()-ed in batches:
+    after 'sync_every' records or 'sync_interval' seconds since the
+    last sync (whatever comes first).
+
+    Methods:
+
+    append(record):
+        appends a record to the end of journal
+    sync:
+        forces flush & fsync of appended records
+    replay:
+        returns list of records in the order they were appended
+        (a record torn by crash at the end of journal is skipped)
+    clear:
+        truncates journal (should be called after the snapshot)
+    close:
+        syncs & closes journal file
+    """
+
+    # kinds of records
+    ATTACK = 'attack'
+    VILLAGE = 'village'
+    UNTRUSTED = 'untrusted'
+
+    def __init__(self, journal_name, sync_every=20, sync_interval=5):
+        self.journal_name = journal_name
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.pending = 0
+        self.last_sync = time.monotonic()
+        self._file = None
+
+    def append(self, record):
+        if self._file is None:
+            self._file = open(self.journal_name, 'ab')
+        pickle.dump(record, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.flush()
+        self.pending += 1
+        if self.pending >= self.sync_every or \
+                time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._file is not None and self.pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self.pending = 0
+        self.last_sync = time.monotonic()
+
+    def replay(self):
+        records = []
+        if not os.path.isfile(self.journal_name):
+            return records
+        with open(self.journal_name, 'rb') as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except Exception:
+                    logging.warning("Journal {name} ends with a broken record, "
+                                    "skipping it.".format(name=self.journal_name))
+                    break
+        return records
+
+    def clear(self):
+        self.close()
+        open(self.journal_name, 'wb').close()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
 
 class CookiesExtractor:
     """
@@ -215,8 +500,7 @@ class AutoLogin:
         Parses response received after 'show_server_selection' request.
         Returns encrypted user password.
         """
-        pswd_ptrn = re.compile(r'password[\W\w]+?value\W\W"([\W\w]+?)\W"')
-        match = re.search(pswd_ptrn, selection_data)
+        match = PATTERNS.get('enc_password').search(selection_data)
         return match.group(1)
 
     def _post_login_data(self, post_data, server):
@@ -0,0 +1,122 @@
+import time
+import heapq
+import logging
+import itertools
+from threading import Condition
+
+
+__all__ = ['EventScheduler']
+
+
+class EventScheduler:
+    """
+    Keeps a priority queue (heap) of future events & dispatches each
+    due event to the handler registered for its kind.
+
+    Each event is a tuple (t_due, sequence_number, kind, payload):
+    events due at the same time are dispatched in order of scheduling.
+    Time is measured in the same way as in the rest of bot
+    (time.mktime(time.gmtime())).
+
+    Provides the next interface methods:
+
+    set_handler(kind, handler):
+        registers handler(payload) for a given kind of events
+    schedule(t_due, kind, payload):
+        places new event in a queue & wakes up waiting thread, so it
+        could re-calculate time of sleep
+    get_next_event_t:
+        returns time of the nearest event (or None)
+    pop_due_events:
+        removes all events that are due from queue & returns list of
+        tuples (kind, payload)
+    run_pending:
+        dispatches all due events to their handlers, returns number
+        of dispatched events
+    wait(until):
+        sleeps until the nearest event is due (but not longer than
+        'until' time), or until .wake() was called
+    wake:
+        interrupts .wait()
+    """
+
+    ARRIVAL = 'arrival'
+    RETURN = 'return'
+    REST_EXPIRY = 'rest_expiry'
+    SESSION_REFRESH = 'session_refresh'
+    MAP_REFRESH = 'map_refresh'
+
+    def __init__(self, clock=None):
+        if clock is None:
+            clock = self._get_time_gmt
+        self.clock = clock
+        self.events = []
+        self.handlers = {}
+        self._counter = itertools.count()
+        self._condition = Condition()
+        self._woken = False
+
+    def __len__(self):
+        return len(self.events)
+
+    def set_handler(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def schedule(self, t_due, kind, payload=None):
+        with self._condition:
+            heapq.heappush(self.events, (t_due, next(self._counter),
+                                         kind, payload))
+            self._condition.notify_all()
+
+    def get_next_event_t(self):
+        with self._condition:
+            if self.events:
+                return self.events[0][0]
+
+    def pop_due_events(self):
+        now = self.clock()
+        due_events = []
+        with self._condition:
+            while self.events and self.events[0][0] <= now:
+                _, _, kind, payload = heapq.heappop(self.events)
+                due_events.append((kind, payload))
+        return due_events
+
+    def run_pending(self):
+        due_events = self.pop_due_events()
+        for kind, payload in due_events:
+            handler = self.handlers.get(kind)
+            if handler is None:
+                logging.warning("There is no handler for event "
+                                "'{kind}', skipping.".format(kind=kind))
+                continue
+            handler(payload)
+        return len(due_events)
+
+    def wait(self, until=None):
+        """
+        Blocks until the nearest event is due. If there are no events,
+        waits for a new one (or .wake() call).
+        Returns True if there are due events.
+        """
+        with self._condition:
+            while not self._woken:
+                now = self.clock()
+                t_wake = self.events[0][0] if self.events else None
+                if until is not None and (t_wake is None or until < t_wake):
+                    t_wake = until
+                if t_wake is not None and t_wake <= now:
+                    break
+                timeout = None if t_wake is None else t_wake - now
+                self._condition.wait(timeout)
+            self._woken = False
+            return bool(self.events) and self.events[0][0] <= self.clock()
+
+    def wake(self):
+        with self._condition:
+            self._woken = True
+            self._condition.notify_all()
+
+    @staticmethod
+    def _get_time_gmt():
+        return time.mktime(time.gmtime())
@@ -1,6 +1,19 @@
-import re
+import os
+import time
+import gzip
 import json
+import shelve
+import logging
+from urllib.parse import unquote_plus
 from math import sqrt
+from collections import deque
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from bot.libs.patterns import PATTERNS
 
 
 class MapParser:
@@ -18,10 +31,16 @@ class MapParser:
 
     collect_sector_data(overview_html):
         returns structured sectors_data
+    collect_sectors(overview_html):
+        returns the same sectors, keyed by their origin:
+        {(sector_x, sector_y): sector_data, ...}
     """
 
     def collect_sector_data(self, map_overview_html):
-        structured_sectors = []
+        return list(self.collect_sectors(map_overview_html).values())
+
+    def collect_sectors(self, map_overview_html):
+        structured_sectors = {}
         raw_sectors_data = self.get_map_data(map_overview_html)
         for sector_data in raw_sectors_data:
             sector = {}
@@ -49,7 +68,7 @@ class MapParser:
                     villa_y = sector_y + int(y)
                     villa_coords = (villa_x, villa_y)
                     sector[villa_coords] = village_data
-            structured_sectors.append(sector)
+            structured_sectors[(sector_x, sector_y)] = sector
 
         return structured_sectors
 
@@ -59,13 +78,305 @@ class MapParser:
         Looks for string containg sector data (JSON)
         Returns unstructured dict containing sector data
         """
-        ptrn = re.compile('TWMap.sectorPrefech = ([\W\w]+?\]);')
-        match = re.search(ptrn, html_data)
+        match = PATTERNS.get('map_sectors').search(html_data)
         js_res = match.group(1)
         res = json.loads(js_res)
         return res
 
 
+class VillageDumpReader:
+    """
+    Reads world dump of villages (village.txt, as published by game:
+    a line 'id,name,x,y,player_id,points,rank' per village, name is
+    url-encoded). File may be gzip-compressed.
+    The file is streamed line by line, so only kept villages reside
+    in memory.
+
+    Methods:
+
+    iter_villages:
+        yields rows [id, name, x, y, player_id, points, rank]
+    get_map_data(centers, radius, include):
+        returns villages without owner (& villages with given coords)
+        in the same shape as MapParser does:
+        {(x, y): [id, 0, name (0 for barbarians), points, player_id, rank]}
+    get_t_of_dump:
+        returns time when dump was made (modification time of file),
+        comparable with time.mktime(time.gmtime())
+    """
+
+    GZIP_MAGIC = b'\x1f\x8b'
+
+    def __init__(self, path):
+        self.path = path
+
+    def iter_villages(self):
+        with open(self.path, 'rb') as f:
+            compressed = f.read(2) == self.GZIP_MAGIC
+        opener = gzip.open if compressed else open
+        with opener(self.path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                row = line.rstrip('\r\n').split(',')
+                if len(row) == 7:
+                    yield row
+
+    def get_map_data(self, centers=(), radius=None, include=()):
+        """
+        Keeps only villages in a given radius around any of centers
+        ((x, y) coordinates), if radius is given.
+        """
+        map_data = {}
+        squared_radius = radius ** 2 if radius is not None else None
+        for village_id, name, x, y, player_id, points, rank in self.iter_villages():
+            coords = (int(x), int(y))
+            if player_id != '0' and coords not in include:
+                continue
+            if squared_radius is not None and not \
+                    any((coords[0] - center[0]) ** 2 + (coords[1] - center[1]) ** 2
+                        <= squared_radius for center in centers):
+                continue
+            name = 0 if player_id == '0' else unquote_plus(name)
+            map_data[coords] = [village_id, 0, name, points, player_id, rank]
+        return map_data
+
+    def get_t_of_dump(self):
+        return time.mktime(time.gmtime(os.path.getmtime(self.path)))
+
+
+class MapCrawler:
+    """
+    Collects map data around farming centers in a breadth-first order:
+    each map overview contains a few sectors around the requested point,
+    so overviews are requested only for sectors that were not covered
+    yet and that intersect with a circle of given radius around any of
+    farming centers.
+
+    Takes a MapParser & function fetch_overview(village_id, x, y),
+    which returns HTML of map overview.
+
+    Methods:
+
+    crawl(centers, radius):
+        returns merged data of collected sectors: {(x, y): village_data}
+        & keeps statistics in .requests, .sectors & .villages
+    get_sector_origins(center_coords, radius):
+        returns set of origins of sectors that intersect with a circle
+        of given radius around any of given coordinates
+    split_to_sectors(area, origins):
+        groups villages of area {(x, y): village_data} by sectors (in
+        the shape of MapParser.collect_sectors); given origins are
+        included even if there are no villages in them
+    """
+
+    SECTOR_SIZE = 20
+
+    def __init__(self, map_parser, fetch_overview, on_sectors=None):
+        self.map_parser = map_parser
+        self.fetch_overview = fetch_overview
+        # called with each portion of collected sectors
+        self.on_sectors = on_sectors
+        self.requests = 0
+        self.sectors = 0
+        self.villages = 0
+
+    def crawl(self, centers, radius):
+        area = {}
+        covered = set()
+        queued = set()
+        center_coords = [center.coords for center in centers]
+        to_visit = deque()
+        for center in centers:
+            origin = self._get_origin(center.coords)
+            if origin not in queued:
+                queued.add(origin)
+                to_visit.append((center.id, origin, center.coords))
+
+        while to_visit:
+            village_id, origin, (x, y) = to_visit.popleft()
+            if origin in covered:
+                continue
+            sectors = self.map_parser.collect_sectors(self.fetch_overview(village_id,
+                                                                          x, y))
+            self.requests += 1
+            new_sectors = {sector_origin: sector for sector_origin, sector in
+                           sectors.items() if sector_origin not in covered}
+            covered.update(new_sectors)
+            # requested sector might be absent (e.g. beyond the edge of map):
+            # it is saved as empty, so cache covers it
+            covered.add(origin)
+            if origin not in sectors:
+                sectors[origin] = {}
+            for sector_origin, sector in new_sectors.items():
+                area.update(sector)
+                self.sectors += 1
+                for neighbor in self._get_neighbors(sector_origin):
+                    if neighbor in queued or neighbor in covered:
+                        continue
+                    if self._is_in_radius(neighbor, center_coords, radius):
+                        queued.add(neighbor)
+                        # overview certainly contains the sector of its
+                        # center point (& maybe some sectors around)
+                        half = self.SECTOR_SIZE // 2
+                        point = (neighbor[0] + half, neighbor[1] + half)
+                        to_visit.append((village_id, neighbor, point))
+            if self.on_sectors is not None:
+                self.on_sectors(sectors)
+
+        self.villages = len(area)
+        logging.info("Map crawl: {r} overviews requested, {s} sectors & {v} villages "
+                     "collected".format(r=self.requests, s=self.sectors,
+                                        v=self.villages))
+        return area
+
+    @classmethod
+    def get_sector_origins(cls, center_coords, radius):
+        size = cls.SECTOR_SIZE
+        origins = set()
+        for x, y in center_coords:
+            min_x, min_y = cls._get_origin((x - radius, y - radius))
+            max_x, max_y = cls._get_origin((x + radius, y + radius))
+            for origin_x in range(min_x, max_x + 1, size):
+                for origin_y in range(min_y, max_y + 1, size):
+                    if cls._is_in_radius((origin_x, origin_y), [(x, y)], radius):
+                        origins.add((origin_x, origin_y))
+        return origins
+
+    @classmethod
+    def split_to_sectors(cls, area, origins=()):
+        sectors = {origin: {} for origin in origins}
+        for coords, village_data in area.items():
+            sectors.setdefault(cls._get_origin(coords), {})[coords] = village_data
+        return sectors
+
+    @classmethod
+    def _get_origin(cls, coords):
+        size = cls.SECTOR_SIZE
+        return coords[0] // size * size, coords[1] // size * size
+
+    def _get_neighbors(self, origin):
+        size = self.SECTOR_SIZE
+        x, y = origin
+        return [(x + dx, y + dy) for dx in (-size, 0, size) for dy in (-size, 0, size)
+                if dx or dy]
+
+    @classmethod
+    def _is_in_radius(cls, origin, centers, radius):
+        """
+        Checks if sector intersects with a circle around any of centers
+        """
+        size = cls.SECTOR_SIZE
+        for x, y in centers:
+            nearest_x = min(max(x, origin[0]), origin[0] + size - 1)
+            nearest_y = min(max(y, origin[1]), origin[1] + size - 1)
+            if (nearest_x - x) ** 2 + (nearest_y - y) ** 2 <= radius ** 2:
+                return True
+        return False
+
+
+class MapSectorCache:
+    """
+    Keeps map sectors (as returned by MapParser.collect_sectors) in a
+    local shelve file, so map data doesn't need to be downloaded on
+    each start. Sectors are considered stale 'ttl' hours after they
+    were fetched.
+
+    Methods:
+
+    update_sectors(sectors):
+        saves given sectors & returns the difference with previously
+        saved ones: tuple({(x, y): village_data} of new & changed
+        villages, [(x, y), ...] of villages which are not on map anymore)
+    get_area_data:
+        returns merged data of all saved sectors {(x, y): village_data}
+    get_origins:
+        returns set of origins of all saved sectors
+    get_stale_origins:
+        returns origins of sectors that should be re-fetched
+    get_next_expiry:
+        returns time when the next sector becomes stale (or None)
+    has_sectors(origins):
+        checks if all of given sectors are saved
+    touch_sectors(origins):
+        marks given saved sectors as fetched now (w/o changing them)
+    """
+
+    def __init__(self, cache_name, ttl=24):
+        self.cache_name = cache_name
+        self.ttl = ttl
+
+    def update_sectors(self, sectors, t_of_fetch=None):
+        if t_of_fetch is None:
+            t_of_fetch = time.mktime(time.gmtime())
+        changed, removed = {}, []
+        cache = shelve.open(self.cache_name)
+        for origin, sector in sectors.items():
+            key = self._get_key(origin)
+            _, cached_sector = cache.get(key, (None, {}))
+            for coords, village_data in sector.items():
+                if cached_sector.get(coords) != village_data:
+                    changed[coords] = village_data
+            removed.extend(coords for coords in cached_sector if coords not in sector)
+            cache[key] = (t_of_fetch, sector)
+        cache.close()
+        return changed, removed
+
+    def get_area_data(self):
+        area = {}
+        cache = shelve.open(self.cache_name)
+        for _, sector in cache.values():
+            area.update(sector)
+        cache.close()
+        return area
+
+    def get_origins(self):
+        cache = shelve.open(self.cache_name)
+        origins = {self._get_origin(key) for key in cache.keys()}
+        cache.close()
+        return origins
+
+    def get_stale_origins(self):
+        expired = time.mktime(time.gmtime()) - self.ttl * 3600
+        cache = shelve.open(self.cache_name)
+        stale = [self._get_origin(key) for key, (t_of_fetch, _) in cache.items()
+                 if t_of_fetch <= expired]
+        cache.close()
+        return stale
+
+    def get_next_expiry(self):
+        cache = shelve.open(self.cache_name)
+        fetch_times = [t_of_fetch for t_of_fetch, _ in cache.values()]
+        cache.close()
+        if fetch_times:
+            return min(fetch_times) + self.ttl * 3600
+
+    def has_sectors(self, origins):
+        cache = shelve.open(self.cache_name)
+        has_sectors = all(self._get_key(origin) in cache for origin in origins)
+        cache.close()
+        return has_sectors
+
+    def touch_sectors(self, origins, t_of_fetch=None):
+        if t_of_fetch is None:
+            t_of_fetch = time.mktime(time.gmtime())
+        cache = shelve.open(self.cache_name)
+        for origin in origins:
+            key = self._get_key(origin)
+            if key in cache:
+                _, sector = cache[key]
+                cache[key] = (t_of_fetch, sector)
+        cache.close()
+
+    @staticmethod
+    def _get_key(origin):
+        # shelve keys should be strings
+        return '{x}|{y}'.format(x=origin[0], y=origin[1])
+
+    @staticmethod
+    def _get_origin(key):
+        x, y = key.split('|')
+        return int(x), int(y)
+
+
 class MapMath:
     """
     Provides helper methods for operations with villages on map.
@@ -81,11 +392,15 @@ class MapMath:
         4 most outer coordinates in this sequence.
         return list of tuples(x,y)
 
-    get_targets_in_radius:
+    get_targets_by_distance:
         tries to determine which target villages lie in a given
         radius from source (attacking) village.
         returns list of tuples:
         [((target_x_coordinate, target_y_coordinate), distance_to_target), ...]
+
+    get_distance_matrix (requires NumPy):
+        takes sequences of source & target coordinates
+        returns array of rounded distances (row per source)
     """
 
     @classmethod
@@ -130,12 +445,167 @@ class MapMath:
         return corners
 
     @staticmethod
-    def get_targets_by_distance(source_coords, target_coords, sort_by_distance=True):
+    def get_targets_by_distance(source_coords, target_coords, sort_by_distance=True,
+                                radius=None, index=None):
+        """
+        Calculates distance from source to each of target coordinates.
+        If radius is given, only targets that lie within it are returned.
+        If MapGrid index is given (along with radius), only targets from
+        grid cells near the source are considered.
+        """
+        if radius is not None and index is not None:
+            target_coords = index.get_in_radius(source_coords, radius)
         targets = []
         for coords in target_coords:
             distance = MapMath.calculate_distance(source_coords, coords)
-            targets.append((coords, distance))
+            if radius is None or distance <= radius:
+                targets.append((coords, distance))
         if sort_by_distance:
             targets = sorted(targets, key=lambda x: x[1])
 
         return targets
+
+    @staticmethod
+    def get_distance_matrix(source_coords, target_coords):
+        """
+        Calculates distances between each source & each target in one
+        batch. Returns NumPy array of shape (len(sources), len(targets)).
+        """
+        sources = numpy.array(source_coords, dtype=float).reshape(-1, 2)
+        targets = numpy.array(target_coords, dtype=float).reshape(-1, 2)
+        side_x = sources[:, 0, None] - targets[None, :, 0]
+        side_y = sources[:, 1, None] - targets[None, :, 1]
+        distances = numpy.sqrt(side_x ** 2 + side_y ** 2)
+        return numpy.round(distances, 2)
+
+
+class AttackTargets:
+    """
+    Attack targets of one attacker, backed by an array of distances:
+    keeps a list of candidate coordinates, the array of distances to them
+    and an index array of targets in range, ordered by distance.
+    Iteration yields the same ((x, y), distance) tuples as a list
+    built by MapMath.get_targets_by_distance.
+    """
+
+    def __init__(self, target_coords, distances, radius=None):
+        self.target_coords = target_coords
+        self.distances = distances
+        if radius is not None:
+            in_range = numpy.flatnonzero(distances <= radius)
+        else:
+            in_range = numpy.arange(len(distances))
+        order = numpy.argsort(distances[in_range], kind='stable')
+        self.order = in_range[order]
+
+    def get_travel_times(self, speed):
+        """
+        Returns array of travel times (seconds) to each target (in order
+        of distance) for a unit with given speed (minutes per tile).
+        """
+        return self.distances[self.order] * speed * 60
+
+    def __iter__(self):
+        # lazy: consumers usually stop at one of the nearest targets
+        for index in self.order:
+            yield self.target_coords[index], float(self.distances[index])
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, position):
+        index = int(self.order[position])
+        return self.target_coords[index], float(self.distances[index])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    # compared by content, which is mutable (as of list), so unhashable
+    __hash__ = None
+
+    def __repr__(self):
+        return "AttackTargets({})".format(list(self))
+
+
+class MapGrid:
+    """
+    Spatial index of map coordinates: splits map into square cells
+    (cell_size x cell_size tiles) and keeps coordinates bucketed by cell.
+
+    Methods:
+
+    add(coords) / remove(coords):
+        places (x, y) to / removes it from its cell
+    get_in_radius(center, radius):
+        returns list of coordinates that lie within radius from center
+    get_nearest(center, k):
+        returns list of k nearest to center coordinates (from nearest
+        to outermost)
+    """
+
+    def __init__(self, coords=(), cell_size=10):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.size = 0
+        for item in coords:
+            self.add(item)
+
+    def add(self, coords):
+        cell = self.cells.setdefault(self._get_cell(coords), set())
+        if coords not in cell:
+            cell.add(coords)
+            self.size += 1
+
+    def remove(self, coords):
+        cell_key = self._get_cell(coords)
+        cell = self.cells.get(cell_key)
+        if cell and coords in cell:
+            cell.remove(coords)
+            self.size -= 1
+            if not cell:
+                self.cells.pop(cell_key)
+
+    def get_in_radius(self, center, radius):
+        x, y = center
+        squared_radius = radius ** 2
+        found = []
+        for cell in self._get_cells_around(center, radius):
+            for coords in cell:
+                if (coords[0] - x) ** 2 + (coords[1] - y) ** 2 <= squared_radius:
+                    found.append(coords)
+        return found
+
+    def get_nearest(self, center, k):
+        """
+        Widens search radius cell by cell until at least k coordinates
+        are found (or whole index is covered).
+        """
+        if k <= 0 or not self.size:
+            return []
+        radius = self.cell_size
+        while True:
+            found = self.get_in_radius(center, radius)
+            if len(found) >= k or len(found) == self.size:
+                break
+            radius += self.cell_size
+        found.sort(key=lambda coords: MapMath.calculate_distance(center, coords))
+        return found[:k]
+
+    def _get_cells_around(self, center, radius):
+        min_x, min_y = self._get_cell((center[0] - radius, center[1] - radius))
+        max_x, max_y = self._get_cell((center[0] + radius, center[1] + radius))
+        # if query covers more cells than there are non-empty ones,
+        # it's cheaper to walk through non-empty cells
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+            for cell_key, cell in self.cells.items():
+                if min_x <= cell_key[0] <= max_x and min_y <= cell_key[1] <= max_y:
+                    yield cell
+            return
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                cell = self.cells.get((cell_x, cell_y))
+                if cell:
+                    yield cell
+
+    def _get_cell(self, coords):
+        return int(coords[0] // self.cell_size), int(coords[1] // self.cell_size)
@@ -0,0 +1,189 @@
+import re
+
+
+__all__ = ['PatternRegistry', 'PATTERNS']
+
+
+class PatternRegistry:
+    """
+    Keeps precompiled regular expressions of all HTML extractors, so
+    each of them is compiled once (at import) instead of on each call.
+
+    Templates (patterns with {placeholders}, e.g. building & level names
+    of a locale) are compiled once per set of parameters: parameters
+    are escaped & compiled patterns are cached. Templates of a locale
+    may be compiled in advance with .precompile & .load_locale.
+
+    Methods:
+
+    register(name, pattern, flags=0):
+        compiles pattern & registers it under a given name
+    register_template(name, template, flags=0):
+        registers template, which is compiled on the first .get with
+        a new set of parameters
+    get(name, **params):
+        returns compiled pattern (template is formatted with params)
+    precompile(name, **params):
+        compiles template with given params in advance (not counted
+        in stats)
+    load_locale(locale):
+        compiles locale-specific templates for a given locale
+    get_stats:
+        returns dict with number of hits & misses of compiled templates
+        cache (& its hit rate), number of lookups of static patterns
+        (which are always compiled) & number of compiled patterns
+    add_stats(stats):
+        adds counters of another registry (e.g. of a worker process,
+        as returned by .get_stats) to own ones
+    reset_stats:
+        sets counters to 0
+    """
+
+    def __init__(self):
+        self.patterns = {}
+        self.templates = {}
+        # {(template_name, sorted params): compiled pattern}
+        self.compiled = {}
+        self.hits = 0
+        self.misses = 0
+        self.static_lookups = 0
+
+    def register(self, name, pattern, flags=0):
+        self.patterns[name] = re.compile(pattern, flags)
+
+    def register_template(self, name, template, flags=0):
+        self.templates[name] = (template, flags)
+
+    def get(self, name, **params):
+        if not params:
+            try:
+                pattern = self.patterns[name]
+            except KeyError:
+                raise KeyError("Unknown pattern: {}".format(name))
+            self.static_lookups += 1
+            return pattern
+        key = (name, tuple(sorted(params.items())))
+        pattern = self.compiled.get(key)
+        if pattern is not None:
+            self.hits += 1
+            return pattern
+        self.misses += 1
+        return self._compile(key, name, params)
+
+    def precompile(self, name, **params):
+        key = (name, tuple(sorted(params.items())))
+        if key not in self.compiled:
+            self._compile(key, name, params)
+
+    def _compile(self, key, name, params):
+        try:
+            template, flags = self.templates[name]
+        except KeyError:
+            raise KeyError("Unknown pattern template: {}".format(name))
+        escaped = {param: re.escape(str(value)) for param, value in params.items()}
+        pattern = re.compile(template.format(**escaped), flags)
+        self.compiled[key] = pattern
+        return pattern
+
+    def load_locale(self, locale):
+        level_name = locale.get('level_name')
+        if level_name is None:
+            return
+        buildings = list(locale.get('mines', []))
+        buildings.extend(locale[name] for name in ('storage', 'wall') if name in locale)
+        for building in buildings:
+            self.precompile('building_level', building=building, level=level_name)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else None
+        return {'hits': self.hits, 'misses': self.misses,
+                'static_lookups': self.static_lookups,
+                'compiled': len(self.patterns) + len(self.compiled),
+                'hit_rate': hit_rate}
+
+    def add_stats(self, stats):
+        self.hits += stats['hits']
+        self.misses += stats['misses']
+        self.static_lookups += stats['static_lookups']
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.static_lookups = 0
+
+
+PATTERNS = PatternRegistry()
+
+# map overview (MapParser)
+PATTERNS.register('map_sectors', r'TWMap.sectorPrefech = ([\W\w]+?\]);')
+
+# villages overviews & train screens (VillageManager, PlayerVillage)
+PATTERNS.register('village_label_id', r'label_text_\d+')
+PATTERNS.register('village_data_id', r'\d{5,6}')
+PATTERNS.register('village_label', r"""(?P<id>\d{5,6})  # village id
+                                       \W+  # closing quote, bracket,
+                                            # possible space character
+                                       (?P<name>[\w\s]+)  # village name
+                                       \W  # bracket before coordinates
+                                       (?P<xcoord>\d{3})  # village x
+                                       \|  # delimiter between x & y
+                                       (?P<ycoord>\d{3})  # village y
+                                    """, re.VERBOSE)
+PATTERNS.register('village_span', r"""(?P<name>[\w\s]+)  # village name
+                                      \W  # bracket before coordinates
+                                      (?P<xcoord>\d{3})  # village x
+                                      \|  # delimiter between x & y
+                                      (?P<ycoord>\d{3})  # village y
+                                   """, re.VERBOSE)
+PATTERNS.register('troops_data', r'UnitPopup.unit_data\s?=\s?([\w\W]+);[\s]*UnitPopup[\w\W]+')
+
+# world settings page (WorldConfig)
+PATTERNS.register('units_data', r'UnitPopup.unit_data\s?=\s?(\{[\w\W]+?\});\s*UnitPopup')
+
+# reports page (ReportManager)
+PATTERNS.register('report_row', r'<input name="id_[\W\w]+?</tr>')
+PATTERNS.register('report_id', r'id_(\d+)')
+PATTERNS.register('report_href', r'<a href="([\W\w]+?)">')
+
+# single report (AttackReport)
+PATTERNS.register('tag', r'<[^>]*>')
+PATTERNS.register('row_open', r'<tr\b[^>]*>')
+PATTERNS.register('hidden_unit', r'<td\b[^>]*\bclass=(["\'])unit-item hidden\1')
+PATTERNS.register_template('element_open', r'<{tag}\b[^>]*\bid=(["\']){id}\1[^>]*>')
+PATTERNS.register_template('tag_boundary', r'<(/?){tag}[\s>]')
+PATTERNS.register('report_status', r'/graphic/dots/([\W\w]+?)\.png')
+PATTERNS.register('report_coords', r'(\d{3})\|(\d{3})')
+PATTERNS.register('date_abbreviated', r"""(\w{3})\s  # abbreviated month name
+                                          (\d{2}),\s  # decimal day
+                                          (\d{4})\s{1,2}  # year
+                                          (\d{2}):(\d{2}):(\d{2})  # hours-minutes-seconds
+                                          # e.g: "Nov 03, 2013  14:01:57"
+                                       """, re.VERBOSE)
+PATTERNS.register('date_numerical', r"""(\d{2})/  # decimal day
+                                        (\d{2})/  # decimal month
+                                        (\d{4})\s{1,2}  # year
+                                        (\d{2}):(\d{2}):(\d{2})  # hours-minutes-seconds
+                                        # e.g: "07/03/2014 00:23:23"
+                                     """, re.VERBOSE)
+# building & level names depend on locale
+PATTERNS.register_template('building_level', r'{building}\s\W{level}\s(\d+)\W')
+PATTERNS.register('haul_wood', r'wood[\W\w]{1,200}stone')
+PATTERNS.register('haul_clay', r'stone[\W\w]{1,200}iron')
+PATTERNS.register('haul_iron', r'iron[\W\w]+?</td>')
+PATTERNS.register('digits', r'\d+')
+
+# rally point & confirmation screen (AttackHelper)
+PATTERNS.register('confirmation_token',
+                  r'type=\Whidden\W name=\W([\w\d]+)\W value=\W([\w\d]+)\W')
+PATTERNS.register('csrf_token', r'csrf\W:\W([\w\d]+)\W')
+PATTERNS.register('ch_token', r'type=\Whidden\W name=\Wch\W value=\W([\w\d]+)\W')
+PATTERNS.register('action_id', r'type=\Whidden\W name=\Waction_id\W value=\W(\d+)\W')
+
+# login & bot protection (AutoLogin, SafeOpener)
+PATTERNS.register('enc_password', r'password[\W\w]+?value\W\W"([\W\w]+?)\W"')
+PATTERNS.register('captcha_url', r"""(/human.php[\W\w]+?)
+                                     \W    # closing quote
+                                     \){0,1}   # may have closing bracket
+                                     ; # deterministic semicolon
+                                  """, re.VERBOSE)
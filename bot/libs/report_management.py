@@ -1,11 +1,31 @@
 import sys
-import re
 import time
 import logging
 import traceback
+import multiprocessing
+from html import unescape
+from concurrent.futures import ProcessPoolExecutor
 
 from bs4 import BeautifulSoup as Soup
 
+from bot.libs.common_tools import Storage
+from bot.libs.patterns import PATTERNS
+
+
+# (tag, id) of elements that 'markup' path of AttackReport parsing cuts out
+REPORT_ELEMENTS = (('span', 'labelText'), ('table', 'attack_info_def_units'),
+                   ('table', 'attack_spy'), ('table', 'attack_results'))
+for _tag, _element_id in REPORT_ELEMENTS:
+    PATTERNS.precompile('element_open', tag=_tag, id=_element_id)
+for _tag in ('span', 'table', 'tr'):
+    PATTERNS.precompile('tag_boundary', tag=_tag)
+
+# Bot is a Thread: fork of its process may copy locks held by other
+# threads, so workers of parsing pool are started by forkserver (where
+# it is available) or spawn
+POOL_START_METHOD = 'forkserver' if 'forkserver' in \
+    multiprocessing.get_all_start_methods() else 'spawn'
+
 
 class ReportManager:
     """
@@ -15,13 +35,41 @@ class ReportManager:
     get_report_urls:
         takes HTML (string) of report page and
         returns list of URLs for each report on this page
+    get_new_report_urls:
+        takes HTML (string) of report page and returns URLs of
+        reports that are newer than the last handled one
+    mark_parsed(report_id):
+        remembers that report was handled
+    save_last_report_id:
+        moves the 'high-water mark' of handled reports to the newest
+        seen report & saves it to storage
     build_report:
         takes HTML (string) of single report and
         returns new AttackReport object.
+    build_reports(report_pages):
+        takes list of HTML (strings) of single reports & returns list
+        of AttackReport objects (in the same order), parsed in a pool
+        of processes if there are at least .min_batch reports.
+    close:
+        shuts down the pool of processes
     """
 
-    def __init__(self, locale):
+    def __init__(self, locale, storage_type=None, storage_name=None,
+                 workers=None, min_batch=8):
         self.locale = locale
+        # compile locale-specific patterns of reports in advance
+        PATTERNS.load_locale(locale)
+        self.workers = workers
+        self.min_batch = min_batch
+        self._executor = None
+        self.storage = None
+        self.last_report_id = None
+        # reports handled since the last save of high-water mark
+        self.parsed_ids = set()
+        self.newest_seen_id = None
+        if storage_type:
+            self.storage = Storage(storage_type, storage_name)
+            self.last_report_id = self.storage.get_last_report_id()
 
     def get_report_urls(self, report_page, only_new=True):
         """
@@ -34,10 +82,85 @@ class ReportManager:
             report_urls.append(report_url)
         return report_urls
 
+    def get_new_report_urls(self, report_page):
+        """
+        Returns tuple (list of (report_id, url), reached_last), where list
+        contains reports that are newer than the last handled report &
+        were not handled yet. reached_last is True, if there is no need
+        to look at the next (older) report page.
+        Until the last handled report is known, only reports marked as
+        "new" are returned.
+        """
+        new_reports = []
+        raw_reports = self._get_reports_from_page(report_page, only_new=False)
+        reached_last = not raw_reports
+        for raw_report in raw_reports:
+            report_id = self._get_report_id(raw_report)
+            if self.newest_seen_id is None or report_id > self.newest_seen_id:
+                self.newest_seen_id = report_id
+            if self.last_report_id is None:
+                if '(new)' not in raw_report:
+                    continue
+            elif report_id <= self.last_report_id:
+                reached_last = True
+                continue
+            if report_id in self.parsed_ids:
+                continue
+            new_reports.append((report_id, self._get_single_report_url(raw_report)))
+        if raw_reports and not new_reports and self.last_report_id is not None:
+            # e.g. the same page was returned again
+            reached_last = True
+        return new_reports, reached_last
+
+    def mark_parsed(self, report_id):
+        self.parsed_ids.add(report_id)
+
+    def save_last_report_id(self):
+        if self.newest_seen_id is not None and \
+                (self.last_report_id is None or
+                 self.newest_seen_id > self.last_report_id):
+            self.last_report_id = self.newest_seen_id
+        self.parsed_ids.clear()
+        if self.storage is not None and self.last_report_id is not None:
+            self.storage.save_last_report_id(self.last_report_id)
+
     def build_report(self, report_page):
         report = AttackReport(report_page, locale=self.locale)
         return report
 
+    def build_reports(self, report_pages):
+        """
+        Reports parsed in other processes come w/o .data & .soup
+        (AttackReport drops them after parsing, so there is no need
+        to send them back).
+        """
+        if len(report_pages) < self.min_batch:
+            return [self.build_report(report_page) for report_page in report_pages]
+        if self._executor is None:
+            mp_context = multiprocessing.get_context(POOL_START_METHOD)
+            try:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=mp_context)
+            except TypeError:
+                # mp_context is not supported before 3.7: workers are
+                # started by the default method of the platform
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        locales = [self.locale] * len(report_pages)
+        reports = []
+        for report, patterns_stats in self._executor.map(_build_report,
+                                                          report_pages, locales):
+            # lookups of patterns in workers are counted by main registry
+            PATTERNS.add_stats(patterns_stats)
+            reports.append(report)
+        return reports
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self.storage is not None:
+            self.storage.close()
+
     @staticmethod
     def _get_reports_from_page(reports_page, only_new):
         """
@@ -45,13 +168,18 @@ class ReportManager:
         Returns list of HTML-chunks, containing actual URLs
         for single reports.
         """
-        single_report_ptrn = re.compile(r'<input name="id_[\W\w]+?</tr>')
-        reports_list = re.findall(single_report_ptrn, reports_page)
+        reports_list = PATTERNS.get('report_row').findall(reports_page)
         if only_new:
             # get reports marked as "new"
             reports_list = [x for x in reports_list if '(new)' in x]
         return reports_list
 
+    @staticmethod
+    def _get_report_id(report):
+        # <input name="id_65471139" type="checkbox" />
+        match = PATTERNS.get('report_id').search(report)
+        return int(match.group(1))
+
     @staticmethod
     def _get_single_report_url(report):
         """
@@ -59,19 +187,33 @@ class ReportManager:
         single report page from server. Returns HTML page
         of single attack report.
         """
-        href_ptrn = re.compile(r'<a href="([\W\w]+?)">')
-        url = re.search(href_ptrn, report)
+        url = PATTERNS.get('report_href').search(report)
         url = url.group(1)
         url = url.replace('&amp;', '&')
         return url
 
 
+def _build_report(report_page, locale):
+    """
+    Builds AttackReport in a worker process of ReportManager's pool.
+    Returns it together with stats of PATTERNS lookups made for it.
+    """
+    PATTERNS.reset_stats()
+    report = AttackReport(report_page, locale=locale)
+    return report, PATTERNS.get_stats()
+
+
 class AttackReport:
     """
     Extracts valuable data from a HTML str data for
     a particular attack report.
+    HTML & Soup tree are released as soon as fields are extracted.
     """
 
+    __slots__ = ('data', 'locale', 'status', 'coords', 't_of_attack',
+                 'defended', 'mine_levels', 'remaining_capacity',
+                 'looted_capacity', 'storage_level', 'wall_level', 'soup')
+
     def __init__(self, str_html, locale):
         self.data = str_html
         self.locale = locale
@@ -85,20 +227,30 @@ class AttackReport:
         self.storage_level = None
         self.wall_level = None
         self.soup = None
-        self.build_report()
+        try:
+            self.build_report()
+        finally:
+            self.data = None
+            self.soup = None
 
     def build_report(self):
         """
-        Builds info about self from HTML string of report page
+        Builds info about self from HTML string of report page.
+        Tries to extract all fields directly from HTML markup first
+        and falls back to parsing of the whole Soup tree if some of
+        needed elements could not be located unambiguously.
         """
         # Check if report has color status (green, blue, red, red_blue).
         # Otherwise we faced with non-battle report (trade/support)
         self._set_attack_status()
         if not self.status:
             return
-        else:
-            self.soup = Soup(self.data)
+        if self._build_from_markup():
+            return
+        self.soup = Soup(self.data)
+        self._build_from_soup()
 
+    def _build_from_soup(self):
         if self.status == 'red':
             # No troops returned. No information collected.
             self._set_t_of_attack()
@@ -114,6 +266,104 @@ class AttackReport:
             for setter in field_setters:
                 setter()
 
+    def _build_from_markup(self):
+        """
+        Single-pass extraction of report fields: cuts out only those
+        elements that are needed (report header, defender troops, espionage
+        & haul tables) and applies the same regexes as the Soup path.
+        Returns False (and leaves fields untouched) if markup doesn't look
+        as expected.
+        """
+        try:
+            label = self._get_element_html('span', 'labelText')
+            if label is None:
+                return False
+            if self.status == 'red':
+                self._set_t_of_attack()
+                self._set_coords_from_text(self._get_text(label))
+                self.defended = True
+                return True
+            defender_table = self._get_element_html('table', 'attack_info_def_units')
+            espionage = self._get_element_html('table', 'attack_spy')
+            attack_results = self._get_element_html('table', 'attack_results')
+            if defender_table is None:
+                return False
+            defender_rows = self._get_rows(defender_table)
+            spy_rows, results_rows = None, None
+            if espionage is not None:
+                spy_rows = self._get_rows(espionage)
+            if attack_results is not None:
+                results_rows = self._get_rows(attack_results)
+        except ValueError:
+            return False
+        if len(defender_rows) < 2 or spy_rows == [] or results_rows == []:
+            return False
+
+        self._set_coords_from_text(self._get_text(label))
+        self._set_t_of_attack()
+        # each unit has its own <td> cell. If unit count == 0, <td> class
+        # will be "unit-item hidden"
+        empty_slots = PATTERNS.get('hidden_unit').findall(defender_rows[1])
+        self.defended = len(empty_slots) != 13
+        if espionage is not None:
+            self._set_levels_from_text(self._get_text(espionage))
+            self.remaining_capacity = self._get_haul_amount(unescape(spy_rows[0]))
+        else:
+            self._set_levels_from_text("")
+            self.remaining_capacity = 0
+        if attack_results is not None:
+            self.looted_capacity = self._get_haul_amount(unescape(results_rows[0]))
+        else:
+            self.looted_capacity = 0
+        return True
+
+    def _get_element_html(self, tag, element_id):
+        """
+        Returns inner HTML of the only element with given tag & id.
+        Returns None if there is no such element & raises ValueError if
+        there are few of them or element is not closed.
+        """
+        open_ptrn = PATTERNS.get('element_open', tag=tag, id=element_id)
+        opened = list(open_ptrn.finditer(self.data))
+        if not opened:
+            return None
+        if len(opened) > 1:
+            raise ValueError("Duplicate element id: {}".format(element_id))
+        match = opened[0]
+        close_start, _ = self._find_closing_tag(self.data, tag, match.end())
+        return self.data[match.end():close_start]
+
+    @classmethod
+    def _get_rows(cls, table_html):
+        """
+        Returns list of <tr> elements (HTML) of a given table in document
+        order (rows of nested tables are included, as Soup does).
+        """
+        rows = []
+        for match in PATTERNS.get('row_open').finditer(table_html):
+            _, close_end = cls._find_closing_tag(table_html, 'tr', match.end())
+            rows.append(table_html[match.start():close_end])
+        return rows
+
+    @staticmethod
+    def _find_closing_tag(html_data, tag, position):
+        """
+        Finds closing tag that matches the tag opened right before given
+        position (tags of nested elements with the same name are skipped).
+        Returns tuple (start, end) of closing tag.
+        """
+        depth = 1
+        tags_ptrn = PATTERNS.get('tag_boundary', tag=tag)
+        for match in tags_ptrn.finditer(html_data, position):
+            depth += -1 if match.group(1) else 1
+            if not depth:
+                return match.start(), html_data.find('>', match.start()) + 1
+        raise ValueError("Element <{}> is not closed".format(tag))
+
+    @staticmethod
+    def _get_text(element_html):
+        return unescape(PATTERNS.get('tag').sub('', element_html))
+
     def _set_attack_status(self):
         """
         Looks for color of image-icon that represents report
@@ -124,8 +374,7 @@ class AttackReport:
         (no haul).
         green, yellow: usual battle report (yellow = some casualties)
         """
-        status_ptrn = re.compile(r'/graphic/dots/([\W\w]+?)\.png')
-        match = re.search(status_ptrn, self.data)
+        match = PATTERNS.get('report_status').search(self.data)
         if match:
             self.status = match.group(1)
 
@@ -145,8 +394,10 @@ class AttackReport:
                 with open('bad_report_data_coords.html', 'w') as f:
                     f.write(str(self.soup))
                 raise e
-        coords_ptrn = re.compile(r"(\d{3})\|(\d{3})")
-        match = re.search(coords_ptrn, text)
+        self._set_coords_from_text(text)
+
+    def _set_coords_from_text(self, text):
+        match = PATTERNS.get('report_coords').search(text)
         if match:
             self.coords = (int(match.group(1)), int(match.group(2)))
         else:
@@ -155,28 +406,13 @@ class AttackReport:
 
     def _set_t_of_attack(self):
         if self.locale["dateformat"] == "abbreviated":
-            pattern = re.compile(r"""(\w{3})\s  # abbreviated month name
-                                     (\d{2}),\s  # decimal day
-                                     (\d{4})\s{1,2}  # year
-                                     (\d{2}):(\d{2}):(\d{2})  # hours-minutes-seconds
-                                     # e.g: "Nov 03, 2013  14:01:57"
-                                  """,
-                                 re.VERBOSE)
-
-            match = re.search(pattern, self.data)
+            match = PATTERNS.get('date_abbreviated').search(self.data)
             if match:
                 str_t = match.group()
                 struct_t = time.strptime(str_t, "%b %d, %Y %H:%M:%S")
                 self.t_of_attack = round(time.mktime(struct_t))
         elif self.locale["dateformat"] == "numerical":
-            pattern = re.compile(r"""(\d{2})/  # decimal day
-                                     (\d{2})/  # decimal month
-                                     (\d{4})\s{1,2}  # year
-                                     (\d{2}):(\d{2}):(\d{2})  # hours-minutes-seconds
-                                     # e.g: "07/03/2014 00:23:23"
-                                  """,
-                                 re.VERBOSE)
-            match = re.search(pattern, self.data)
+            match = PATTERNS.get('date_numerical').search(self.data)
             if match:
                 str_t = match.group()
                 struct_t = time.strptime(str_t, "%d/%m/%Y %H:%M:%S")
@@ -211,12 +447,15 @@ class AttackReport:
         be there if attack was sent with scouts) and sets
         building levels.
         """
-        level_name = self.locale["level_name"]
         espionage = self.soup.find(id="attack_spy")
         if espionage is not None:
             text = espionage.text
         else:
             text = ""
+        self._set_levels_from_text(text)
+
+    def _set_levels_from_text(self, text):
+        level_name = self.locale["level_name"]
         mines = self.locale["mines"]
         mine_levels = []
         for mine in mines:
@@ -233,9 +472,8 @@ class AttackReport:
         """
         Parses input text to get building level.
         """
-        search = r'{building}\s\W{level}\s(\d+)\W'.format(building=building_name,
-                                                          level=level_name)
-        match = re.search(search, text)
+        match = PATTERNS.get('building_level', building=building_name,
+                             level=level_name).search(text)
         if match:
             return int(match.group(1))
         else:
@@ -280,16 +518,13 @@ class AttackReport:
         """
         # grab the chunk which contains loot info for particular
         # resource.
-        wood_pattern = re.compile(r'wood[\W\w]{1,200}stone')
-        clay_pattern = re.compile(r'stone[\W\w]{1,200}iron')
-        iron_pattern = re.compile(r'iron[\W\w]+?</td>')
         i_amount = 0
-        for ptrn in (wood_pattern, clay_pattern, iron_pattern,):
-            match = re.search(ptrn, s_resources)
+        for name in ('haul_wood', 'haul_clay', 'haul_iron'):
+            match = PATTERNS.get(name).search(s_resources)
             if match:
                 s_resource = match.group()
                 # floats:
-                amounts = re.findall(r'\d+', s_resource)
+                amounts = PATTERNS.get('digits').findall(s_resource)
                 s_amount = ''
                 for s in amounts:
                     s_amount += s
@@ -1,20 +1,26 @@
 import sys
-import re
 import random
 import time
 import struct
 import logging
+import asyncio
 import traceback
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from urllib.request import urlopen
 from urllib.error import HTTPError, URLError
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import cookiejar_from_dict
 
 from bot.libs.common_tools import AutoLogin, AntigateWrapper
+from bot.libs.patterns import PATTERNS
 
 
-__all__ = ['RequestManager', 'SessionExpiredError', 'TooManyConnectionAttempts',
-           'RequestDataProvider', 'SafeOpener']
+__all__ = ['RequestManager', 'AsyncRequestManager', 'SessionExpiredError',
+           'TooManyConnectionAttempts', 'RequestDataProvider', 'SafeOpener',
+           'AsyncSafeOpener']
 
 
 class SessionExpiredError(Exception):
@@ -43,9 +49,11 @@ class RequestManager:
     """
 
     def __init__(self, host, initial_cookies, main_id, locale, con_attempts,
-                 reconnect=False, username=None, password=None, antigate_key=None):
+                 reconnect=False, username=None, password=None, antigate_key=None,
+                 pool_size=4):
         self.safe_opener = SafeOpener(host, initial_cookies, locale, con_attempts,
-                                      reconnect, username, password, antigate_key)
+                                      reconnect, username, password, antigate_key,
+                                      pool_size)
         self.data_provider = RequestDataProvider(host, main_id)
 
     def __getattr__(self, name):
@@ -60,6 +68,34 @@ class RequestManager:
         return call_wrapper
 
 
+class AsyncRequestManager:
+    """
+    Asyncio counterpart of RequestManager: exposes the same method names
+    (get_train_screen, get_report, etc.), but each of them is a coroutine
+    that should be awaited. Independent requests may be run concurrently,
+    e.g. with asyncio.gather().
+    """
+
+    def __init__(self, host, initial_cookies, main_id, locale, con_attempts,
+                 reconnect=False, username=None, password=None, antigate_key=None,
+                 pool_size=4):
+        self.safe_opener = AsyncSafeOpener(host, initial_cookies, locale,
+                                           con_attempts, reconnect, username,
+                                           password, antigate_key, pool_size)
+        self.data_provider = RequestDataProvider(host, main_id)
+
+    def __getattr__(self, name):
+        async def call_wrapper(*args, **kwargs):
+            if not hasattr(self.data_provider, name):
+                raise NotImplementedError("This method is not implemented yet!")
+            else:
+                request_data = getattr(self.data_provider, name)(**kwargs)
+                result = await self.safe_opener.send_request(request_data)
+                return result
+
+        return call_wrapper
+
+
 class RequestDataProvider:
     """
     Summarizes all available methods that interact with game server.
@@ -111,6 +147,15 @@ class RequestDataProvider:
         data = {'url': url, 'headers': headers}
         return data
 
+    def get_world_settings(self):
+        """
+        Page with settings of game world (speeds, stats of units).
+        """
+        url = 'http://{host}/stat.php?mode=settings'.format(host=self.host)
+        headers = self._get_default_headers()
+        data = {'url': url, 'headers': headers}
+        return data
+
     def get_train_screen(self, village_id):
         """
         Game screen that contains full listing of units that belong
@@ -308,7 +353,7 @@ class RequestDataProvider:
         if referer is not None:
             default_headers['referer'] = referer
         if content_length is not None:
-            default_headers['content-length'] = content_length
+            default_headers['content-length'] = str(content_length)
 
         return default_headers
 
@@ -330,14 +375,30 @@ class SafeOpener:
         and uses new cookies (cid, sid) to perform all next requests.
         2. If Antigate API key is provided, uses AntigateWrapper class
         to 'break' the captcha.
+
+    All requests are sent through one persistent session with a pool of
+    keep-alive connections (pool_size), so sequential requests to game
+    host re-use already established TCP connections. Cookies of session
+    are replaced after re-login, which is serialized: only the first of
+    requests that faced expired session re-logins.
     """
 
+    # steps of sending a request (see ._get_request_steps)
+    FETCH = 'fetch'
+    SLEEP = 'sleep'
+    RELOGIN = 'relogin'
+    CAPTCHA = 'captcha'
+
     def __init__(self, host, cookies, locale, con_attempts, reconnect,
-                 username, password, antigate_key):
+                 username, password, antigate_key, pool_size=4):
         self.host = host
         self.cookies = cookies
         self.locale = locale
         self.attempts = con_attempts
+        self.pool_size = pool_size
+        self.session = self._build_session()
+        self.login_count = 0
+        self._relogin_lock = Lock()
         self.reconnect = reconnect
         if reconnect:
             if not(username and password):
@@ -354,18 +415,40 @@ class SafeOpener:
         return self._send_request(request_data, attempts=self.attempts)
 
     def _send_request(self, request_data, attempts):
+        steps = self._get_request_steps(request_data, attempts)
+        try:
+            step = next(steps)
+            while True:
+                action, argument = step
+                try:
+                    if action == self.FETCH:
+                        result = self._fetch(argument)
+                    elif action == self.SLEEP:
+                        result = time.sleep(argument)
+                    elif action == self.RELOGIN:
+                        result = self._relogin_once(argument)
+                    else:
+                        result = self._handle_captcha(*argument)
+                except Exception as e:
+                    step = steps.throw(e)
+                else:
+                    step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    def _get_request_steps(self, request_data, attempts):
+        """
+        Retry, session expiry & captcha handling rules shared by SafeOpener
+        & AsyncSafeOpener. Generator yields steps to perform - tuples
+        (action, argument), where action is one of FETCH, SLEEP, RELOGIN
+        & CAPTCHA - and receives their results (errors of steps are thrown
+        into it). Returns response data.
+        """
         while attempts > 0:
             attempts -= 1
             try:
-                url = request_data['url']
-                headers = request_data['headers']
-                post_data = request_data.get('data', None)
-                if post_data:
-                    resp = requests.post(url, headers=headers, data=post_data,
-                                         cookies=self.cookies)
-                else:
-                    resp = requests.get(url, headers=headers,
-                                        cookies=self.cookies)
+                login_count = self.login_count
+                resp = yield self.FETCH, request_data
                 response_text = resp.text
                 # sometimes game server returns empty response
                 if len(response_text) == 0:
@@ -374,7 +457,7 @@ class SafeOpener:
                 expiration_check = self._check_if_session_expire(response_text)
                 if expiration_check:
                     if self.reconnect:
-                        self._relogin_to_game_server()
+                        yield self.RELOGIN, login_count
                         # compensate attempts if re-login was successful
                         attempts += 1
                         continue
@@ -382,7 +465,7 @@ class SafeOpener:
                         raise SessionExpiredError
                 captcha_url = self._check_if_captcha_spawned(response_text)
                 if captcha_url:
-                    self._handle_captcha(captcha_url, attempts)
+                    yield self.CAPTCHA, (captcha_url, attempts)
                     attempts += 1
                     continue
 
@@ -397,12 +480,12 @@ class SafeOpener:
                 error_info = traceback.format_exception(*sys.exc_info())
                 logging.error(error_info)
                 # do not hit server in a predictable manner
-                time.sleep(30 + random.random() * 30)
+                yield self.SLEEP, 30 + random.random() * 30
                 continue
             except ConnectionError:
                 error_info = traceback.format_exception(*sys.exc_info())
                 logging.error(error_info)
-                time.sleep(30 + random.random() * 30)
+                yield self.SLEEP, 30 + random.random() * 30
                 continue
             # strange & rare issue when unzipping some of TribalWars responses.
             # never reproduced 2 times in row (when repeating request)
@@ -414,6 +497,19 @@ class SafeOpener:
         raise TooManyConnectionAttempts("There were too many connection errors."
                                         "See log file for details.")
 
+    def _fetch(self, request_data):
+        """
+        Sends given request through pooled session & returns raw response
+        """
+        url = request_data['url']
+        headers = request_data['headers']
+        post_data = request_data.get('data', None)
+        if post_data:
+            resp = self.session.post(url, headers=headers, data=post_data)
+        else:
+            resp = self.session.get(url, headers=headers)
+        return resp
+
     def _check_if_session_expire(self, html_data):
         """
         Checks for a language-specific text that indicates that user session
@@ -424,8 +520,35 @@ class SafeOpener:
             logging.warning("Session expired... Don't worry, masta!")
             return True
 
+    def _relogin_once(self, seen_login_count):
+        """
+        Re-logins to game server unless somebody else has already done it
+        after the failed request was sent.
+        """
+        with self._relogin_lock:
+            if self.login_count == seen_login_count:
+                self._relogin_to_game_server()
+                self.login_count += 1
+
     def _relogin_to_game_server(self):
         self.cookies = self.auto_login.login_to_server()
+        # session is shared with requests that may still be in flight:
+        # its cookie jar is refilled instead of re-building the session,
+        # cookies of the old session (e.g. 'cid') must not outlive it
+        self.session.cookies.clear()
+        cookiejar_from_dict(self.cookies, cookiejar=self.session.cookies)
+
+    def _build_session(self):
+        """
+        Creates a session that keeps pooled keep-alive connections to
+        game host & carries current cookies in its cookie jar.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.cookies = cookiejar_from_dict(self.cookies)
+        return session
 
     def _check_if_captcha_spawned(self, html_data):
         """
@@ -440,15 +563,10 @@ class SafeOpener:
             # may look differently:
             # 1. '/human.php?s=afef3a5b97df&small'
             # 2. '/human.php?s=d775cf97c86e'
-            img_url_ptrn = re.compile(r"""(/human.php[\W\w]+?)
-                                          \W    # closing quote
-                                          \){0,1}   # may have closing bracket
-                                          ; # deterministic semicolon
-                                       """, re.VERBOSE)
             # Extract CAPTCHA URL. Note: it's changing on each
             # subsequent request, do not refresh TW pages in browser
             # while waiting for captcha answer from Antigate
-            url_match = re.search(img_url_ptrn, html_data)
+            url_match = PATTERNS.get('captcha_url').search(html_data)
             if url_match:
                 captcha_url = 'http://{host}{match}'.format(host=self.host,
                                                             match=url_match.group(1))
@@ -493,3 +611,74 @@ class SafeOpener:
 
         data = {'url': url, 'headers': headers, 'data': post_data}
         return data
+
+
+class AsyncSafeOpener(SafeOpener):
+    """
+    Awaitable version of SafeOpener with the same retry, session expiry
+    & captcha handling rules.
+    Blocking network calls are delegated to a thread pool of pool_size
+    workers (one worker per pooled connection), so up to pool_size
+    requests may be in flight at the same time.
+    When several in-flight requests face expired session at once, only
+    the first of them re-logins to game server, others just retry with
+    new cookies.
+    """
+
+    def __init__(self, host, cookies, locale, con_attempts, reconnect,
+                 username, password, antigate_key, pool_size=4):
+        SafeOpener.__init__(self, host, cookies, locale, con_attempts, reconnect,
+                            username, password, antigate_key, pool_size)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self._login_lock = None
+
+    async def send_request(self, request_data):
+        return await self._send_request(request_data, attempts=self.attempts)
+
+    async def _send_request(self, request_data, attempts):
+        steps = self._get_request_steps(request_data, attempts)
+        try:
+            step = next(steps)
+            while True:
+                action, argument = step
+                try:
+                    if action == self.FETCH:
+                        result = await self._run_blocking(self._fetch, argument)
+                    elif action == self.SLEEP:
+                        result = await asyncio.sleep(argument)
+                    elif action == self.RELOGIN:
+                        result = await self._relogin_once(argument)
+                    else:
+                        result = await self._handle_captcha(*argument)
+                except Exception as e:
+                    step = steps.throw(e)
+                else:
+                    step = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+    async def _relogin_once(self, seen_login_count):
+        """
+        Re-logins to game server unless somebody else has already done it
+        after the failed request was sent.
+        """
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        async with self._login_lock:
+            if self.login_count == seen_login_count:
+                await self._run_blocking(self._relogin_to_game_server)
+                self.login_count += 1
+
+    async def _handle_captcha(self, image_url, attempts):
+        if not self.captcha_breaker:
+            raise AttributeError("There are no captcha breakers available :(")
+        img_bytes = await self._run_blocking(self._download_img, image_url)
+        text_anwser = await self._run_blocking(self.captcha_breaker.get_captcha_answer,
+                                               img_bytes)
+        request_data = self._post_captcha_answer(text_anwser)
+        await self._send_request(request_data, attempts)
+
+    async def _run_blocking(self, func, *args):
+        # running loop (.get_running_loop is not available before 3.7)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
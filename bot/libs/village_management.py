@@ -1,17 +1,37 @@
-import re
 import json
 import time
 import random
 import logging
 
 from bs4 import BeautifulSoup as Soup
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from bot.libs.map_tools import MapMath
+from bot.libs import map_tools
+from bot.libs.map_tools import MapMath, MapGrid, AttackTargets
 from bot.libs.common_tools import Storage
 from bot.libs.attack_management import Unit
+from bot.libs.patterns import PATTERNS
 
 
-__all__ = ['VillageManager', 'TargetVillage', 'PlayerVillage', 'Village']
+__all__ = ['VillageManager', 'TargetVillage', 'PlayerVillage', 'Village',
+           'TargetVillageStore']
+
+
+# production (per hour, x1 world) of mine of each level
+MINE_RATES = [5, 30, 35, 41, 47, 55, 64, 74, 86, 100, 117,
+              136, 158, 184, 214, 249, 289, 337, 391, 455,
+              530, 616, 717, 833, 969, 1127, 1311, 1525, 1774,
+              2063, 2400]
+# {server_speed: MINE_RATES multiplied by server speed}
+SCALED_MINE_RATES = {}
+# capacity (of one resource) of warehouse of each level
+STORAGE_RATES = [1000, 1229, 1512, 1859, 2285, 2810, 3454,
+                 4247, 5222, 6420, 7893, 9705, 11932, 14670, 18037,
+                 22177, 27266, 33523, 41217, 50675, 62305, 76604, 94184,
+                 115798, 142373, 175047, 215219, 264611, 325337, 400000]
 
 
 class VillageManager:
@@ -30,18 +50,27 @@ class VillageManager:
         input.
         filters map data (exclude non-neutral & non-trusted targets)
         and builds mapping of target villages.
-    set_farming_village(attacker_id, train_screen, use_def, heavy_is_def):
+    set_farming_village(attacker_id, train_screen, use_def, heavy_is_def,
+                        t_limit_to_leave):
         takes train screen (html string) for a given PlayerVillage
         & farming options.
-        configures this PlayerVillage to act as farming village
+        configures this PlayerVillage to act as farming village (with
+        targets that may be reached within t_limit_to_leave hours)
     get_attack_targets():
         returns mapping {(x_coordinate, y_coordinate): TargetVillage_obj, ...}
     get_next_attacking_village():
         randomly decides who will attack next
         returns PlayerVillage_obj
-    disable_farming_village(attacker_id):
+    get_active_farming_villages():
+        returns mapping {village_id: PlayerVillage_obj} of farming
+        villages that may attack
+    disable_farming_village(attacker_id, no_targets=False):
         marks given village as inactive (so it will not be considered as
-        the next possible attacker)
+        the next possible attacker). Village that has no targets to
+        attack is remembered as idle
+    enable_idle_villages():
+        marks villages that were disabled for lack of targets as active
+        again (e.g. when targets have returned to queue)
     update_troops_count(attacker_id, troops):
         updates given attacker's troops basing on amount of troops that
         were sent
@@ -51,14 +80,26 @@ class VillageManager:
     update_villages_in_storage(villages)
         updates target villages saved in storage with a given mapping
         of target villages (those that were attacked & have more recent info)
+    apply_map_delta(changed, removed, ...):
+        updates target villages with changes of map
+    close:
+        closes storage
     """
 
-    def __init__(self, storage_type, storage_name):
+    def __init__(self, storage_type, storage_name, speed_factor=1, unit_stats=None):
 
         self.map_storage = Storage(storage_type, storage_name)
+        # units with speeds & stats of current world
+        self.units = Unit.build_units(speed_factor, unit_stats)
         self.player_villages = {}
         self.target_villages = {}
+        self.targets_index = MapGrid()
         self.farming_villages = {}
+        # ids of farming villages disabled for lack of targets
+        self.idle_villages = set()
+        self.farm_radii = {}
+        # columnar copy of targets' fields (if NumPy is available)
+        self.target_store = None
 
     def build_player_villages(self, overviews_html):
         """
@@ -112,10 +153,67 @@ class VillageManager:
                       "initialization: {}".format(target_villages))
 
         self.target_villages = target_villages
+        self.targets_index = MapGrid(target_villages.keys())
+        if numpy is not None:
+            self.target_store = TargetVillageStore(size=len(target_villages))
+            for village in target_villages.values():
+                self.target_store.add(village)
+
+    def apply_map_delta(self, changed, removed, trusted_targets,
+                        untrusted_targets, server_speed):
+        """
+        Applies changes of map (see MapSectorCache.update_sectors) to
+        self.target_villages: updates population of known targets,
+        adds new targets & removes villages that are not valid targets
+        anymore (e.g. conquered barbarians). Re-assigns attack targets
+        to farming villages, if set of targets has changed.
+        Returns tuple ({(x, y): TargetVillage} of new targets,
+        [(x, y), ...] of removed targets)
+        """
+        new_targets, removed_targets = {}, []
+        for coords in removed:
+            if coords in self.target_villages:
+                removed_targets.append(coords)
+        for coords, village_data in changed.items():
+            if (self._is_valid_target(village_data) and
+                    coords not in untrusted_targets) or coords in trusted_targets:
+                village = self.target_villages.get(coords)
+                if village is not None:
+                    population = village_data[3]
+                    village.population = int(population.replace('.', ''))
+                else:
+                    new_targets[coords] = self._build_target_village(coords,
+                                                                     village_data,
+                                                                     server_speed)
+            elif coords in self.target_villages:
+                removed_targets.append(coords)
+
+        for coords in removed_targets:
+            village = self.target_villages.pop(coords)
+            self.targets_index.remove(coords)
+            if self.target_store is not None:
+                self.target_store.remove(village)
+        for coords, village in new_targets.items():
+            self.target_villages[coords] = village
+            self.targets_index.add(coords)
+            if self.target_store is not None:
+                self.target_store.add(village)
+
+        logging.info("Map changes: {n} new & {r} removed targets".format(
+            n=len(new_targets), r=len(removed_targets)))
+
+        if new_targets or removed_targets:
+            for attacker_id, attacker in self.farming_villages.items():
+                radius = self.farm_radii.get(attacker_id)
+                attacker.set_attack_targets(self._get_targets_for_attacker(attacker,
+                                                                           radius))
+                attacker.set_travel_times(self.units)
+        return new_targets, removed_targets
 
     def set_farming_village(self, attacker_id, train_screen_html,
                             use_def_to_farm=False,
-                            heavy_is_def=False):
+                            heavy_is_def=False,
+                            t_limit_to_leave=None):
         """
         Configures the PlayerVillage which should be used as attacker &
         sets attack targets for it.
@@ -129,14 +227,22 @@ class VillageManager:
         4) heavy_is_def: if use_def_to_farm is set to 'False' & heavy_is_def
         is set to 'True', HeavyCavalry unit will be considered as defensive
         unit and will not be used to farm villages.
-
+        5) t_limit_to_leave: maximum time (hours) for troops to reach their
+        target. Targets that cannot be reached by the fastest of attacker's
+        units within this time are not assigned to attacker.
         """
         attacker = self.player_villages.get(attacker_id, None)
         if attacker is not None:
             attacker.set_troops_to_use(use_def_to_farm, heavy_is_def)
             attacker.update_troops_count(html_data=train_screen_html)
-            attacker_targets = self._get_targets_for_attacker(attacker)
+            if t_limit_to_leave is not None:
+                radius = attacker.get_farm_radius(t_limit_to_leave, self.units)
+            else:
+                radius = None
+            attacker_targets = self._get_targets_for_attacker(attacker, radius)
             attacker.set_attack_targets(attacker_targets)
+            attacker.set_travel_times(self.units)
+            self.farm_radii[attacker_id] = radius
 
             logging.info(str(attacker))
             event_msg = "Attacker {id} has {c} villages in " \
@@ -154,6 +260,10 @@ class VillageManager:
     def get_player_villages(self):
         return self.player_villages
 
+    def get_active_farming_villages(self):
+        return {villa_id: villa for villa_id, villa in
+                self.farming_villages.items() if villa.active}
+
     def get_next_attacking_village(self):
         """
         Randomly decides which PlayerVillage from list of active
@@ -167,8 +277,23 @@ class VillageManager:
             next_attacker = random.choice(attackers)
             return next_attacker
 
-    def disable_farming_village(self, attacker_id):
+    def disable_farming_village(self, attacker_id, no_targets=False):
         self.farming_villages[attacker_id].active = False
+        if no_targets:
+            self.idle_villages.add(attacker_id)
+
+    def enable_idle_villages(self):
+        """
+        Marks villages that were disabled for lack of targets as active
+        (their troops may be at home, so they are not enabled again
+        by .refresh_village_troops).
+        Returns number of enabled villages.
+        """
+        for villa_id in self.idle_villages:
+            self.farming_villages[villa_id].active = True
+        enabled = len(self.idle_villages)
+        self.idle_villages.clear()
+        return enabled
 
     def update_troops_count(self, attacker_id, troops_sent):
         """
@@ -193,21 +318,45 @@ class VillageManager:
             # since some troops have returned, try
             # to consider villa as attacker again.
             self.farming_villages[villa_id].active = True
+            self.idle_villages.discard(villa_id)
 
     def update_villages_in_storage(self, villages):
         self.map_storage.update_villages(villages)
 
-    def _get_targets_for_attacker(self, attacker):
+    def close(self):
+        self.map_storage.close()
+
+    def _get_targets_for_attacker(self, attacker, radius=None):
         """
         Asks MapMath for a list of targets for a given attacker
-        (where each attack target is a tuple((x, y), distance_from_attacker))
+        (where each attack target is a tuple((x, y), distance_from_attacker)).
+        If NumPy is available, returns AttackTargets (with distances
+        calculated in one batch) instead.
         """
+        if map_tools.numpy is not None and self.target_villages:
+            return self._get_targets_in_batch(attacker, radius)
         attacker_coords = attacker.coords
         target_coords = self.target_villages.keys()
         targets_by_distance = MapMath.get_targets_by_distance(attacker_coords,
-                                                              target_coords)
+                                                              target_coords,
+                                                              radius=radius,
+                                                              index=self.targets_index)
         return targets_by_distance
 
+    def _get_targets_in_batch(self, attacker, radius):
+        """
+        Takes candidates within radius from targets index (all targets,
+        if radius is not given) & calculates distances to them in one batch.
+        """
+        if radius is not None:
+            target_coords = self.targets_index.get_in_radius(attacker.coords, radius)
+        else:
+            target_coords = list(self.target_villages.keys())
+        if not target_coords:
+            return []
+        distances = MapMath.get_distance_matrix([attacker.coords], target_coords)[0]
+        return AttackTargets(target_coords, distances, radius)
+
     @staticmethod
     def _get_villages_data(html_data):
         """
@@ -220,36 +369,24 @@ class VillageManager:
 
         villages_data = []
         soup = Soup(html_data)
-        villages_info = soup.findAll(id=re.compile('label_text_\d+'))
+        villages_info = soup.findAll(id=PATTERNS.get('village_label_id'))
         if villages_info:
-            villa_info_ptrn = re.compile("""(?P<id>\d{5,6})  # village id
-                                        \W+  # closing quote, bracket,
-                                             # possible space character
-                                        (?P<name>[\w\s]+)  # village name
-                                        \W  # bracket before coordinates
-                                        (?P<xcoord>\d{3})  # village x
-                                        \|  # delimiter between x & y
-                                        (?P<ycoord>\d{3})  # village y
-                                     """, re.VERBOSE)
+            villa_info_ptrn = PATTERNS.get('village_label')
             for village in villages_info:
                 text = str(village)
-                village_data = re.search(villa_info_ptrn, text)
+                village_data = villa_info_ptrn.search(text)
                 village_id = int(village_data.group('id'))
                 village_name = village_data.group('name').strip()
                 village_coords = int(village_data.group('xcoord')), int(village_data.group('ycoord'))
                 villages_data.append((village_id, village_coords, village_name))
         else:
-            villages_info = soup.findAll("span", attrs={"data-id": re.compile(r'\d{5,6}')})
-            villa_info_ptrn = re.compile("""(?P<name>[\w\s]+)  # village name
-                                         \W  # bracket before coordinates
-                                         (?P<xcoord>\d{3})  # village x
-                                         \|  # delimiter between x & y
-                                         (?P<ycoord>\d{3})  # village y
-                                         """, re.VERBOSE)
+            villages_info = soup.findAll("span",
+                                         attrs={"data-id": PATTERNS.get('village_data_id')})
+            villa_info_ptrn = PATTERNS.get('village_span')
             for village in villages_info:
                 village_id = int(village.attrs["data-id"])
                 text = village.text
-                village_data = re.search(villa_info_ptrn, text)
+                village_data = villa_info_ptrn.search(text)
                 village_name = village_data.group('name').strip()
                 village_coords = int(village_data.group('xcoord')), int(village_data.group('ycoord'))
                 villages_data.append((village_id, village_coords, village_name))
@@ -290,10 +427,39 @@ class VillageManager:
 
 
 class Village:
+    """
+    Base class for player & target villages.
+    Attributes are kept in __slots__ (there are tens of thousands of
+    target villages in memory), while pickled state remains a plain
+    dict of attributes, so villages saved to storage before slots were
+    introduced keep loading (attributes unknown to class are skipped).
+    """
+
+    __slots__ = ('id', 'coords')
+
     def __init__(self, village_id, coords):
         self.id = village_id
         self.coords = coords
 
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self._get_slot_names()
+                if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # (dict_state, slots_state) pair
+            dict_state, slots_state = state
+            state = dict(dict_state or {}, **(slots_state or {}))
+        slot_names = self._get_slot_names()
+        for name, value in state.items():
+            if name in slot_names:
+                setattr(self, name, value)
+
+    @classmethod
+    def _get_slot_names(cls):
+        return [name for klass in reversed(cls.__mro__)
+                for name in getattr(klass, '__slots__', ())]
+
 
 class PlayerVillage(Village):
     """
@@ -310,10 +476,19 @@ class PlayerVillage(Village):
         returns self.troops_count
     set_attack_targets(attack_targets):
         sets self.attack_targets = attack_targets
+    set_travel_times(units):
+        pre-calculates travel times (seconds) to each of attack targets
+        for each of farming units
     set_troops_to_use(heavy_is_def, use_def_to_farm):
         sets a list of units that will be used to farm.
+    get_farm_radius(t_limit, units=None):
+        returns max distance that the fastest of farming units could
+        pass in t_limit hours.
     """
 
+    __slots__ = ('name', 'flag', 'troops_to_use', 'troops_count',
+                 'attack_targets', 'travel_times', 'active')
+
     def __init__(self, village_id, coords, name, flag=None):
         Village.__init__(self, village_id, coords)
         self.name = name
@@ -321,6 +496,8 @@ class PlayerVillage(Village):
         self.troops_to_use = []
         self.troops_count = {}
         self.attack_targets = []
+        # {unit_name: travel times in order of self.attack_targets}
+        self.travel_times = None
         self.active = True
 
     def update_troops_count(self, html_data=None, troops_sent=None):
@@ -349,6 +526,21 @@ class PlayerVillage(Village):
 
     def set_attack_targets(self, attack_targets):
         self.attack_targets = attack_targets
+        self.travel_times = None
+
+    def set_travel_times(self, units):
+        travel_times = {}
+        for name in self.troops_to_use:
+            # scouts are not sent alone
+            if name == 'spy' or name not in units:
+                continue
+            speed = units[name].speed
+            if isinstance(self.attack_targets, AttackTargets):
+                travel_times[name] = self.attack_targets.get_travel_times(speed)
+            else:
+                travel_times[name] = [distance * speed * 60 for _, distance
+                                      in self.attack_targets]
+        self.travel_times = travel_times
 
     def set_troops_to_use(self, use_def, heavy_is_def):
         if use_def:
@@ -360,15 +552,24 @@ class PlayerVillage(Village):
 
         self.troops_to_use = troops_group
 
+    def get_farm_radius(self, t_limit, units=None):
+        if units is None:
+            units = Unit.build_units()
+        # scouts are not sent alone
+        speeds = [units[name].speed for name in self.troops_to_use
+                  if name != 'spy' and name in units]
+        if not speeds:
+            return 0
+        # Unit.speed is a minutes-per-tile
+        return t_limit * 60 / min(speeds)
+
     @staticmethod
     def _get_troops_data(html_data):
         """
         Returns dict containing all troops data for
         a given village (current & total)
         """
-        data_ptrn = re.compile(r'UnitPopup.unit_data\s?=\s?'
-                               r'([\w\W]+);[\s]*UnitPopup[\w\W]+')
-        match = re.search(data_ptrn, html_data)
+        match = PATTERNS.get('troops_data').search(html_data)
         troops_data = json.loads(match.group(1))
         return troops_data
 
@@ -408,8 +609,22 @@ class TargetVillage(Village):
         on the time of last visit.
     """
 
+    __slots__ = ('population', 'bonus', 'rate_multiplier', 'mine_levels',
+                 'h_rates', 'last_visited', 'remaining_capacity', 'total_loot',
+                 'visits_history', 'defended', 'storage_limit', 'base_defence',
+                 '_store', '_row')
+
+    # (population from, population to (excl.), capacity); villages with
+    # population out of these ranges get DEFAULT_CAPACITY_MAX
+    DEFAULT_CAPACITIES = ((1, 50, 600), (50, 100, 1200), (100, 200, 2400),
+                          (200, 300, 3200), (300, 400, 4800), (400, 600, 6400),
+                          (600, 800, 8000))
+    DEFAULT_CAPACITY_MAX = 16000
+
     def __init__(self, village_id, coords, population, bonus=None, server_speed=1):
         Village.__init__(self, village_id, coords)
+        self._store = None
+        self._row = None
         self.population = population
         self.bonus = bonus
         self.rate_multiplier = server_speed
@@ -423,6 +638,13 @@ class TargetVillage(Village):
         self.storage_limit = None
         self.base_defence = None
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # fields are read from village itself, store (if any) is updated
+        # on write
+        if name in TargetVillageStore.FIELDS and self._store is not None:
+            self._store.set_field(self._row, name, value)
+
     def update_stats(self, attack_report):
         """
         Updates self basing on information of
@@ -494,9 +716,8 @@ class TargetVillage(Village):
         on mines level, production bonus & server speed.
         """
         if self.mine_levels:
-            rates = self._get_mine_rates()
-            h_rates = [int(rates[x] * self.rate_multiplier)
-                       for x in self.mine_levels]
+            rates = self._get_scaled_mine_rates(self.rate_multiplier)
+            h_rates = [rates[x] for x in self.mine_levels]
             if self.bonus:
                 if "all resource" in self.bonus:
                     h_rates = [round(x * 1.3) for x in h_rates]
@@ -527,22 +748,11 @@ class TargetVillage(Village):
         """
         Roughly estimates village capacity basing on its .population
         """
-        if self.population in range(1, 50):
-            return 600
-        elif self.population in range(50, 100):
-            return 1200
-        elif self.population in range(100, 200):
-            return 2400
-        elif self.population in range(200, 300):
-            return 3200
-        elif self.population in range(300, 400):
-            return 4800
-        elif self.population in range(400, 600):
-            return 6400
-        elif self.population in range(600, 800):
-            return 8000
-        else:
-            return 16000
+        population = self.population
+        for population_from, population_to, capacity in self.DEFAULT_CAPACITIES:
+            if population_from <= population < population_to:
+                return capacity
+        return self.DEFAULT_CAPACITY_MAX
 
     @staticmethod
     def _get_mine_rates():
@@ -551,11 +761,18 @@ class TargetVillage(Village):
         Index = mine_level, value = production hour rate.
         (http://help.tribalwars.net/wiki/Timber_camp)
         """
-        rates = [5, 30, 35, 41, 47, 55, 64, 74, 86, 100, 117,
-                 136, 158, 184, 214, 249, 289, 337, 391, 455,
-                 530, 616, 717, 833, 969, 1127, 1311, 1525, 1774,
-                 2063, 2400]
+        return MINE_RATES
 
+    @staticmethod
+    def _get_scaled_mine_rates(rate_multiplier):
+        """
+        Returns mines h/rates multiplied by server speed (calculated
+        once per speed).
+        """
+        rates = SCALED_MINE_RATES.get(rate_multiplier)
+        if rates is None:
+            rates = [int(rate * rate_multiplier) for rate in MINE_RATES]
+            SCALED_MINE_RATES[rate_multiplier] = rates
         return rates
 
     @staticmethod
@@ -563,12 +780,18 @@ class TargetVillage(Village):
         """
         http://help.tribalwars.net/wiki/Warehouse
         """
-        rates = [1000, 1229, 1512, 1859, 2285, 2810, 3454,
-                 4247, 5222, 6420, 7893, 9705, 11932, 14670, 18037,
-                 22177, 27266, 33523, 41217, 50675, 62305, 76604, 94184,
-                 115798, 142373, 175047, 215219, 264611, 325337, 400000]
+        return STORAGE_RATES
 
-        return rates
+    def __setstate__(self, state):
+        self._store = None
+        self._row = None
+        Village.__setstate__(self, state)
+
+    @classmethod
+    def _get_slot_names(cls):
+        # attachment to TargetVillageStore is not pickled
+        return [name for name in super()._get_slot_names()
+                if name not in ('_store', '_row')]
 
     def __str__(self):
         info = "Village: \t\tcoords => {coords}, visited => {visit}, \n\
@@ -592,3 +815,115 @@ class TargetVillage(Village):
 
     def __repr__(self):
         return self.__str__()
+
+
+class TargetVillageStore:
+    """
+    Columnar (NumPy) copy of TargetVillage fields that are needed to
+    estimate village capacity: .population, .last_visited, .h_rates,
+    .remaining_capacity & .storage_limit are kept in parallel arrays, a
+    row per village (rows are found by village id). Villages keep their
+    own fields (& read them as usual), attached villages write them to
+    store as well. None is kept as NaN.
+
+    Provides the next interface methods:
+
+    add(village):
+        attaches village to store (copies its fields to arrays)
+    remove(village):
+        detaches village
+    set_field(row, name, value):
+        updates field of village in a given row
+    estimate_capacity(ids, t_of_arrival):
+        returns array of estimated capacities of villages with given ids,
+        equal to TargetVillage.estimate_capacity of each of them
+    """
+
+    FIELDS = ('population', 'last_visited', 'h_rates',
+              'remaining_capacity', 'storage_limit')
+
+    def __init__(self, size=1024):
+        size = max(size, 1)
+        self.rows = {}
+        self.villages = [None] * size
+        self.free_rows = list(range(size - 1, -1, -1))
+        self.population = numpy.full(size, numpy.nan)
+        self.last_visited = numpy.full(size, numpy.nan)
+        self.h_rates = numpy.full((size, 3), numpy.nan)
+        self.remaining_capacity = numpy.full(size, numpy.nan)
+        self.storage_limit = numpy.full(size, numpy.nan)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, village_id):
+        return village_id in self.rows
+
+    def add(self, village):
+        if village._store is self:
+            return
+        if village._store is not None:
+            village._store.remove(village)
+        if village.id in self.rows:
+            self.remove(self.villages[self.rows[village.id]])
+        if not self.free_rows:
+            self._grow()
+        row = self.free_rows.pop()
+        self.rows[village.id] = row
+        self.villages[row] = village
+        for name in self.FIELDS:
+            self.set_field(row, name, getattr(village, name))
+        village._store, village._row = self, row
+
+    def remove(self, village):
+        if village._store is not self:
+            return
+        del self.rows[village.id]
+        self.villages[village._row] = None
+        self.free_rows.append(village._row)
+        village._store, village._row = None, None
+
+    def set_field(self, row, name, value):
+        if value is None:
+            value = numpy.nan
+        getattr(self, name)[row] = value
+
+    def estimate_capacity(self, ids, t_of_arrival):
+        """
+        Vectorized TargetVillage.estimate_capacity: t_of_arrival is
+        either a single time or a sequence of times (one per id).
+        Returns int64 array.
+        """
+        rows = numpy.fromiter((self.rows[village_id] for village_id in ids),
+                              dtype=numpy.intp, count=len(ids))
+        t_of_arrival = numpy.broadcast_to(numpy.asarray(t_of_arrival, dtype=float),
+                                          rows.shape)
+        h_rates = self.h_rates[rows]
+        hours = numpy.minimum((t_of_arrival - self.last_visited[rows]) / 3600, 8)
+        # the same order of additions as in TargetVillage.estimate_capacity
+        capacity = h_rates[:, 0] * hours + h_rates[:, 1] * hours + h_rates[:, 2] * hours
+        capacity += numpy.nan_to_num(self.remaining_capacity[rows])
+        storage_limit = numpy.nan_to_num(self.storage_limit[rows])
+        over_limit = (storage_limit > 0) & (capacity > storage_limit)
+        capacity = numpy.where(over_limit, storage_limit, capacity)
+
+        population = self.population[rows]
+        default_capacity = numpy.full(len(rows), TargetVillage.DEFAULT_CAPACITY_MAX,
+                                      dtype=float)
+        for population_from, population_to, village_capacity in \
+                TargetVillage.DEFAULT_CAPACITIES:
+            in_range = (population >= population_from) & (population < population_to)
+            default_capacity[in_range] = village_capacity
+        has_rates = ~numpy.isnan(h_rates[:, 0])
+        capacity = numpy.where(has_rates, numpy.round(capacity), default_capacity)
+        return capacity.astype(numpy.int64)
+
+    def _grow(self):
+        size = len(self.villages)
+        self.villages.extend([None] * size)
+        self.free_rows.extend(range(2 * size - 1, size - 1, -1))
+        for name in ('population', 'last_visited', 'remaining_capacity',
+                     'storage_limit'):
+            setattr(self, name, numpy.concatenate([getattr(self, name),
+                                                   numpy.full(size, numpy.nan)]))
+        self.h_rates = numpy.concatenate([self.h_rates, numpy.full((size, 3), numpy.nan)])
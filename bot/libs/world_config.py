@@ -0,0 +1,169 @@
+import json
+import time
+import logging
+import xml.etree.ElementTree as ElementTree
+
+from bs4 import BeautifulSoup as Soup
+
+from bot.libs.patterns import PATTERNS
+
+
+__all__ = ['WorldConfig', 'WorldConfigCache']
+
+
+class WorldConfig:
+    """
+    Settings of game world that matter for farming: game speed, unit
+    speed & stats of units (attack, speed in minutes per tile on x1
+    world, haul).
+
+    Methods:
+
+    from_settings_page(html_data):
+        builds config from world settings page (stat.php?mode=settings)
+    from_config_xml(xml_data):
+        builds config from world config (interface.php?func=get_config),
+        which has no stats of units
+    from_file(path):
+        builds config from a local copy of settings page, config XML
+        or JSON (as returned by .to_dict)
+    to_dict / from_dict(data):
+        (de)serialization for WorldConfigCache
+    get_speed_factor:
+        returns speed * unit_speed (times on the road are divided by it)
+    get_unit_stats:
+        returns {unit_name: (attack, speed, haul)}
+    """
+
+    def __init__(self, speed=1, unit_speed=1, units=None):
+        self.speed = speed
+        self.unit_speed = unit_speed
+        # {unit_name: {'attack': int, 'speed': float, 'carry': int}}
+        self.units = units or {}
+
+    @classmethod
+    def from_settings_page(cls, html_data):
+        """
+        Game & unit speeds are taken from the first two rows of settings
+        table (labels are locale-specific), stats of units - from JSON
+        data of unit popups.
+        """
+        soup = Soup(html_data)
+        try:
+            settings_table = soup.find('h2').find_next('table', class_='vis')
+            rows = settings_table.find_all('tr')
+            speed = cls._to_number(rows[1].find_all('td')[1].text)
+            unit_speed = cls._to_number(rows[2].find_all('td')[1].text)
+        except (AttributeError, IndexError):
+            raise ValueError("Unable to find speeds on world settings page.")
+        match = PATTERNS.get('units_data').search(html_data)
+        units = {}
+        if match:
+            for name, unit_data in json.loads(match.group(1)).items():
+                units[name] = {'attack': unit_data['attack'],
+                               'speed': unit_data['speed'],
+                               'carry': unit_data['carry']}
+        return cls(speed=speed, unit_speed=unit_speed, units=units)
+
+    @classmethod
+    def from_config_xml(cls, xml_data):
+        try:
+            root = ElementTree.fromstring(xml_data)
+            speed = cls._to_number(root.findtext('speed'))
+            unit_speed = cls._to_number(root.findtext('unit_speed'))
+        except (ElementTree.ParseError, AttributeError):
+            raise ValueError("Unable to find speeds in world config.")
+        return cls(speed=speed, unit_speed=unit_speed)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = f.read()
+        content = data.lstrip()
+        if content.startswith('{'):
+            return cls.from_dict(json.loads(content))
+        if content.startswith('<?xml') or content.startswith('<config'):
+            return cls.from_config_xml(content)
+        return cls.from_settings_page(data)
+
+    def to_dict(self):
+        return {'speed': self.speed, 'unit_speed': self.unit_speed,
+                'units': self.units}
+
+    @classmethod
+    def from_dict(cls, data):
+        try:
+            return cls(speed=data['speed'], unit_speed=data['unit_speed'],
+                       units=data.get('units'))
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError("Unable to find speeds in world config data.")
+
+    def get_speed_factor(self):
+        return self.speed * self.unit_speed
+
+    def get_unit_stats(self):
+        return {name: (unit['attack'], unit['speed'], unit['carry'])
+                for name, unit in self.units.items()}
+
+    @staticmethod
+    def _to_number(text):
+        # e.g. '0,5' on some of localized servers
+        number = float(text.strip().replace(',', '.'))
+        if number.is_integer():
+            return int(number)
+        return number
+
+    def __str__(self):
+        return "WorldConfig: speed: {speed}, unit_speed: {unit_speed}, " \
+               "units: {units}".format(speed=self.speed,
+                                       unit_speed=self.unit_speed,
+                                       units=sorted(self.units))
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class WorldConfigCache:
+    """
+    Keeps WorldConfig of each game host in a local JSON file, so world
+    settings are requested only once per host.
+
+    Methods:
+
+    get(host):
+        returns cached WorldConfig of a given host (or None)
+    save(host, world_config):
+        saves WorldConfig of a given host
+    """
+
+    def __init__(self, cache_name):
+        self.cache_name = cache_name
+
+    def get(self, host):
+        data = self._load().get(host)
+        if data is not None:
+            try:
+                return WorldConfig.from_dict(data)
+            except ValueError:
+                logging.warning("World config of {host} in cache {name} is "
+                                "corrupted, ignoring it.".format(host=host,
+                                                                 name=self.cache_name))
+
+    def save(self, host, world_config):
+        cache = self._load()
+        data = world_config.to_dict()
+        data['t_of_fetch'] = time.mktime(time.gmtime())
+        cache[host] = data
+        with open(self.cache_name, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+
+    def _load(self):
+        try:
+            with open(self.cache_name, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logging.warning("World config cache {name} is corrupted, "
+                            "ignoring it.".format(name=self.cache_name))
+            return {}
@@ -0,0 +1,199 @@
+"""
+Benchmarks of HTML parsers over pages from settings.TEST_DATA_FOLDER.
+
+For each parser reports ops/sec, p50/p99 latency of a single call and
+peak memory allocated during a call. Results may be saved to a JSON
+baseline & compared with later runs:
+
+    python -m bot.tests.benchmark_parsers --save baseline.json
+    python -m bot.tests.benchmark_parsers --compare baseline.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import warnings
+
+import settings
+from bot.app import locale
+from bot.libs.map_tools import MapParser
+from bot.libs.village_management import VillageManager, PlayerVillage
+from bot.libs.report_management import ReportManager, AttackReport
+from bot.libs.attack_management import AttackHelper
+from bot.libs.patterns import PATTERNS
+
+
+__all__ = ['get_benchmarks', 'run_benchmarks', 'compare_results']
+
+
+HTML_FOLDER = os.path.join(settings.TEST_DATA_FOLDER, 'html')
+
+
+def _read(*path):
+    with open(os.path.join(HTML_FOLDER, *path)) as f:
+        return f.read()
+
+
+def _read_folder(folder, prefix=''):
+    return [(filename, _read(folder, filename)) for filename in
+            sorted(os.listdir(os.path.join(HTML_FOLDER, folder)))
+            if filename.startswith(prefix) and filename.endswith('.html')]
+
+
+def _report_locale(filename):
+    lang = filename[:2]
+    if lang == 'us':
+        lang = 'en'
+    return locale.LOCALE[lang]
+
+
+def get_benchmarks():
+    """
+    Returns mapping {benchmark_name: [callable, ...]}, where each callable
+    parses one page of test data.
+    """
+    map_parser = MapParser()
+    maps = [html for _, html in _read_folder('map_overviews')]
+    overviews = [html for _, html in _read_folder('', 'net_villages_overviews')]
+    train_screens = [html for _, html in _read_folder('', 'train_screen')]
+    report_pages = [html for _, html in _read_folder('reports', 'report_page')]
+    report_pages.extend(html for _, html in
+                        _read_folder(os.path.join('reports', 'report_page_test_set')))
+    single_reports = _read_folder(os.path.join('reports', 'single_report_test_set'))
+    rally_screen = _read('rally_point_screen.html')
+    confirmation_screen = _read('confirmation_screen.html')
+    report_manager = ReportManager(locale=locale.LOCALE['en'])
+    attack_helper = AttackHelper()
+
+    def bind(func, *args):
+        return lambda: func(*args)
+
+    benchmarks = {
+        'MapParser.collect_sector_data':
+            [bind(map_parser.collect_sector_data, html) for html in maps],
+        'VillageManager._get_villages_data':
+            [bind(VillageManager._get_villages_data, html) for html in overviews],
+        'PlayerVillage._get_troops_data':
+            [bind(PlayerVillage._get_troops_data, html) for html in train_screens],
+        'ReportManager.get_report_urls':
+            [bind(report_manager.get_report_urls, html, False)
+             for html in report_pages],
+        'AttackReport':
+            [bind(AttackReport, html, _report_locale(filename))
+             for filename, html in single_reports],
+        'AttackHelper.set_confirmation_token':
+            [bind(attack_helper.set_confirmation_token, rally_screen)],
+        'AttackHelper.get_csrf_token':
+            [bind(AttackHelper.get_csrf_token, confirmation_screen)],
+        'AttackHelper._get_ch_token':
+            [bind(AttackHelper._get_ch_token, confirmation_screen)],
+        'AttackHelper._get_action_id':
+            [bind(AttackHelper._get_action_id, confirmation_screen)],
+    }
+    return benchmarks
+
+
+def _percentile(sorted_values, percent):
+    index = round((len(sorted_values) - 1) * percent / 100)
+    return sorted_values[index]
+
+
+def run_benchmark(calls, rounds):
+    """
+    Runs each of given calls 'rounds' times & returns dict with
+    measurements.
+    """
+    latencies = []
+    for _ in range(rounds):
+        for call in calls:
+            start = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - start)
+    # separate pass: tracemalloc slows down each allocation
+    peak = 0
+    for call in calls:
+        tracemalloc.start()
+        call()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    latencies.sort()
+    return {'calls': len(latencies),
+            'ops_per_sec': round(len(latencies) / sum(latencies), 2),
+            'p50_ms': round(_percentile(latencies, 50) * 1000, 4),
+            'p99_ms': round(_percentile(latencies, 99) * 1000, 4),
+            'peak_kb': round(peak / 1024, 2)}
+
+
+def run_benchmarks(rounds=20, names=None):
+    results = {}
+    for name, calls in get_benchmarks().items():
+        if names and name not in names:
+            continue
+        results[name] = run_benchmark(calls, rounds)
+    return results
+
+
+def compare_results(baseline, current):
+    """
+    Returns mapping {benchmark_name: {metric: current/baseline ratio}}
+    for benchmarks present in both runs.
+    """
+    comparison = {}
+    for name, metrics in current.items():
+        if name not in baseline:
+            continue
+        ratios = {}
+        for metric in ('ops_per_sec', 'p50_ms', 'p99_ms', 'peak_kb'):
+            base_value = baseline[name].get(metric)
+            if base_value:
+                ratios[metric] = round(metrics[metric] / base_value, 3)
+        comparison[name] = ratios
+    return comparison
+
+
+def _print_results(results, comparison=None):
+    header = "{:<40}{:>12}{:>11}{:>11}{:>11}".format('benchmark', 'ops/sec',
+                                                    'p50, ms', 'p99, ms',
+                                                    'peak, KB')
+    print(header)
+    for name, res in results.items():
+        print("{:<40}{:>12}{:>11}{:>11}{:>11}".format(name, res['ops_per_sec'],
+                                                      res['p50_ms'], res['p99_ms'],
+                                                      res['peak_kb']))
+        if comparison and name in comparison:
+            ratios = ', '.join('{}: x{}'.format(metric, ratio) for metric, ratio
+                               in comparison[name].items())
+            print("{:<40}{}".format('', ratios))
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser(description="Benchmark HTML parsers")
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--only', action='append',
+                        help="name of benchmark to run (may be repeated)")
+    parser.add_argument('--save', help="file to save results to (JSON)")
+    parser.add_argument('--compare', help="baseline file (JSON) to compare with")
+    args = parser.parse_args(arguments)
+
+    # Soup complains about implicit parser choice on each call
+    warnings.simplefilter('ignore')
+    results = run_benchmarks(rounds=args.rounds, names=args.only)
+    patterns_stats = PATTERNS.get_stats()
+    comparison = None
+    if args.compare:
+        with open(args.compare) as f:
+            comparison = compare_results(json.load(f), results)
+    _print_results(results, comparison)
+    if patterns_stats['hit_rate'] is not None:
+        print("Regex patterns cache: {hits} hits, {misses} misses, "
+              "hit rate {hit_rate:.4f} ({static_lookups} lookups of static "
+              "patterns)".format(**patterns_stats))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,236 @@
+"""
+Offline stand-in for a game host.
+
+Serves HTML pages from settings.TEST_DATA_FOLDER for the URLs that
+RequestDataProvider builds, so Bot (or RequestManager alone) may be run
+end to end without live game server:
+
+    python -m bot.tests.game_server [number_of_attack_cycles]
+"""
+import os
+import sys
+import time
+import tempfile
+from threading import Thread
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import settings
+from bot.app import locale
+from bot.app.bot import Bot
+from bot.libs.request_management import RequestManager
+
+
+__all__ = ['GameServer', 'OfflineBot', 'measure_attack_cycles']
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is not available before 3.7
+    daemon_threads = True
+
+
+class GameServer:
+    """
+    Local HTTP server that replays saved game screens.
+
+    Routing is done by 'screen' (and some other) query parameters of
+    game.php URL:
+
+        overview_villages => villages overviews screen
+        overview => village overview
+        map => map overview, which is the closest to requested (x, y)
+        train => train screen
+        place => rally point (GET), confirmation screen (POST try=confirm)
+        & rally point again (POST action=command)
+        report => report page (w/o 'view'), single reports in a round-robin
+        order (with 'view')
+
+    as well as world settings page (stat.php?mode=settings).
+
+    Each response carries a real 'Date' header. Number of served requests
+    per screen is kept in .hits.
+    """
+
+    def __init__(self, data_folder=None, port=0):
+        if data_folder is None:
+            data_folder = os.path.join(settings.TEST_DATA_FOLDER, 'html')
+        self.data_folder = data_folder
+        self.pages = self._load_pages(data_folder)
+        self.hits = {}
+        self._report_counter = 0
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', port), self._get_handler())
+        self._thread = None
+
+    @property
+    def host(self):
+        address, port = self._httpd.server_address[:2]
+        return '{address}:{port}'.format(address=address, port=port)
+
+    def start(self):
+        self._thread = Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def get_page(self, method, query):
+        """
+        Returns HTML page (str) for a given request method & parsed
+        query of game.php URL.
+        """
+        screen = query.get('screen', [''])[0]
+        self.hits[screen] = self.hits.get(screen, 0) + 1
+        if screen == 'overview_villages':
+            return self.pages['overviews']
+        elif screen == 'overview':
+            return self.pages['village_overview']
+        elif screen == 'map':
+            x = int(query.get('x', [0])[0])
+            y = int(query.get('y', [0])[0])
+            return self._get_closest_map(x, y)
+        elif screen == 'train':
+            return self.pages['train']
+        elif screen == 'place':
+            if method == 'POST' and query.get('try') == ['confirm']:
+                return self.pages['confirmation']
+            return self.pages['rally_point']
+        elif screen == 'report':
+            if 'view' in query:
+                reports = self.pages['single_reports']
+                report = reports[self._report_counter % len(reports)]
+                self._report_counter += 1
+                return report
+            return self.pages['report_page']
+        elif query.get('mode') == ['settings']:
+            return self.pages['world_settings']
+
+    def _get_closest_map(self, x, y):
+        maps = self.pages['maps']
+        closest = min(maps, key=lambda coords: (coords[0] - x) ** 2 +
+                                               (coords[1] - y) ** 2)
+        return maps[closest]
+
+    def _get_handler(self):
+        server = self
+
+        class GameRequestHandler(BaseHTTPRequestHandler):
+            # keep-alive connections, as the real game host does
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self._reply('GET')
+
+            def do_POST(self):
+                length = int(self.headers.get('content-length', 0))
+                self.rfile.read(length)
+                self._reply('POST')
+
+            def _reply(self, method):
+                url = urlsplit(self.path)
+                page = server.get_page(method, parse_qs(url.query))
+                if page is None:
+                    self.send_error(404)
+                    return
+                body = page.encode()
+                # send_response() also sets 'Date' header
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return GameRequestHandler
+
+    @staticmethod
+    def _load_pages(data_folder):
+        def read(*path):
+            with open(os.path.join(data_folder, *path)) as f:
+                return f.read()
+
+        pages = {'overviews': read('net_villages_overviews-1.html'),
+                 'village_overview': read('village_overview_test_pv_initial.html'),
+                 'train': read('train_screen.html'),
+                 'rally_point': read('rally_point_screen.html'),
+                 'confirmation': read('confirmation_screen.html'),
+                 'report_page': read('reports', 'report_page_test_set',
+                                     'en_report-page_w_new_battle.html'),
+                 'world_settings': read('misc', 'world_settings.html')}
+        maps = {}
+        for filename in os.listdir(os.path.join(data_folder, 'map_overviews')):
+            # e.g. map_overview_211_305.html
+            if filename.startswith('map_overview_'):
+                name = os.path.splitext(filename)[0]
+                x, y = name.split('_')[-2:]
+                maps[(int(x), int(y))] = read('map_overviews', filename)
+        pages['maps'] = maps
+        reports_folder = os.path.join('reports', 'single_report_test_set')
+        pages['single_reports'] = [read(reports_folder, filename) for filename in
+                                   sorted(os.listdir(os.path.join(data_folder,
+                                                                  reports_folder)))
+                                   if filename.startswith('en_')]
+        return pages
+
+
+class OfflineBot(Bot):
+    """
+    Bot that talks to GameServer: uses english locale and does not
+    extract cookies from user's browser.
+    """
+
+    def set_locale(self):
+        self.locale = locale.LOCALE['en']
+
+    def setup_request_manager(self):
+        self.request_manager = RequestManager(host=settings.HOST,
+                                              initial_cookies={},
+                                              main_id=settings.MAIN_VILLAGE_ID,
+                                              locale=self.locale,
+                                              con_attempts=5,
+                                              pool_size=settings.CONNECTION_POOL_SIZE)
+
+
+def measure_attack_cycles(cycles=100):
+    """
+    Runs Bot.attack_cycle() against local GameServer (with settings.DEBUG
+    set to True) & returns a tuple (number of performed cycles,
+    cycles per second).
+    Stops earlier, if there are no attackers left.
+    """
+    server = GameServer().start()
+    saved_settings = {name: getattr(settings, name) for name in
+                      ('HOST', 'DEBUG', 'DATA_FOLDER', 'MAIN_VILLAGE_ID')}
+    try:
+        with tempfile.TemporaryDirectory() as data_folder:
+            settings.HOST = server.host
+            settings.DEBUG = True
+            settings.DATA_FOLDER = data_folder
+            settings.MAIN_VILLAGE_ID = 135083
+            bot = OfflineBot()
+            performed = 0
+            start = time.perf_counter()
+            while performed < cycles:
+                if not bot.village_manager.get_next_attacking_village():
+                    break
+                bot.attack_cycle()
+                performed += 1
+            elapsed = time.perf_counter() - start
+    finally:
+        for name, value in saved_settings.items():
+            setattr(settings, name, value)
+        server.stop()
+    if not elapsed:
+        return performed, 0
+    return performed, performed / elapsed
+
+
+if __name__ == '__main__':
+    cycles_to_run = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    done, rate = measure_attack_cycles(cycles_to_run)
+    print("Attack cycles: {done}, cycles/sec: {rate:.2f}".format(done=done, rate=rate))
@@ -1,11 +1,15 @@
 import unittest
 import os
 import time
-from unittest.mock import Mock, call
+from unittest.mock import Mock, call, patch
 
 import settings
 from bot.libs.attack_management import *
+from bot.libs.common_tools import AttackJournal
 from bot.tests.factories import TargetVillageFactory
+from bot.libs.village_management import TargetVillage, TargetVillageStore
+from bot.libs.village_management import numpy
+from bot.tests.helpers import StorageHelper
 
 
 class TestAttackQueue(unittest.TestCase):
@@ -38,21 +42,22 @@ class TestAttackQueue(unittest.TestCase):
         self.assertIsNone(fresh.last_visited)
         not_fresh_but_ready = village_list[3]
         not_fresh_but_ready.last_visited = 1000
-        not_fresh_but_ready.has_valuable_loot = Mock(return_value=True)
-        not_fresh_but_ready.finished_rest = Mock(return_value=True)
         not_fresh_and_not_ready = village_list[4]
         not_fresh_and_not_ready.last_visited = 1000
-        not_fresh_and_not_ready.has_valuable_loot = Mock(return_value=False)
-        not_fresh_and_not_ready.finished_rest = Mock(return_value=False)
+        is_ready = lambda villa, rest: villa is not_fresh_but_ready
         target_villages = {in_pending_arrival.coords: in_pending_arrival,
                            in_visited.coords: in_visited,
                            fresh.coords: fresh,
                            not_fresh_but_ready.coords: not_fresh_but_ready,
                            not_fresh_and_not_ready.coords: not_fresh_and_not_ready}
 
-        queue.build_queue(pending_arrival=pending_arrival,
-                          target_villages=target_villages,
-                          farm_frequency=3)
+        with patch.object(TargetVillage, 'has_valuable_loot', autospec=True,
+                          side_effect=is_ready), \
+                patch.object(TargetVillage, 'finished_rest', autospec=True,
+                             side_effect=is_ready):
+            queue.build_queue(pending_arrival=pending_arrival,
+                              target_villages=target_villages,
+                              farm_frequency=3)
         self.assertEqual(len(queue.queue), 2)
         self.assertEqual(len(queue.visited_villages), 2)
         self.assertIn(fresh.coords, queue.queue)
@@ -60,6 +65,110 @@ class TestAttackQueue(unittest.TestCase):
         self.assertIn(not_fresh_but_ready.coords, queue.queue)
         self.assertIn(not_fresh_and_not_ready.coords, queue.visited_villages)
 
+
+    def test_get_rest_expiry_times(self):
+        queue = AttackQueue()
+        queue.rest = 2
+        visited = TargetVillageFactory.build_batch(3)
+        visited[0].last_visited = 1000
+        visited[1].last_visited = 2000
+        queue.visited_villages = {villa.coords: villa for villa in visited}
+        queue.untrusted_villages = {visited[1].coords: visited[1]}
+        self.assertEqual(queue.get_rest_expiry_times(),
+                         {visited[0].coords: 1000 + 7200 + 1})
+        self.assertEqual(queue.get_rest_expiry_times([visited[2].coords]), {})
+        # village with valuable loot does not need to finish its rest
+        visited[0].last_visited = time.mktime(time.gmtime()) - 600
+        visited[0].h_rates = [10, 10, 10]
+        visited[0].remaining_capacity = 1000
+        self.assertEqual(queue.get_rest_expiry_times([visited[0].coords]),
+                         {visited[0].coords: 0})
+
+    def test_flush_visited_villages(self):
+        queue = AttackQueue()
+        queue.rest = 1
+        now = time.mktime(time.gmtime())
+        rested, resting, with_loot, untrusted = TargetVillageFactory.build_batch(4)
+        rested.last_visited = now - 7200
+        resting.last_visited = now - 600
+        with_loot.last_visited = now - 600
+        with_loot.h_rates = [10, 10, 10]
+        with_loot.remaining_capacity = 1000
+        untrusted.last_visited = now - 7200
+        queue.untrusted_villages = {untrusted.coords: untrusted}
+        queue.visited_villages = {villa.coords: villa for villa in
+                                  (rested, resting, with_loot, untrusted)}
+
+        with patch.object(AttackQueue, '_is_ready_for_farm', autospec=True,
+                          side_effect=AttackQueue._is_ready_for_farm) as is_ready:
+            queue.flush_visited_villages()
+        # only villages which time has come were checked
+        self.assertEqual(is_ready.call_count, 2)
+        self.assertCountEqual(queue.queue, [rested.coords, with_loot.coords])
+        self.assertCountEqual(queue.visited_villages, [resting.coords, untrusted.coords])
+
+        # the next visit has left a lot of resources in village
+        queue.villages = {resting.coords: resting}
+        queue.update_villages([Mock(coords=resting.coords, t_of_attack=now - 300,
+                                    defended=False, mine_levels=[1, 1, 1],
+                                    remaining_capacity=1000, storage_level=None,
+                                    wall_level=None, looted_capacity=0)])
+        self.assertCountEqual(queue.queue, [rested.coords, with_loot.coords,
+                                            resting.coords])
+        self.assertEqual(list(queue.visited_villages), [untrusted.coords])
+
+    def test_get_available_targets(self):
+        queue = AttackQueue()
+        villages = TargetVillageFactory.build_batch(6)
+        queue.build_queue([villages[1].coords],
+                          {villa.coords: villa for villa in villages},
+                          farm_frequency=1)
+        attacker = Mock(id=1, attack_targets=[(villa.coords, index) for index, villa
+                                              in enumerate(villages)])
+        other_attacker = Mock(id=2, attack_targets=[(villages[2].coords, 1)])
+        available = list(queue.get_available_targets(attacker))
+        # position of target in attacker.attack_targets equals its distance here
+        self.assertEqual(available, [(villages[index], index, index)
+                                     for index in (0, 2, 3, 4, 5)])
+        self.assertEqual(list(queue.get_available_targets(other_attacker)),
+                         [(villages[2], 1, 0)])
+
+        queue.remove_villa_from_queue(villages[2].coords)
+        queue.remove_villa_from_queue(villages[0].coords)
+        self.assertEqual(next(queue.get_available_targets(attacker)), (villages[3], 3, 3))
+        self.assertEqual(list(queue.get_available_targets(other_attacker)), [])
+        # village has rested
+        queue.update_targets({villages[2].coords: villages[2]}, [villages[4].coords])
+        self.assertEqual(list(queue.get_available_targets(attacker)),
+                         [(villages[index], index, index) for index in (2, 3, 5)])
+        self.assertEqual(list(queue.get_available_targets(other_attacker)),
+                         [(villages[2], 1, 0)])
+        # targets of attacker were re-assigned
+        attacker.attack_targets = [(villages[5].coords, 1), (villages[0].coords, 2),
+                                   (villages[3].coords, 3)]
+        self.assertEqual(list(queue.get_available_targets(attacker)),
+                         [(villages[5], 1, 0), (villages[3], 3, 2)])
+        # targets are taken lazily, queue may not change under generator
+        available = queue.get_available_targets(attacker)
+        self.assertEqual(next(available), (villages[5], 1, 0))
+        list(queue.get_available_targets(other_attacker))
+        queue.remove_villa_from_queue(villages[3].coords)
+        with self.assertRaises(RuntimeError):
+            next(available)
+
+    def test_update_targets(self):
+        queue = AttackQueue()
+        villages = TargetVillageFactory.build_batch(3)
+        queue.build_queue([], {villa.coords: villa for villa in villages},
+                          farm_frequency=1)
+        queue.visited_villages = {villages[1].coords: villages[1]}
+        new_village = TargetVillageFactory()
+        queue.update_targets({new_village.coords: new_village},
+                             [villages[0].coords, villages[1].coords])
+        self.assertCountEqual(queue.villages, [villages[2].coords, new_village.coords])
+        self.assertCountEqual(queue.queue, [villages[2].coords, new_village.coords])
+        self.assertEqual(queue.visited_villages, {})
+
     def test_is_ready_for_farm(self):
         queue = AttackQueue()
         villa = TargetVillageFactory()
@@ -69,16 +178,18 @@ class TestAttackQueue(unittest.TestCase):
         self.assertFalse(queue._is_ready_for_farm(villa))
 
         queue.untrusted_villages.pop(villa_coords)
-        villa.finished_rest = Mock(return_value=False)
-        villa.has_valuable_loot = Mock(return_value=False)
-        self.assertFalse(queue._is_ready_for_farm(villa))
+        with patch.object(TargetVillage, 'finished_rest',
+                          return_value=False) as finished_rest, \
+                patch.object(TargetVillage, 'has_valuable_loot',
+                             return_value=False) as has_valuable_loot:
+            self.assertFalse(queue._is_ready_for_farm(villa))
 
-        villa.finished_rest.return_value = True
-        self.assertTrue(queue._is_ready_for_farm(villa))
+            finished_rest.return_value = True
+            self.assertTrue(queue._is_ready_for_farm(villa))
 
-        villa.finished_rest.return_value = False
-        villa.has_valuable_loot.return_value = True
-        self.assertTrue(queue._is_ready_for_farm(villa))
+            finished_rest.return_value = False
+            has_valuable_loot.return_value = True
+            self.assertTrue(queue._is_ready_for_farm(villa))
 
 
 class TestDecisionMaker(unittest.TestCase):
@@ -171,6 +282,62 @@ class TestDecisionMaker(unittest.TestCase):
         self.assertIsNotNone(check)
         self.assertEqual(check, [{'c': 50}, t_on_the_road])
 
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    @patch('bot.libs.attack_management.time')
+    def test_rank_attack_targets(self, time_mock):
+        maker = DecisionMaker()
+        now = time.mktime(time.gmtime())
+        time_mock.mktime.return_value = now
+        villages = TargetVillageFactory.build_batch(30)
+        for index, village in enumerate(villages):
+            village.id = index
+            if index % 3:
+                village.last_visited = now - 600 * index
+                village.h_rates = [50 + index, 60, 70]
+                village.remaining_capacity = 100 * (index % 4)
+        targets = [(village, 2.5 * index) for index, village in enumerate(villages)]
+        troops = {'axe': 100, 'light': 40, 'spy': 5}
+
+        ranked = maker.rank_attack_targets(targets, troops, t_limit=2, insert_spy=True)
+        self.assertTrue(2 < len(ranked) < len(villages))
+        self.assertEqual(ranked[0], maker.get_next_attack_target(targets, troops,
+                                                                 t_limit=2,
+                                                                 insert_spy=True))
+        self.assertEqual(maker.rank_attack_targets(targets, troops, t_limit=2,
+                                                   insert_spy=True, limit=2),
+                         ranked[:2])
+        # the same decisions are made with pre-calculated travel times
+        travel_times = {name: [distance * unit.speed * 60 for _, distance in targets]
+                        for name, unit in maker.units.items()}
+        positioned = [(village, distance, position) for position, (village, distance)
+                      in enumerate(targets)]
+        self.assertEqual(maker.rank_attack_targets(positioned, troops, t_limit=2,
+                                                   insert_spy=True,
+                                                   travel_times=travel_times), ranked)
+        # the same decisions are made in batch for villages in store
+        store = TargetVillageStore(size=len(villages))
+        for village in villages:
+            store.add(village)
+        self.assertEqual(maker.rank_attack_targets(iter(targets), troops, t_limit=2,
+                                                   insert_spy=True), ranked)
+        self.assertEqual(maker.rank_attack_targets(targets, troops, t_limit=2,
+                                                   insert_spy=True, limit=2),
+                         ranked[:2])
+        self.assertEqual(maker.rank_attack_targets(positioned, troops, t_limit=2,
+                                                   insert_spy=True,
+                                                   travel_times=travel_times), ranked)
+        # targets are scored in chunks until limit is reached
+        with patch.object(TargetVillageStore, 'estimate_capacity', autospec=True,
+                          side_effect=TargetVillageStore.estimate_capacity) as estimate, \
+                patch.object(DecisionMaker, 'MIN_CHUNK', 2):
+            self.assertEqual(maker.rank_attack_targets(targets, troops, t_limit=2,
+                                                       insert_spy=True, limit=1),
+                             ranked[:1])
+        scored = set()
+        for estimate_call in estimate.call_args_list:
+            scored.update(estimate_call[0][1])
+        self.assertLess(len(scored), len(villages))
+
     def test_get_troops_map(self):
         maker = DecisionMaker()
         troops_count = {'spy': 20, 'axe': 200, 'light': 200, 'marcher': 100}
@@ -181,6 +348,25 @@ class TestDecisionMaker(unittest.TestCase):
         self.assertEqual(slowest_unit.name, 'axe')
 
 
+class TestAttackPlanner(unittest.TestCase):
+
+    def test_plan(self):
+        planner = AttackPlanner()
+        # 'light' hauls 80, 'axe' hauls 10
+        candidates = {1: [[{'light': 10, 'spy': 1}, 600, (1, 1)],
+                          [{'light': 20, 'spy': 1}, 1200, (2, 2)],
+                          [{'light': 20, 'spy': 1}, 6000, (3, 3)]],
+                      2: [[{'light': 10}, 300, (2, 2)],
+                          [{'light': 10}, 400, (1, 1)],
+                          [{'axe': 50}, 3000, (4, 4)]]}
+        troops = {1: {'light': 30, 'spy': 1}, 2: {'light': 10, 'axe': 100}}
+        schedule = planner.plan(candidates, troops)
+        self.assertEqual(schedule, [(2, [{'light': 10}, 300, (2, 2)]),
+                                    (1, [{'light': 10, 'spy': 1}, 600, (1, 1)]),
+                                    (1, [{'light': 20}, 6000, (3, 3)]),
+                                    (2, [{'axe': 50}, 3000, (4, 4)])])
+
+
 class TestAttackObserver(unittest.TestCase):
 
     def setUp(self):
@@ -254,6 +440,174 @@ class TestAttackObserver(unittest.TestCase):
         self.assertEqual(self.ao.arrival_queue, {(1, 1): 10})
         self.assertEqual(self.ao.return_queue, {1: [20]})
 
+    def test_registered_attacks_are_popped_once(self):
+        now = time.mktime(time.gmtime())
+        self.ao.arrival_queue = {(1, 1): now - 10}
+        self.ao.return_queue = {1: [now - 5]}
+        # (1, 1) was attacked again: previous arrival is outdated
+        self.ao.register_attack(attacker_id=1, coords=(1, 1),
+                                t_of_arrival=now + 10, t_of_return=now + 20)
+        self.ao.register_attack(attacker_id=2, coords=(2, 2),
+                                t_of_arrival=now - 1, t_of_return=now - 1)
+        self.assertEqual(self.ao.is_someone_arrived(), 1)
+        self.assertEqual(self.ao.arrival_queue, {(1, 1): now + 10})
+        self.assertEqual(self.ao.is_someone_arrived(), 0)
+        self.assertEqual(self.ao.is_someone_returned(), [1, 2])
+        self.assertEqual(self.ao.return_queue, {1: [now + 20], 2: []})
+        self.assertEqual(self.ao.is_someone_returned(), [])
+
+
+class TestAttackManager(unittest.TestCase):
+
+    def setUp(self):
+        self.helper = StorageHelper()
+        storage_folder = self.helper.create_test_storage()
+        self.storage_name = os.path.join(storage_folder, 'test_storage')
+        self.journal_name = os.path.join(storage_folder, 'test_journal')
+
+    def tearDown(self):
+        self.helper.clean_test_storage()
+
+    def get_attack_manager(self):
+        return AttackManager(storage_type='local_file',
+                             storage_name=self.storage_name,
+                             journal_name=self.journal_name)
+
+    def test_get_next_attack_target_uses_alternatives(self):
+        attack_manager = self.get_attack_manager()
+        villages = TargetVillageFactory.build_batch(4)
+        attack_manager.attack_queue.queue = {villa.coords: villa for villa in villages}
+        attack_manager.decision_maker = Mock(spec=DecisionMaker)
+        ranked = [[{'axe': 10 * (index + 1)}, 600, villa.coords]
+                  for index, villa in enumerate(villages)]
+        attack_manager.decision_maker.rank_attack_targets.return_value = ranked
+        attacker = Mock(id=1, attack_targets=[])
+        attacker.get_troops_count.return_value = {'axe': 30}
+
+        self.assertEqual(attack_manager.get_next_attack_target(attacker, 3, True),
+                         ranked[0])
+        attack_manager.attack_queue.remove_villa_from_queue(villages[0].coords)
+        # villages[1] was attacked by another attacker, there are not
+        # enough troops for villages[3]
+        attack_manager.attack_queue.remove_villa_from_queue(villages[1].coords)
+        self.assertEqual(attack_manager.get_next_attack_target(attacker, 3, True),
+                         ranked[2])
+        self.assertEqual(attack_manager.decision_maker.rank_attack_targets.call_count, 1)
+        attack_manager.get_next_attack_target(attacker, 3, True)
+        self.assertEqual(attack_manager.decision_maker.rank_attack_targets.call_count, 2)
+
+        # expired alternatives are not used
+        attack_manager.attack_queue.queue = {villa.coords: villa for villa in villages}
+        t_of_decision, alternatives = attack_manager.alternatives[attacker.id]
+        attack_manager.alternatives[attacker.id] = \
+            (t_of_decision - attack_manager.ALTERNATIVES_TTL - 1, alternatives)
+        self.assertEqual(attack_manager.get_next_attack_target(attacker, 3, True),
+                         ranked[0])
+        self.assertEqual(attack_manager.decision_maker.rank_attack_targets.call_count, 3)
+
+    def test_get_planned_attack(self):
+        attack_manager = self.get_attack_manager()
+        villages = TargetVillageFactory.build_batch(3)
+        attack_manager.attack_queue.queue = {villa.coords: villa for villa in villages}
+        attack_manager.decision_maker = Mock(spec=DecisionMaker)
+        attack_manager.decision_maker.rank_attack_targets.side_effect = [
+            [[{'axe': 10}, 600, villages[0].coords]],
+            [[{'axe': 10}, 300, villages[1].coords],
+             [{'axe': 10}, 400, villages[2].coords]]]
+        attackers = {1: Mock(attack_targets=[]), 2: Mock(attack_targets=[])}
+        for attacker in attackers.values():
+            attacker.get_troops_count.return_value = {'axe': 20}
+
+        self.assertEqual(attack_manager.get_planned_attack(attackers, 3, True),
+                         (2, [{'axe': 10}, 300, villages[1].coords]))
+        # the rest of schedule is kept until targets are updated
+        self.assertEqual(len(attack_manager.attack_schedule), 2)
+        # planned target has left queue
+        attack_manager.attack_queue.remove_villa_from_queue(villages[2].coords)
+        self.assertEqual(attack_manager.get_planned_attack(attackers, 3, True),
+                         (1, [{'axe': 10}, 600, villages[0].coords]))
+        self.assertEqual(attack_manager.decision_maker.rank_attack_targets.call_count, 2)
+
+        attack_manager.attack_schedule = [(1, [{'axe': 10}, 600, (1, 1)])]
+        attack_manager.refresh_attack_queue()
+        self.assertEqual(attack_manager.attack_schedule, [])
+
+    def test_get_planned_attack_rebuilds_stale_schedule(self):
+        attack_manager = self.get_attack_manager()
+        villages = TargetVillageFactory.build_batch(3)
+        attack_manager.attack_queue.queue = {villa.coords: villa for villa in villages}
+        attacker = Mock(attack_targets=[])
+        attacker.get_troops_count.return_value = {'axe': 20}
+        attack_manager.plan_attacks = Mock(side_effect=lambda *args: [
+            (1, [{'axe': 10}, 600, villages[1].coords])])
+        # the rest of schedule is not valid anymore: it is made again once
+        attack_manager.attack_schedule = [(1, [{'axe': 10}, 600, (1, 1)]),
+                                          (1, [{'axe': 30}, 600, villages[0].coords])]
+        attack_manager.t_of_schedule = time.mktime(time.gmtime())
+        self.assertEqual(attack_manager.get_planned_attack({1: attacker}, 3, True),
+                         (1, [{'axe': 10}, 600, villages[1].coords]))
+        self.assertEqual(attack_manager.plan_attacks.call_count, 1)
+        attack_manager.attack_queue.remove_villa_from_queue(villages[1].coords)
+        self.assertIsNone(attack_manager.get_planned_attack({1: attacker}, 3, True))
+        self.assertEqual(attack_manager.plan_attacks.call_count, 2)
+        attack_manager.attack_queue.queue = {villa.coords: villa for villa in villages}
+
+        # old schedule is not used
+        attack_manager.attack_schedule = [(1, [{'axe': 10}, 600, villages[0].coords])]
+        attack_manager.t_of_schedule = time.mktime(time.gmtime()) - \
+            attack_manager.ALTERNATIVES_TTL - 1
+        self.assertEqual(attack_manager.get_planned_attack({1: attacker}, 3, True),
+                         (1, [{'axe': 10}, 600, villages[1].coords]))
+        self.assertEqual(attack_manager.plan_attacks.call_count, 3)
+
+    def test_journal_is_replayed(self):
+        t_of_attack = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
+        now = AttackManager._convert_t_to_seconds(t_of_attack)
+        villages = TargetVillageFactory.build_batch(4)
+        target_villages = {villa.coords: villa for villa in villages}
+        attack_manager = self.get_attack_manager()
+        attack_manager.build_attack_queue(dict(target_villages), farm_frequency=1)
+        self.assertFalse(attack_manager.journal_replayed)
+        saved_coords = villages[0].coords
+        attack_manager.register_attack(1, saved_coords, t_of_attack,
+                                       t_on_the_road=600)
+        attack_manager.save_registered_attacks()
+        attack_manager.clear_journal()
+
+        # not saved to storage, 'crash' happens after
+        attack_manager.attack_observer.register_attack(1, villages[1].coords,
+                                                       now + 10, now + 20)
+        report = Mock(coords=villages[2].coords, t_of_attack=now - 100,
+                      defended=False, mine_levels=None, remaining_capacity=None,
+                      storage_level=None, wall_level=None, looted_capacity=None)
+        defended_report = Mock(coords=villages[3].coords, t_of_attack=now - 7200,
+                               defended=True, mine_levels=None,
+                               remaining_capacity=None, storage_level=None,
+                               wall_level=None, looted_capacity=None)
+        attack_manager.update_attack_targets([report, defended_report])
+        attack_manager.journal.close()
+
+        attack_manager = self.get_attack_manager()
+        attack_manager.build_attack_queue(dict(target_villages), farm_frequency=1)
+        arrivals, returns = attack_manager.get_registered_attacks()
+        self.assertEqual(arrivals, {saved_coords: now + 600,
+                                    villages[1].coords: now + 10})
+        self.assertEqual(returns, {1: [now + 1200, now + 20]})
+        # journaled stats are used & village is still resting
+        restored_village = attack_manager.attack_queue.villages[villages[2].coords]
+        self.assertEqual(restored_village.last_visited, now - 100)
+        # untrusted village has finished to rest, but it is not farmed
+        self.assertEqual(list(attack_manager.attack_queue.untrusted_villages),
+                         [villages[3].coords])
+        self.assertEqual(attack_manager.attack_queue.queue, {})
+        self.assertTrue(attack_manager.journal_replayed)
+
+        # journal is compacted to what storage does not keep
+        attack_manager.clear_journal()
+        self.assertEqual(attack_manager.journal.replay(),
+                         [(AttackJournal.UNTRUSTED, villages[3].coords)])
+        attack_manager.journal.close()
+
 
 class TestAttackHelper(unittest.TestCase):
 
@@ -1,10 +1,15 @@
+import os
 import unittest
 from unittest.mock import patch, call
 from unittest.mock import Mock
 
 import settings
 from bot.tests.factories import PlayerVillageFactory
+from bot.tests.helpers import StorageHelper
 from bot.app.bot import Bot
+from bot.libs.event_scheduler import EventScheduler
+from bot.libs.world_config import WorldConfig
+from bot.libs.map_tools import MapCrawler, MapSectorCache
 
 
 class TestBot(unittest.TestCase):
@@ -13,9 +18,12 @@ class TestBot(unittest.TestCase):
         @patch.object(Bot, 'setup_report_manager')
         @patch.object(Bot, 'setup_attack_manager')
         @patch.object(Bot, 'setup_village_manager')
+        @patch.object(Bot, 'setup_world_config')
         @patch.object(Bot, 'setup_request_manager')
-        def setup_bot(patched_rm, patched_vm, patched_am, pacthed_report, patched_ah):
+        def setup_bot(patched_rm, patched_wc, patched_vm, patched_am, pacthed_report,
+                      patched_ah):
             bot =  Bot()
+            bot.world_config = WorldConfig()
             return bot
         settings.DEBUG = True
         self.bot = setup_bot()
@@ -24,137 +32,236 @@ class TestBot(unittest.TestCase):
         settings.DEBUG = False
 
     def test_get_map_data(self):
-        self.bot._get_map_overview = Mock()
-        # 1 case: ._get_map_data is called with empty list
-        # of farming centers. expected: return value = empty dict,
-        # map overview was not requested.
-        map_data = self.bot._get_map_data([], map_depth=10)
-        self.assertEqual(map_data, {})
-        self.assertEqual(len(self.bot._get_map_overview.method_calls), 0)
-        # 2 case: ._get_map_data is called with 2 farming
-        # centers, that belong to the same sector & with map_depth=1
-        # expected: ._get_map_overview method is called once (for 1st
-        # farming center); no calls to MapMath.get_area_corners method;
-        # return value = merged sectors data.
-        with patch('bot.app.bot.MapMath', autospec=True) as map_math:
-            distinct_1 = PlayerVillageFactory(village_id=1, coords=(1, 1), name="1")
-            distinct_2 = PlayerVillageFactory(village_id=2, coords=(2, 2), name="2")
-            distinct_centers = [distinct_1, distinct_2]
-            # set return value for .collect_sectors_data of map_parser,
-            # so both centers are in the same sector
-            self.bot.map_parser = Mock()
-            self.bot.map_parser.collect_sector_data.return_value = \
-                [{(1, 1): ['1001'], (2, 2): ['1002'], (3, 3): ['1003']},
-                 {(4, 4): ['1004'], (5, 5): ['1005']},
-                 {(8, 8): ['1008'], (10, 10): ['1010'], (6, 6): ['1006']},
-                 {(0, 0): ['10000'], (0, 1000): ['10001'], (1000, 0): ['10002'],
-                  (1000, 1000): ['10003']}]
-            expected_return_value = {(1, 1): ['1001'], (2, 2): ['1002'],
-                                     (3, 3): ['1003'], (4, 4): ['1004'],
-                                     (5, 5): ['1005'], (6, 6): ['1006'],
-                                     (8, 8): ['1008'], (10, 10): ['1010'],
-                                     (0, 0): ['10000'], (0, 1000): ['10001'],
-                                     (1000, 0): ['10002'], (1000, 1000): ['10003']}
-
-            map_data = self.bot._get_map_data(distinct_centers, map_depth=1)
-            self.assertEqual(map_data, expected_return_value)
-            calls = self.bot._get_map_overview.mock_calls
-            self.assertEqual(len(calls), 1)
-            # .get_map_overview() was called with x=1,y=1,id=1 (first farming center)
-            self.assertIn(call(1, 1, 1), calls)
-            # refresh calls to _get_map_overview
-            self.bot._get_map_overview.mock_calls = []
-            # 3 case: 2 farming centers (same sector), map_depth=2.
-            # expected: _get_map_overview is called 5 times (center +
-            # 4 area corners. return value = merged sectors data
-            map_math.get_area_corners.return_value = [(0, 0), (0, 1000),
-                                                      (1000, 0), (1000, 1000)]
-            map_data = self.bot._get_map_data(distinct_centers, map_depth=2)
-            self.assertEqual(map_data, expected_return_value)
-            calls = self.bot._get_map_overview.mock_calls
-            self.assertEqual(len(calls), 5)
-            self.assertIn(call(1, 1, 1), calls)
-            self.assertIn(call(10000, 0, 0), calls)
-            self.assertIn(call(10001, 0, 1000), calls)
-            self.assertIn(call(10002, 1000, 0), calls)
-            self.assertIn(call(10003, 1000, 1000), calls)
-            # refresh calls to _get_map_overview
-            self.bot._get_map_overview.mock_calls = []
-            # 4 case: 2 farming centers in distinct sectors, map_depth=2.
-            # expected: _get_map_overview is called 10 times (each center &
-            # 4 area corners for each center. return value = merged sectors data
-            self.bot.map_parser.collect_sector_data.return_value = \
-                [{(1, 1): ['1001'], (3, 3): ['1003'], (1000, 1000): ['10003']},
-                 {(2, 2): ['1002'], (4, 4): ['1004'], (5, 5): ['1005']},
-                 {(8, 8): ['1008'], (10, 10): ['1010'], (6, 6): ['1006']},
-                 {(0, 0): ['10000'], (0, 1000): ['10001'], (1000, 0): ['10002']}]
-            map_data = self.bot._get_map_data(distinct_centers, map_depth=2)
-            self.assertEqual(map_data, expected_return_value)
-            calls = self.bot._get_map_overview.mock_calls
-            expected_calls = [call(1, 1, 1),
-                              call(2, 2, 2),
-                              call(10000, 0, 0),
-                              call(10000, 0, 0),
-                              call(10001, 0, 1000),
-                              call(10001, 0, 1000),
-                              call(10002, 1000, 0),
-                              call(10002, 1000, 0),
-                              call(10003, 1000, 1000),
-                              call(10003, 1000, 1000)]
-            self.assertCountEqual(expected_calls, calls)
-
-    def test_merge_sectors_data(self):
-        sectors_data_unique = [{(1, 1): 'test11', (2, 2): 'test22'},
-                               {(3, 3): 'test33', (4, 4): 'test44'}]
-        expected = {(1, 1): 'test11', (2, 2): 'test22',
-                    (3, 3): 'test33', (4, 4): 'test44'}
-        actual = self.bot._merge_sectors_data(sectors_data_unique)
-        self.assertTrue(expected, actual)
-
-        sectors_data_non_unique = [{(1, 1): 'test11', (2, 2): 'test22'},
-                                   {(1, 1): 'test33', (4, 4): 'test44'}]
-        expected = {(1, 1): 'test33', (2, 2): 'test22',  (4, 4): 'test44'}
-        actual = self.bot._merge_sectors_data(sectors_data_non_unique)
-        self.assertTrue(expected, actual)
-
-    def test_filter_distinct_centers(self):
-        """
-        Possible situations:
-        1) All farming centers lie in the same sector as
-        current attacker: expected result = [] (empty list)
-        2) All farming centers lie in different sectors
-        from attacker: expected result = list with all centers,
-        current attacker not in returned list
-        3) Some farming centers do lie in the same sector as
-        current attacker and some centers do not. expected
-        return: list with centers that do not lie in attacker's
-        sector, attacker is not in returned list.
-        Expected returned type = list of tuples, where each tuple
-        is (x, y) coordinates
-        """
-        current_attacker = (1, 1)
-        attacker_a = PlayerVillageFactory(coords=(2, 2), village_id=2, name="a")
-        attacker_b = PlayerVillageFactory(coords=(3, 3), village_id=3, name="b")
-        attacker_c = PlayerVillageFactory(coords=(4, 4), village_id=4, name="c")
-        attacker_d = PlayerVillageFactory(coords=(5, 5), village_id=5, name="d")
-        centers = [attacker_a, attacker_b, attacker_c, attacker_d]
-        # some non-centers point added for plausibility
-        all_in_one_data = [{(1, 1): '', (2, 2): '', (3, 3): '', (4, 4): '', (5, 5): ''},
-                           {(6, 6): '', (7, 7): ''}]
-        distinct_centers = self.bot._filter_distinct_centers(
-            current_attacker, centers, all_in_one_data)
-        self.assertEqual(distinct_centers, [])
-
-        all_in_separate = [{(1, 1): '', (10, 10): ''},
-                           {(2, 2): '', (3, 3): ''},
-                           {(4, 4): '', (8, 8): '', (10, 10): '', (5, 5): ''}]
-        distinct_centers = self.bot._filter_distinct_centers(
-            current_attacker, centers, all_in_separate)
-        self.assertCountEqual(distinct_centers, centers)
-
-        in_same_and_separate = [{(1, 1): '', (2, 2): '', (3, 3): ''},
-                                {(4, 4): '', (7, 7): '', (9, 9): ''},
-                                {(5, 5): '', (6, 6): ''}]
-        distinct_centers = self.bot._filter_distinct_centers(
-            current_attacker, centers, in_same_and_separate)
-        self.assertCountEqual(distinct_centers, [attacker_c, attacker_d])
+        # overview requested at (x, y) contains 2x2 sectors around it
+        def collect_sectors(overview):
+            x, y = overview
+            origins = [(sx, sy) for sx in (x // 20 * 20 - 20, x // 20 * 20)
+                       for sy in (y // 20 * 20 - 20, y // 20 * 20)]
+            return {origin: {(origin[0] + 1, origin[1] + 1): [str(origin)]}
+                    for origin in origins}
+
+        self.bot.map_parser = Mock()
+        self.bot.map_parser.collect_sectors.side_effect = collect_sectors
+        self.bot._get_map_overview = Mock(side_effect=lambda village_id, x, y: (x, y))
+        self.bot.map_cache = Mock()
+        # 1 case: no farming centers: map overview was not requested.
+        self.assertEqual(self.bot._get_map_data([], radius=10), {})
+        self.assertEqual(self.bot._get_map_overview.call_count, 0)
+
+        # 2 case: 2 farming centers in the same sector, small radius:
+        # only one overview is requested
+        center_1 = PlayerVillageFactory(village_id=1, coords=(105, 105), name="1")
+        center_2 = PlayerVillageFactory(village_id=2, coords=(110, 110), name="2")
+        map_data = self.bot._get_map_data([center_1, center_2], radius=4)
+        self.assertEqual(self.bot._get_map_overview.mock_calls, [call(1, 105, 105)])
+        self.assertCountEqual(map_data, [(81, 81), (81, 101), (101, 81), (101, 101)])
+        self.assertEqual(self.bot.map_cache.update_sectors.call_count, 1)
+
+        # 3 case: larger radius: all 9 sectors around centers are collected,
+        # but each of them is requested only once
+        self.bot._get_map_overview.reset_mock()
+        map_data = self.bot._get_map_data([center_1, center_2], radius=20)
+        for x in (81, 101, 121):
+            for y in (81, 101, 121):
+                self.assertIn((x, y), map_data)
+        requested = [(x, y) for _, (_, x, y), _ in
+                     self.bot._get_map_overview.mock_calls]
+        requested_origins = [(x // 20 * 20, y // 20 * 20) for x, y in requested]
+        self.assertEqual(len(requested_origins), len(set(requested_origins)))
+        self.assertLess(len(requested), 9)
+
+    def test_attack_next_schedules_events(self):
+        bot = self.bot
+        bot.village_manager = Mock()
+        bot.attack_manager = Mock()
+        bot.send_attack = Mock(return_value='Sun, 10 Nov 2013 07:30:32 GMT')
+        attacker = PlayerVillageFactory()
+        bot.village_manager.get_next_attacking_village.return_value = attacker
+        bot.attack_manager.get_next_attack_target.return_value = \
+            [{'light': 10}, 600, (1, 1)]
+        bot.attack_manager.register_attack.return_value = (1600, 2200)
+
+        self.assertTrue(bot.attack_next())
+        self.assertEqual(bot.event_scheduler.pop_due_events(),
+                         [(EventScheduler.ARRIVAL, (1, 1)),
+                          (EventScheduler.RETURN, attacker.id)])
+
+        # attack was not sent: attacker is disabled, nothing is registered
+        bot.send_attack.return_value = None
+        self.assertFalse(bot.attack_next())
+        bot.village_manager.disable_farming_village.assert_called_once_with(attacker.id)
+        bot.attack_manager.register_attack.assert_called_once()
+        bot.send_attack.return_value = 'Sun, 10 Nov 2013 07:30:32 GMT'
+
+        bot.attack_manager.get_next_attack_target.return_value = None
+        self.assertFalse(bot.attack_next())
+        bot.village_manager.disable_farming_village.assert_called_with(attacker.id,
+                                                                       no_targets=True)
+        bot.village_manager.get_next_attacking_village.return_value = None
+        self.assertIsNone(bot.attack_next())
+        self.assertEqual(len(bot.event_scheduler), 0)
+
+    def test_attack_next_planned(self):
+        bot = self.bot
+        bot.village_manager = Mock()
+        bot.attack_manager = Mock()
+        bot.send_attack = Mock(return_value='Sun, 10 Nov 2013 07:30:32 GMT')
+        bot.attack_manager.get_planned_attack.return_value = \
+            (1000, [{'light': 10}, 600, (1, 1)])
+        bot.attack_manager.register_attack.return_value = (1600, 2200)
+
+        with patch.object(settings, 'PLAN_ATTACKS', True):
+            self.assertTrue(bot.attack_next())
+            bot.send_attack.assert_called_once_with(1000, coords=(1, 1),
+                                                    troops={'light': 10})
+            bot.village_manager.update_troops_count.assert_called_once_with(
+                1000, {'light': 10})
+            bot.attack_manager.get_planned_attack.return_value = None
+            self.assertIsNone(bot.attack_next())
+        bot.village_manager.get_next_attacking_village.assert_not_called()
+
+    def test_event_handlers(self):
+        bot = self.bot
+        bot.active = True
+        bot.village_manager = Mock()
+        bot.attack_manager = Mock()
+        bot.get_new_reports = Mock(return_value=[Mock(coords=(1, 1))])
+        bot._get_train_screen = Mock(return_value='train_screen')
+        bot.send_attacks = Mock()
+        bot.attack_manager.get_new_arrivals.side_effect = [1, 0]
+        bot.attack_manager.get_new_returns.return_value = [1000]
+        bot.attack_manager.get_rest_expiry_times.return_value = {(1, 1): 3600}
+        scheduler = bot.event_scheduler
+        scheduler.schedule(0, EventScheduler.ARRIVAL, (1, 1))
+        scheduler.schedule(0, EventScheduler.ARRIVAL, (2, 2))
+        scheduler.schedule(0, EventScheduler.RETURN, 1000)
+
+        self.assertEqual(scheduler.run_pending(), 3)
+        # the second arrival found nothing to do
+        bot.get_new_reports.assert_called_once_with(1)
+        bot.attack_manager.get_rest_expiry_times.assert_called_once_with([(1, 1)])
+        bot.village_manager.refresh_village_troops.\
+            assert_called_once_with(1000, 'train_screen')
+        self.assertEqual(bot.send_attacks.call_count, 2)
+        self.assertEqual(scheduler.get_next_event_t(), 3600)
+
+        # villages that have finished to rest return to queue: attackers
+        # disabled for lack of targets are enabled before sending attacks
+        manager = Mock()
+        manager.attach_mock(bot.attack_manager.refresh_attack_queue, 'refresh')
+        manager.attach_mock(bot.village_manager.enable_idle_villages, 'enable')
+        manager.attach_mock(bot.send_attacks, 'send')
+        bot.on_rest_expiry((1, 1))
+        self.assertEqual(manager.mock_calls, [call.refresh(), call.enable(),
+                                              call.send()])
+
+    def test_get_new_reports(self):
+        bot = self.bot
+        bot.report_manager = Mock(last_report_id=None)
+        bot._get_reports_page = Mock(return_value='report_page')
+        bot._get_report = Mock(side_effect=lambda url: url)
+        bot.report_manager.build_reports.side_effect = \
+            lambda htmls: [Mock(status='green', url=html) for html in htmls]
+        bot.report_manager.get_new_report_urls.return_value = ([(1, 'url_1')],
+                                                               False)
+        # the last report is unknown: number of pages is guessed
+        reports = bot.get_new_reports(new_arrivals=13)
+        self.assertEqual(len(reports), 2)
+        bot._get_reports_page.assert_has_calls([call(0), call(12)])
+        bot.report_manager.save_last_report_id.assert_called_once_with()
+
+        # pages are requested until the last report is reached
+        bot._get_reports_page.reset_mock()
+        bot.report_manager.last_report_id = 1
+        bot.report_manager.get_new_report_urls.side_effect = [
+            ([(4, 'url_4'), (3, 'url_3')], False), ([(2, 'url_2')], True)]
+        reports = bot.get_new_reports(new_arrivals=1)
+        self.assertEqual([report.url for report in reports],
+                         ['url_4', 'url_3', 'url_2'])
+        bot._get_reports_page.assert_has_calls([call(0), call(12)])
+        bot.report_manager.mark_parsed.assert_has_calls([call(4), call(3), call(2)])
+
+        # the last report was not found (e.g. deleted): paging is limited
+        bot._get_reports_page.reset_mock()
+        bot.report_manager.get_new_report_urls.side_effect = None
+        bot.report_manager.get_new_report_urls.return_value = ([(5, 'url_5')],
+                                                               False)
+        bot.get_new_reports(new_arrivals=1)
+        self.assertEqual(bot._get_reports_page.call_count,
+                         1 + bot.EXTRA_REPORT_PAGES)
+
+    def test_on_map_refresh(self):
+        bot = self.bot
+        bot.village_manager = Mock()
+        bot.attack_manager = Mock()
+        bot.map_cache = Mock()
+        bot.map_parser = Mock()
+        bot.send_attacks = Mock()
+        bot._get_map_overview = Mock(return_value='map_overview')
+        bot.map_cache.get_origins.return_value = {(0, 0), (20, 0), (40, 0),
+                                                  (960, 0), (980, 0)}
+        bot.map_cache.get_stale_origins.return_value = [(0, 0), (20, 0), (40, 0)]
+        bot.map_cache.get_next_expiry.return_value = 5000
+        # the 1st overview contains 2 of stale sectors
+        bot.map_parser.collect_sectors.side_effect = [
+            {(0, 0): {}, (20, 0): {}}, {(40, 0): {}}]
+        bot.map_cache.update_sectors.side_effect = [({(1, 1): ['1']}, []),
+                                                    ({}, [(41, 1)])]
+        new_targets = {(1, 1): Mock()}
+        bot.village_manager.apply_map_delta.return_value = (new_targets, [(41, 1)])
+
+        bot.on_map_refresh()
+        # overviews are requested at centers of stale sectors
+        bot._get_map_overview.assert_has_calls([call(settings.MAIN_VILLAGE_ID, 10, 10),
+                                                call(settings.MAIN_VILLAGE_ID, 50, 10)])
+        self.assertEqual(bot._get_map_overview.call_count, 2)
+        self.assertEqual(bot.village_manager.apply_map_delta.call_args[0],
+                         ({(1, 1): ['1']}, [(41, 1)]))
+        bot.attack_manager.update_targets.assert_called_once_with(new_targets,
+                                                                  [(41, 1)])
+        bot.send_attacks.assert_called_once_with()
+        bot.village_manager.enable_idle_villages.assert_called_once_with()
+        self.assertEqual(bot.event_scheduler.get_next_event_t(), 5000)
+        bot.map_cache.touch_sectors.assert_not_called()
+
+        # stale sector is absent from its overview (e.g. beyond the edge
+        # of map): it is marked as fetched, so it is not re-fetched at once
+        bot.map_cache.get_stale_origins.return_value = [(980, 0)]
+        bot.map_parser.collect_sectors.side_effect = [{(960, 0): {}}]
+        bot.map_cache.update_sectors.side_effect = [({}, [])]
+        bot.on_map_refresh()
+        bot.map_cache.touch_sectors.assert_called_once_with([(980, 0)])
+
+    def test_on_map_refresh_keeps_cached_area(self):
+        # overview requested at (x, y) contains 2x2 sectors: the sector
+        # of (x, y) & sectors above & to the left of it
+        def collect_sectors(overview):
+            x, y = overview
+            origins = [(sx, sy) for sx in (x // 20 * 20 - 20, x // 20 * 20)
+                       for sy in (y // 20 * 20 - 20, y // 20 * 20)]
+            return {origin: {(origin[0] + 1, origin[1] + 1): [str(origin)]}
+                    for origin in origins}
+
+        helper = StorageHelper()
+        storage_folder = helper.create_test_storage()
+        self.addCleanup(helper.clean_test_storage)
+        bot = self.bot
+        bot.village_manager = Mock()
+        bot.attack_manager = Mock()
+        bot.send_attacks = Mock()
+        bot.village_manager.apply_map_delta.return_value = ({}, [])
+        bot.map_parser = Mock()
+        bot.map_parser.collect_sectors.side_effect = collect_sectors
+        bot._get_map_overview = Mock(side_effect=lambda village_id, x, y: (x, y))
+        # all sectors are stale right after refresh
+        bot.map_cache = MapSectorCache(os.path.join(storage_folder, 'map_cache'),
+                                       ttl=0)
+        bot.map_origins = MapCrawler.get_sector_origins([(210, 310)], 15)
+        bot.map_cache.update_sectors(MapCrawler.split_to_sectors({}, bot.map_origins),
+                                     t_of_fetch=0)
+
+        for _ in range(2):
+            bot.on_map_refresh()
+            self.assertEqual(bot.map_cache.get_origins(), bot.map_origins)
+        for _, (_, x, y), _ in bot._get_map_overview.mock_calls:
+            self.assertEqual((x % 20, y % 20), (10, 10))
@@ -7,6 +7,8 @@ import shutil
 import settings
 from bot.libs.common_tools import LocalStorage
 from bot.libs.common_tools import Storage
+from bot.libs.common_tools import SQLiteStorage
+from bot.libs.common_tools import AttackJournal
 from bot.libs.common_tools import CookiesExtractor
 from bot.tests.helpers import StorageHelper
 from bot.tests.factories import TargetVillageFactory
@@ -27,6 +29,32 @@ class TestStorage(unittest.TestCase):
                                  storage_name=self.storage_name)
         self.assertIsInstance(map_storage.storage_processor, LocalStorage)
 
+    def test_init_with_sqlite_processor(self):
+        map_storage = Storage(storage_type='sqlite',
+                              storage_name=self.storage_name)
+        self.assertIsInstance(map_storage.storage_processor, SQLiteStorage)
+        # sqlite file does not collide with shelve file of the same name
+        self.assertEqual(map_storage.storage_processor.storage_name,
+                         self.storage_name + '.sqlite')
+
+    def test_sqlite_migrates_from_shelve(self):
+        local_storage = LocalStorage(self.storage_name)
+        test_villages = TargetVillageFactory.build_batch(2)
+        local_storage.update_villages({village.coords: village
+                                       for village in test_villages})
+        local_storage.save_last_report_id(65471139)
+
+        map_storage = Storage(storage_type='sqlite',
+                              storage_name=self.storage_name)
+        self.addCleanup(map_storage.close)
+        self.assertCountEqual(map_storage.get_saved_villages(),
+                              [village.coords for village in test_villages])
+        self.assertEqual(map_storage.get_last_report_id(), 65471139)
+        # shelve file is migrated only once
+        map_storage.close()
+        local_storage.save_last_report_id(65471140)
+        self.assertEqual(map_storage.get_last_report_id(), 65471139)
+
     def test_init_with_non_existing_processor(self):
         self.assertRaises(NotImplementedError, Storage, 'not_implemented', 'test')
 
@@ -121,6 +149,152 @@ class TestLocalStorage(unittest.TestCase):
         self.assertIn('returns', manual_storage)
         self.assertEqual(manual_storage['returns'], save_data_returns)
 
+    def test_last_report_id(self):
+        storage = LocalStorage(self.storage_name)
+        self.assertIsNone(storage.get_last_report_id())
+        storage.save_last_report_id(65471139)
+        self.assertEqual(storage.get_last_report_id(), 65471139)
+
+
+class TestSQLiteStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.helper = StorageHelper()
+        self.storage_folder = self.helper.create_test_storage()
+        self.storage_name = os.path.join(self.storage_folder, 'test_storage.db')
+        self.storage = SQLiteStorage(self.storage_name)
+
+    def tearDown(self):
+        self.storage.close()
+        self.helper.clean_test_storage()
+
+    def test_update_villages(self):
+        self.assertEqual(self.storage.get_saved_villages(), {})
+        test_villages = TargetVillageFactory.build_batch(5)
+        test_villages[0].visits_history = [(2000, 300), (1000, 200)]
+        save_data = {village.coords: village for village in test_villages}
+        self.storage.update_villages(save_data)
+
+        saved_villages = self.storage.get_saved_villages()
+        self.assertCountEqual(saved_villages, save_data)
+        saved_village = saved_villages[test_villages[0].coords]
+        self.assertEqual(saved_village.id, test_villages[0].id)
+        self.assertEqual(saved_village.visits_history, [(2000, 300), (1000, 200)])
+        # given objects were not changed
+        self.assertEqual(test_villages[0].visits_history, [(2000, 300), (1000, 200)])
+
+        # only given villages are updated
+        village = test_villages[0]
+        village.mine_levels = [10, 10, 10]
+        village.last_visited = 3000
+        village.visits_history.insert(0, (3000, 100))
+        self.storage.update_villages({village.coords: village})
+        saved_villages = self.storage.get_saved_villages()
+        self.assertEqual(len(saved_villages), 5)
+        saved_village = saved_villages[village.coords]
+        self.assertEqual(saved_village.mine_levels, [10, 10, 10])
+        self.assertEqual(saved_village.last_visited, 3000)
+        self.assertEqual(saved_village.visits_history,
+                         [(3000, 100), (2000, 300), (1000, 200)])
+
+        # only new visits are inserted, dropped ones are deleted
+        query = "SELECT t_of_attack, rowid FROM visits WHERE x=? AND y=?"
+        rowids = dict(self.storage.connection.execute(query, village.coords))
+        village.visits_history = [(4000, 50), (3000, 100), (2000, 300)]
+        for other_village in test_villages[1:]:
+            other_village.visits_history = [(1500, 10)]
+        statements = []
+        self.storage.connection.set_trace_callback(statements.append)
+        self.storage.update_villages({village.coords: village
+                                      for village in test_villages})
+        self.storage.connection.set_trace_callback(None)
+        # saved visits are read by a single query, not one per village
+        self.assertEqual(len([statement for statement in statements
+                              if statement.startswith('SELECT')]), 1)
+        new_rowids = dict(self.storage.connection.execute(query, village.coords))
+        self.assertCountEqual(new_rowids, [4000, 3000, 2000])
+        self.assertEqual(new_rowids[3000], rowids[3000])
+        self.assertEqual(new_rowids[2000], rowids[2000])
+        saved_village = self.storage.get_saved_villages()[village.coords]
+        self.assertEqual(saved_village.visits_history,
+                         [(4000, 50), (3000, 100), (2000, 300)])
+
+    def test_save_attacks(self):
+        save_data_arrivals = {(1, 1): 1000, (2, 2): 2000, (3, 3): 3000}
+        save_data_returns = {1: [1000, 2000, 3000], 2: [3000, 1000]}
+        self.storage.save_attacks(arrivals=save_data_arrivals,
+                                  returns=save_data_returns)
+        self.assertEqual(self.storage.get_saved_arrivals(), save_data_arrivals)
+        self.assertEqual(self.storage.get_saved_returns(), save_data_returns)
+
+        self.storage.save_attacks(arrivals={(4, 4): 4000})
+        self.assertEqual(self.storage.get_saved_arrivals(), {(4, 4): 4000})
+        self.assertEqual(self.storage.get_saved_returns(), save_data_returns)
+
+    def test_last_report_id(self):
+        self.assertIsNone(self.storage.get_last_report_id())
+        self.storage.save_last_report_id(65471139)
+        self.storage.save_last_report_id(65471140)
+        self.assertEqual(self.storage.get_last_report_id(), 65471140)
+
+    def test_migrate_from_shelve(self):
+        shelve_name = os.path.join(self.storage_folder, 'test_shelve')
+        local_storage = LocalStorage(shelve_name)
+        test_villages = TargetVillageFactory.build_batch(3)
+        save_data = {village.coords: village for village in test_villages}
+        local_storage.update_villages(save_data)
+        local_storage.save_attacks(arrivals={(1, 1): 1000}, returns={1: [2000]})
+
+        self.storage.migrate_from_shelve(shelve_name)
+        self.assertCountEqual(self.storage.get_saved_villages(), save_data)
+        self.assertEqual(self.storage.get_saved_arrivals(), {(1, 1): 1000})
+        self.assertEqual(self.storage.get_saved_returns(), {1: [2000]})
+
+
+class TestAttackJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.helper = StorageHelper()
+        self.storage_folder = self.helper.create_test_storage()
+        self.journal_name = os.path.join(self.storage_folder, 'test_journal')
+
+    def tearDown(self):
+        self.helper.clean_test_storage()
+
+    def test_append_and_replay(self):
+        journal = AttackJournal(self.journal_name)
+        self.assertEqual(journal.replay(), [])
+        records = [(AttackJournal.ATTACK, 1, (1, 1), 1000, 2000),
+                   (AttackJournal.VILLAGE, (1, 1), TargetVillageFactory())]
+        for record in records:
+            journal.append(record)
+        replayed = journal.replay()
+        self.assertEqual(replayed[0], records[0])
+        self.assertEqual(replayed[1][2].coords, records[1][2].coords)
+
+        # a record torn by crash is skipped
+        journal.close()
+        with open(self.journal_name, 'ab') as f:
+            f.write(b'\x80\x04\x95')
+        self.assertEqual(len(journal.replay()), 2)
+
+        journal.clear()
+        self.assertEqual(journal.replay(), [])
+        journal.append(records[0])
+        self.assertEqual(journal.replay(), [records[0]])
+        journal.close()
+
+    @mock.patch('bot.libs.common_tools.os.fsync')
+    def test_batched_sync(self, fsync):
+        journal = AttackJournal(self.journal_name, sync_every=3,
+                                sync_interval=3600)
+        for i in range(7):
+            journal.append((AttackJournal.ATTACK, 1, (i, i), 1000, 2000))
+        self.assertEqual(fsync.call_count, 2)
+        self.assertEqual(journal.pending, 1)
+        journal.close()
+        self.assertEqual(fsync.call_count, 3)
+
 
 class TestCookiesExtractor(unittest.TestCase):
 
@@ -0,0 +1,88 @@
+import time
+import unittest
+from threading import Timer
+from unittest.mock import Mock
+
+from bot.libs.event_scheduler import EventScheduler
+
+
+class TestEventScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.scheduler = EventScheduler(clock=lambda: self.now)
+
+    def test_pop_due_events(self):
+        scheduler = self.scheduler
+        scheduler.schedule(1010, EventScheduler.RETURN, 1)
+        scheduler.schedule(1000, EventScheduler.ARRIVAL, (1, 1))
+        scheduler.schedule(990, EventScheduler.ARRIVAL, (2, 2))
+        scheduler.schedule(1000, EventScheduler.REST_EXPIRY, (1, 1))
+        self.assertEqual(scheduler.get_next_event_t(), 990)
+
+        # events due at the same time keep order of scheduling
+        self.assertEqual(scheduler.pop_due_events(),
+                         [(EventScheduler.ARRIVAL, (2, 2)),
+                          (EventScheduler.ARRIVAL, (1, 1)),
+                          (EventScheduler.REST_EXPIRY, (1, 1))])
+        self.assertEqual(scheduler.pop_due_events(), [])
+        self.assertEqual(len(scheduler), 1)
+        self.now = 1010
+        self.assertEqual(scheduler.pop_due_events(),
+                         [(EventScheduler.RETURN, 1)])
+        self.assertIsNone(scheduler.get_next_event_t())
+
+    def test_run_pending(self):
+        scheduler = self.scheduler
+        on_arrival, on_return = Mock(), Mock()
+        scheduler.set_handler(EventScheduler.ARRIVAL, on_arrival)
+        scheduler.set_handler(EventScheduler.RETURN, on_return)
+        scheduler.schedule(1000, EventScheduler.ARRIVAL, (1, 1))
+        scheduler.schedule(1000, EventScheduler.SESSION_REFRESH)
+        scheduler.schedule(1001, EventScheduler.RETURN, 1)
+
+        self.assertEqual(scheduler.run_pending(), 2)
+        on_arrival.assert_called_once_with((1, 1))
+        self.assertFalse(on_return.called)
+        self.now = 1001
+        self.assertEqual(scheduler.run_pending(), 1)
+        on_return.assert_called_once_with(1)
+
+    def test_wait(self):
+        scheduler = EventScheduler(clock=time.time)
+        # due event: returns immediately
+        scheduler.schedule(time.time() - 1, EventScheduler.ARRIVAL, (1, 1))
+        self.assertTrue(scheduler.wait())
+        scheduler.pop_due_events()
+
+        # sleeps until the event is due
+        start = time.time()
+        scheduler.schedule(start + 0.2, EventScheduler.RETURN, 1)
+        self.assertTrue(scheduler.wait(until=start + 10))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+        scheduler.pop_due_events()
+
+        # but not longer than 'until'
+        start = time.time()
+        scheduler.schedule(start + 10, EventScheduler.RETURN, 1)
+        self.assertFalse(scheduler.wait(until=start + 0.1))
+        self.assertLess(time.time() - start, 5)
+
+        # an earlier event scheduled from other thread shortens the sleep
+        start = time.time()
+        Timer(0.1, scheduler.schedule,
+              args=(start + 0.2, EventScheduler.ARRIVAL, (2, 2))).start()
+        self.assertTrue(scheduler.wait())
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(scheduler.pop_due_events(),
+                         [(EventScheduler.ARRIVAL, (2, 2))])
+
+        # .wake() interrupts waiting
+        start = time.time()
+        Timer(0.1, scheduler.wake).start()
+        self.assertFalse(scheduler.wait())
+        self.assertLess(time.time() - start, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import time
+import unittest
+import logging
+
+from bot.libs.request_management import RequestManager
+from bot.tests.game_server import GameServer, measure_attack_cycles
+
+
+logging.basicConfig(level=logging.CRITICAL)
+
+
+class TestGameServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = GameServer().start()
+        self.request_manager = RequestManager(host=self.server.host,
+                                              initial_cookies={},
+                                              main_id=135083,
+                                              locale={'expiration': 'Session expired',
+                                                      'protection': 'Bot protection'},
+                                              con_attempts=1)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_serves_game_screens(self):
+        resp = self.request_manager.get_train_screen(village_id=135083)
+        self.assertIn('UnitPopup.unit_data', resp['response_text'])
+        # Date header has the same format as the one of game host
+        time.strptime(resp['response_time'], '%a, %d %b %Y %H:%M:%S %Z')
+
+        resp = self.request_manager.get_map_overview(village_id=135083, x=211, y=305)
+        self.assertIn('TWMap.sectorPrefech', resp['response_text'])
+
+        resp = self.request_manager.post_confirmation(village_id=135083,
+                                                      post_data=b'x=211&y=306')
+        self.assertIn('action_id', resp['response_text'])
+        self.assertEqual(self.server.hits, {'train': 1, 'map': 1, 'place': 1})
+
+    def test_measure_attack_cycles(self):
+        performed, rate = measure_attack_cycles(cycles=3)
+        self.assertEqual(performed, 3)
+        self.assertGreater(rate, 0)
@@ -1,7 +1,14 @@
 import os
+import gzip
+import time
 import unittest
+from unittest.mock import Mock
 
-from bot.libs.map_tools import MapParser, MapMath
+from bot.libs import map_tools
+from bot.libs.map_tools import MapParser, MapMath, MapGrid, AttackTargets
+from bot.libs.map_tools import MapSectorCache, MapCrawler, VillageDumpReader
+from bot.tests.factories import PlayerVillageFactory
+from bot.tests.helpers import StorageHelper
 import settings
 
 
@@ -35,6 +42,168 @@ class TestMapParser(unittest.TestCase):
         self.assertIn((207, 305), first_sector)
         self.assertEqual(first_sector[(207, 305)][0], '135534')
 
+    def test_collect_sectors(self):
+        filename = os.path.join(self.overviews_folder, 'map_overview_200_300.html')
+        with open(filename) as f:
+            map_data = f.read()
+        sectors = self.parser.collect_sectors(map_data)
+        self.assertEqual(list(sectors), [(180, 280), (180, 300),
+                                         (200, 280), (200, 300)])
+        self.assertEqual(list(sectors.values()),
+                         self.parser.collect_sector_data(map_data))
+
+
+class TestMapCrawler(unittest.TestCase):
+
+    def setUp(self):
+        # each overview contains only the sector of requested point
+        # & the sector to the right of it
+        def collect_sectors(overview):
+            x, y = overview
+            origins = [(x // 20 * 20, y // 20 * 20), (x // 20 * 20 + 20, y // 20 * 20)]
+            return {origin: {(origin[0] + 1, origin[1] + 1): origin}
+                    for origin in origins}
+        self.requested = []
+
+        def fetch_overview(village_id, x, y):
+            self.requested.append((x, y))
+            return x, y
+
+        parser = Mock()
+        parser.collect_sectors.side_effect = collect_sectors
+        self.collected = []
+        self.crawler = MapCrawler(parser, fetch_overview, self.collected.append)
+
+    def test_crawl(self):
+        center = PlayerVillageFactory(village_id=1, coords=(105, 105), name="1")
+        area = self.crawler.crawl([center], radius=25)
+        # all sectors intersecting with the circle
+        expected = [(x + 1, y + 1) for x in range(80, 140, 20)
+                    for y in range(80, 140, 20)]
+        for coords in expected:
+            self.assertIn(coords, area)
+        origins = [(x // 20 * 20, y // 20 * 20) for x, y in self.requested]
+        self.assertEqual(len(origins), len(set(origins)))
+        self.assertEqual(self.crawler.requests, len(self.requested))
+        self.assertLess(self.crawler.requests, len(expected))
+        self.assertEqual(self.crawler.villages, len(area))
+        self.assertEqual(self.crawler.sectors, len(area))
+        self.assertEqual(len(self.collected), self.crawler.requests)
+        # crawled sectors are the ones that cache should cover
+        collected_origins = set()
+        for sectors in self.collected:
+            collected_origins.update(sectors)
+        self.assertTrue(MapCrawler.get_sector_origins([(105, 105)], 25) <=
+                        collected_origins)
+
+    def test_get_sector_origins(self):
+        self.assertEqual(MapCrawler.get_sector_origins([(105, 105)], 4), {(100, 100)})
+        self.assertEqual(MapCrawler.get_sector_origins([(101, 119)], 2),
+                         {(100, 100), (100, 120), (80, 100)})
+        origins = MapCrawler.get_sector_origins([(105, 105), (200, 200)], 25)
+        self.assertEqual(len(origins), 9 + 12)
+        self.assertIn((220, 200), origins)
+        self.assertNotIn((60, 60), origins)
+
+    def test_split_to_sectors(self):
+        area = {(1, 1): ['1'], (19, 19): ['2'], (21, 1): ['3']}
+        self.assertEqual(MapCrawler.split_to_sectors(area, origins=[(0, 0), (0, 20)]),
+                         {(0, 0): {(1, 1): ['1'], (19, 19): ['2']},
+                          (20, 0): {(21, 1): ['3']},
+                          (0, 20): {}})
+
+
+class TestMapSectorCache(unittest.TestCase):
+
+    def setUp(self):
+        self.helper = StorageHelper()
+        storage_folder = self.helper.create_test_storage()
+        self.cache = MapSectorCache(os.path.join(storage_folder, 'map_cache'),
+                                    ttl=1)
+
+    def tearDown(self):
+        self.helper.clean_test_storage()
+
+    def test_update_sectors(self):
+        self.assertEqual(self.cache.get_area_data(), {})
+        self.assertIsNone(self.cache.get_next_expiry())
+        sectors = {(0, 0): {(1, 1): ['1', 4, 0, '78', '0', '100'],
+                            (2, 2): ['2', 4, 0, '78', '0', '100']},
+                   (20, 0): {(21, 1): ['3', 4, 0, '78', '0', '100']}}
+        changed, removed = self.cache.update_sectors(sectors, t_of_fetch=1000)
+        self.assertEqual(changed, {(1, 1): ['1', 4, 0, '78', '0', '100'],
+                                   (2, 2): ['2', 4, 0, '78', '0', '100'],
+                                   (21, 1): ['3', 4, 0, '78', '0', '100']})
+        self.assertEqual(removed, [])
+        self.assertEqual(len(self.cache.get_area_data()), 3)
+        self.assertEqual(self.cache.get_next_expiry(), 1000 + 3600)
+        self.assertCountEqual(self.cache.get_stale_origins(), [(0, 0), (20, 0)])
+
+        now = time.mktime(time.gmtime())
+        updated_sector = {(0, 0): {(1, 1): ['1', 4, 0, '80', '0', '100'],
+                                   (3, 3): ['4', 4, 0, '78', '0', '100']}}
+        changed, removed = self.cache.update_sectors(updated_sector, t_of_fetch=now)
+        self.assertEqual(changed, {(1, 1): ['1', 4, 0, '80', '0', '100'],
+                                   (3, 3): ['4', 4, 0, '78', '0', '100']})
+        self.assertEqual(removed, [(2, 2)])
+        self.assertEqual(self.cache.get_stale_origins(), [(20, 0)])
+        self.assertCountEqual(self.cache.get_area_data(), [(1, 1), (3, 3), (21, 1)])
+
+    def test_has_and_touch_sectors(self):
+        self.cache.update_sectors({(0, 0): {(1, 1): ['1', 4, 0, '78', '0', '100']},
+                                   (20, 0): {}}, t_of_fetch=1000)
+        self.assertTrue(self.cache.has_sectors({(0, 0), (20, 0)}))
+        self.assertFalse(self.cache.has_sectors({(0, 0), (0, 20)}))
+
+        now = time.mktime(time.gmtime())
+        self.cache.touch_sectors([(20, 0), (40, 0)], t_of_fetch=now)
+        self.assertEqual(self.cache.get_stale_origins(), [(0, 0)])
+        self.assertEqual(self.cache.get_next_expiry(), 1000 + 3600)
+        self.assertFalse(self.cache.has_sectors([(40, 0)]))
+        self.assertEqual(len(self.cache.get_area_data()), 1)
+
+
+class TestVillageDumpReader(unittest.TestCase):
+
+    def setUp(self):
+        self.helper = StorageHelper()
+        self.storage_folder = self.helper.create_test_storage()
+        # every 3rd village is owned by a player
+        self.lines = ['{id},{name},{x},{y},{player},{points},{rank}'.format(
+            id=i, name='Village+%23' + str(i), x=i % 500, y=i // 500,
+            player=i if i % 3 == 0 else 0, points=26 + i % 100, rank=0)
+            for i in range(1, 3001)]
+
+    def tearDown(self):
+        self.helper.clean_test_storage()
+
+    def _write_dump(self, filename, opener=open):
+        path = os.path.join(self.storage_folder, filename)
+        with opener(path, 'wt') as f:
+            f.write('\n'.join(self.lines) + '\n')
+        return path
+
+    def test_get_map_data(self):
+        reader = VillageDumpReader(self._write_dump('village.txt'))
+        map_data = reader.get_map_data(include=[(3, 0)])
+        self.assertEqual(len(map_data), 2000 + 1)
+        self.assertEqual(map_data[(1, 0)], ['1', 0, 0, '27', '0', '0'])
+        self.assertEqual(map_data[(3, 0)], ['3', 0, 'Village #3', '29', '3', '0'])
+        self.assertNotIn((6, 0), map_data)
+
+    def test_get_map_data_in_radius(self):
+        reader = VillageDumpReader(self._write_dump('village.txt.gz', gzip.open))
+        map_data = reader.get_map_data(centers=[(10, 2), (400, 5)], radius=1)
+        self.assertCountEqual(map_data, [(10, 2), (10, 3), (9, 2),
+                                         (400, 5), (399, 5)])
+
+    def test_get_t_of_dump(self):
+        path = self._write_dump('village.txt')
+        t_of_dump = time.mktime(time.gmtime()) - 7200
+        os.utime(path, (time.time() - 7200, time.time() - 7200))
+        reader = VillageDumpReader(path)
+        self.assertAlmostEqual(reader.get_t_of_dump(), t_of_dump, delta=2)
+
 
 class TestMapMath(unittest.TestCase):
 
@@ -68,10 +237,90 @@ class TestMapMath(unittest.TestCase):
         self.assertEqual(targets_by_distance[2][0], (100, 89))
         self.assertEqual(targets_by_distance[3][0], (100, 115))
 
+    def test_get_targets_by_distance_in_radius(self):
+        source_coords = (100, 100)
+        target_coords = [(94, 94), (100, 115), (105, 105), (100, 89), (300, 300)]
+        index = MapGrid(target_coords, cell_size=5)
+        for grid in (None, index):
+            targets_by_distance = MapMath.get_targets_by_distance(source_coords,
+                                                                  target_coords,
+                                                                  radius=11,
+                                                                  index=grid)
+            self.assertEqual(targets_by_distance, [((105, 105), 7.07),
+                                                   ((94, 94), 8.49),
+                                                   ((100, 89), 11.0)])
+
+    @unittest.skipIf(map_tools.numpy is None, "NumPy is not installed")
+    def test_get_distance_matrix(self):
+        sources = [(100, 100), (200, 150)]
+        targets = [(94, 94), (100, 115), (200, 150)]
+        matrix = MapMath.get_distance_matrix(sources, targets)
+        self.assertEqual(matrix.shape, (2, 3))
+        for row, source in enumerate(sources):
+            for column, target in enumerate(targets):
+                self.assertEqual(matrix[row][column],
+                                 MapMath.calculate_distance(source, target))
+
+
+@unittest.skipIf(map_tools.numpy is None, "NumPy is not installed")
+class TestAttackTargets(unittest.TestCase):
+
+    def test_matches_targets_by_distance(self):
+        source_coords = (100, 100)
+        target_coords = [(94, 94), (100, 115), (105, 105), (100, 89), (300, 300)]
+        distances = MapMath.get_distance_matrix([source_coords], target_coords)[0]
+        for radius in (None, 11):
+            attack_targets = AttackTargets(target_coords, distances, radius)
+            expected = MapMath.get_targets_by_distance(source_coords, target_coords,
+                                                       radius=radius)
+            self.assertEqual(list(attack_targets), expected)
+            self.assertEqual(len(attack_targets), len(expected))
+            self.assertEqual(attack_targets[0], expected[0])
+        travel_times = attack_targets.get_travel_times(speed=10)
+        self.assertEqual(travel_times.tolist(), [7.07 * 600, 8.49 * 600, 11.0 * 600])
+
+
+class TestMapGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.coords = [(x, y) for x in range(0, 100, 3) for y in range(0, 100, 7)]
+        self.grid = MapGrid(self.coords, cell_size=10)
+
+    def test_get_in_radius(self):
+        for center, radius in (((50, 50), 0), ((50, 50), 12.5), ((0, 0), 30),
+                               ((-40, 10), 45), ((50, 50), 1000)):
+            expected = [c for c in self.coords if
+                        (c[0] - center[0]) ** 2 + (c[1] - center[1]) ** 2 <= radius ** 2]
+            self.assertCountEqual(self.grid.get_in_radius(center, radius), expected)
+
+    def test_get_nearest(self):
+        center = (33, 47)
+        by_distance = sorted(self.coords,
+                             key=lambda c: MapMath.calculate_distance(center, c))
+        nearest = self.grid.get_nearest(center, 5)
+        self.assertEqual([MapMath.calculate_distance(center, c) for c in nearest],
+                         [MapMath.calculate_distance(center, c) for c in by_distance[:5]])
+        self.assertEqual(len(self.grid.get_nearest(center, 10000)), len(self.coords))
+        self.assertEqual(MapGrid().get_nearest(center, 3), [])
+
+    def test_add_remove(self):
+        self.grid.remove((0, 0))
+        self.grid.remove((0, 0))
+        self.assertNotIn((0, 0), self.grid.get_in_radius((0, 0), 1))
+        self.assertEqual(self.grid.size, len(self.coords) - 1)
+        self.grid.add((0, 0))
+        self.grid.add((0, 0))
+        self.assertEqual(self.grid.size, len(self.coords))
+        self.assertIn((0, 0), self.grid.get_in_radius((0, 0), 1))
+
 
 def suite():
     suite = unittest.TestSuite(tests=(TestMapMath,
-                                      TestMapParser))
+                                      TestMapParser,
+                                      TestMapCrawler,
+                                      TestMapSectorCache,
+                                      TestAttackTargets,
+                                      TestMapGrid))
     return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,65 @@
+import unittest
+
+from bot.app import locale
+from bot.libs.patterns import PatternRegistry, PATTERNS
+
+
+class TestPatternRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = PatternRegistry()
+        self.registry.register('digits', r'\d+')
+        self.registry.register_template('building_level',
+                                        r'{building}\s\W{level}\s(\d+)\W')
+
+    def test_get(self):
+        pattern = self.registry.get('digits')
+        self.assertIs(pattern, self.registry.get('digits'))
+        self.assertEqual(pattern.findall('1.234'), ['1', '234'])
+        with self.assertRaises(KeyError):
+            self.registry.get('unknown')
+        # static patterns are not counted as hits of cache
+        self.assertEqual(self.registry.get_stats(), {'hits': 0, 'misses': 0,
+                                                     'static_lookups': 2,
+                                                     'compiled': 1, 'hit_rate': None})
+
+    def test_get_template(self):
+        pattern = self.registry.get('building_level', building='Timber camp',
+                                    level='Level')
+        self.assertEqual(pattern.search('Timber camp (Level 12)').group(1), '12')
+        # compiled once per set of parameters
+        self.assertIs(pattern, self.registry.get('building_level', level='Level',
+                                                 building='Timber camp'))
+        # parameters are escaped
+        pattern = self.registry.get('building_level', building='Iron mine.',
+                                    level='Level')
+        self.assertIsNone(pattern.search('Iron mines (Level 3)'))
+        stats = self.registry.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['compiled']), (1, 2, 3))
+
+        # e.g. stats of worker process
+        self.registry.add_stats({'hits': 3, 'misses': 1, 'static_lookups': 5,
+                                 'compiled': 20, 'hit_rate': 0.75})
+        stats = self.registry.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['static_lookups'],
+                          stats['compiled']), (4, 3, 5, 3))
+
+        self.registry.reset_stats()
+        self.assertIsNone(self.registry.get_stats()['hit_rate'])
+
+    def test_load_locale(self):
+        for lang in ('en', 'fr'):
+            self.registry.load_locale(locale.LOCALE[lang])
+        # compiled in advance
+        self.assertEqual(self.registry.get_stats()['compiled'], 11)
+        fr = locale.LOCALE['fr']
+        pattern = self.registry.get('building_level', building=fr['mines'][1],
+                                    level=fr['level_name'])
+        self.assertEqual(pattern.search("Carrière d'argile (Niveau 7)").group(1), '7')
+        self.assertEqual(self.registry.get_stats()['hit_rate'], 1)
+
+    def test_registered_patterns(self):
+        self.assertEqual(PATTERNS.get('report_coords').search('barbs (220|317)').groups(),
+                         ('220', '317'))
+        self.assertEqual(PATTERNS.get('tag_boundary', tag='tr').findall('<tr><td></td></tr>'),
+                         ['', '/'])
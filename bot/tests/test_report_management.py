@@ -1,10 +1,15 @@
 import unittest
 import os
+from unittest.mock import patch, Mock
+
+from bs4 import BeautifulSoup as Soup
 
 import settings
 from bot.app import locale
 from bot.libs.report_management import AttackReport
 from bot.libs.report_management import ReportManager
+from bot.libs.patterns import PATTERNS
+from bot.tests.helpers import StorageHelper
 
 
 class TestReportManager(unittest.TestCase):
@@ -71,6 +76,53 @@ class TestReportManager(unittest.TestCase):
         actual_urls = rm.get_report_urls(html_data, only_new=False)
         self.assertCountEqual(expected_urls, actual_urls)
 
+    def test_get_new_report_urls(self):
+        helper = StorageHelper()
+        storage_folder = helper.create_test_storage()
+        storage_name = os.path.join(storage_folder, 'test_storage')
+        self.addCleanup(helper.clean_test_storage)
+        rm = ReportManager(locale={}, storage_type='local_file',
+                           storage_name=storage_name)
+        self.assertIsNone(rm.last_report_id)
+        filename = os.path.join(self.test_data_path,
+                                'en_report-page_w_new_battle.html')
+        with open(filename) as f:
+            html_data = f.read()
+
+        # the last handled report is unknown: only "new" reports
+        new_reports, reached_last = rm.get_new_report_urls(html_data)
+        self.assertEqual([report_id for report_id, _ in new_reports],
+                         [65471139, 65470230, 65466313, 65462611, 65456252])
+        self.assertEqual(new_reports[0][1], '/game.php?village=127591&mode=all'
+                                            '&view=65471139&screen=report')
+        self.assertFalse(reached_last)
+        rm.mark_parsed(65471139)
+        rm.save_last_report_id()
+        self.assertEqual(rm.last_report_id, 65471139)
+
+        # high-water mark is restored from storage
+        rm = ReportManager(locale={}, storage_type='local_file',
+                           storage_name=storage_name)
+        self.assertEqual(rm.last_report_id, 65471139)
+        new_reports, reached_last = rm.get_new_report_urls(html_data)
+        self.assertEqual(new_reports, [])
+        self.assertTrue(reached_last)
+
+        # reports that are newer than the mark (read or not) & were
+        # not handled yet
+        rm.last_report_id = 65450705
+        rm.mark_parsed(65471139)
+        new_reports, reached_last = rm.get_new_report_urls(html_data)
+        self.assertEqual([report_id for report_id, _ in new_reports],
+                         [65470230, 65466313, 65462611, 65456252,
+                          65454256, 65451253])
+        self.assertTrue(reached_last)
+
+        rm.last_report_id = 65000000
+        new_reports, reached_last = rm.get_new_report_urls(html_data)
+        self.assertEqual(len(new_reports), 11)
+        self.assertFalse(reached_last)
+
     def test_build_report(self):
         rm = ReportManager(locale=locale.LOCALE["en"])
         filepath = os.path.join(settings.TEST_DATA_FOLDER,
@@ -82,6 +134,54 @@ class TestReportManager(unittest.TestCase):
         report = rm.build_report(html_data)
         self.assertIsInstance(report, AttackReport)
 
+    def test_build_reports(self):
+        reports_path = os.path.join(settings.TEST_DATA_FOLDER, 'html',
+                                    'reports/single_report_test_set')
+        report_pages = []
+        for filename in sorted(os.listdir(reports_path)):
+            if filename.startswith('en_'):
+                with open(os.path.join(reports_path, filename)) as f:
+                    report_pages.append(f.read())
+        rm = ReportManager(locale=locale.LOCALE["en"], workers=2, min_batch=2)
+        self.addCleanup(rm.close)
+        inline_reports = [rm.build_report(page) for page in report_pages]
+        self.addCleanup(PATTERNS.reset_stats)
+        PATTERNS.reset_stats()
+        pool_reports = rm.build_reports(report_pages)
+        # lookups made in worker processes are added to stats of main process
+        self.assertGreater(PATTERNS.get_stats()['static_lookups'], 0)
+        self.assertGreater(PATTERNS.get_stats()['hits'] + PATTERNS.get_stats()['misses'], 0)
+        self.assertIsNotNone(rm._executor)
+        self.assertNotEqual(rm._executor._mp_context.get_start_method(), 'fork')
+        self.assertEqual(len(pool_reports), len(report_pages))
+        for inline_report, pool_report in zip(inline_reports, pool_reports):
+            self.assertIsNone(pool_report.data)
+            for field in ('status', 'coords', 't_of_attack', 'defended',
+                          'mine_levels', 'remaining_capacity', 'looted_capacity',
+                          'storage_level', 'wall_level'):
+                self.assertEqual(getattr(inline_report, field),
+                                 getattr(pool_report, field))
+
+        # pool w/o mp_context (python < 3.7)
+        def old_pool(max_workers=None, **kwargs):
+            if kwargs:
+                raise TypeError("unexpected keyword argument 'mp_context'")
+            return Mock(map=Mock(side_effect=map))
+        rm = ReportManager(locale=locale.LOCALE["en"], workers=2, min_batch=2)
+        with patch('bot.libs.report_management.ProcessPoolExecutor',
+                   side_effect=old_pool):
+            reports = rm.build_reports(report_pages[:2])
+        self.assertEqual([report.status for report in reports],
+                         [report.status for report in inline_reports[:2]])
+
+        # small batch is parsed inline
+        rm = ReportManager(locale=locale.LOCALE["en"], min_batch=10)
+        reports = rm.build_reports(report_pages[:1])
+        self.assertIsNone(rm._executor)
+        self.assertIsNone(reports[0].data)
+        self.assertIsNone(reports[0].soup)
+        self.assertEqual(reports[0].status, inline_reports[0].status)
+
 
 class TestAttackReport(unittest.TestCase):
 
@@ -340,3 +440,34 @@ class TestAttackReport(unittest.TestCase):
         self.assertIsNone(rep.looted_capacity)
         self.assertIsNone(rep.wall_level)
         self.assertIsNone(rep.storage_level)
+
+    def test_markup_and_soup_reports_are_identical(self):
+        fields = ('status', 'coords', 't_of_attack', 'defended', 'mine_levels',
+                  'remaining_capacity', 'looted_capacity', 'storage_level',
+                  'wall_level')
+        for filename in os.listdir(self.test_data_path):
+            lang = 'fr' if filename.startswith('fr') else 'en'
+            with open(os.path.join(self.test_data_path, filename)) as f:
+                report_data = f.read()
+            rep = AttackReport(report_data, self.locale[lang])
+            self.assertIsNone(rep.soup)
+            with patch.object(AttackReport, '_build_from_markup', return_value=False):
+                soup_rep = AttackReport(report_data, self.locale[lang])
+            for field in fields:
+                self.assertEqual(getattr(rep, field), getattr(soup_rep, field),
+                                 "{} of {}".format(field, filename))
+
+    def test_soup_fallback_on_unexpected_markup(self):
+        filepath = os.path.join(self.test_data_path, 'en_report_green.html')
+        with open(filepath) as f:
+            report_data = f.read()
+        # duplicate id makes markup ambiguous
+        report_data = report_data.replace('</body>', '<table id="attack_spy">'
+                                                     '<tr><td></td></tr></table>'
+                                                     '</body>')
+        with patch('bot.libs.report_management.Soup', wraps=Soup) as soup:
+            rep = AttackReport(report_data, self.locale["en"])
+        soup.assert_called_once_with(report_data)
+        self.assertIsNone(rep.soup)
+        self.assertEqual(rep.coords, (203, 316))
+        self.assertEqual(rep.mine_levels, [9, 1, 2])
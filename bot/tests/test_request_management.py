@@ -1,10 +1,13 @@
 import unittest
 import os
+import asyncio
 import logging
+from unittest.mock import Mock
 
 import settings
 from bot.app import locale
-from bot.libs.request_management import SafeOpener
+from bot.libs.request_management import SafeOpener, AsyncSafeOpener
+from bot.libs.request_management import SessionExpiredError
 
 
 logging.basicConfig(level=logging.CRITICAL)
@@ -18,6 +21,44 @@ class TestSafeOpener(unittest.TestCase):
                                  password='pass', antigate_key='key')
         self.data_path = os.path.join(settings.TEST_DATA_FOLDER, 'html', 'misc')
 
+    def test_session_carries_initial_cookies(self):
+        opener = SafeOpener(host='host', cookies={'sid': 'abc', 'cid': '123'},
+                            locale=None, con_attempts=5, reconnect=False,
+                            username=None, password=None, antigate_key=None,
+                            pool_size=2)
+        self.assertEqual(opener.session.cookies.get_dict(),
+                         {'sid': 'abc', 'cid': '123'})
+        adapter = opener.session.get_adapter('http://host/game.php')
+        self.assertEqual(adapter._pool_maxsize, 2)
+
+    def test_relogin_replaces_cookies(self):
+        # session (& its connections) may be used by requests in flight
+        old_session = self.opener.session
+        # cookies of the old session which are not set by a new login
+        old_session.cookies.set('cid', '123')
+        old_session.cookies.set('mobile', '0')
+        self.opener.auto_login = Mock()
+        self.opener.auto_login.login_to_server.return_value = {'sid': 'new'}
+        self.opener._relogin_once(self.opener.login_count)
+        self.assertIs(self.opener.session, old_session)
+        self.assertEqual(self.opener.session.cookies.get_dict(), {'sid': 'new'})
+        # somebody has re-logged in after request was sent
+        self.opener._relogin_once(0)
+        self.assertEqual(len(self.opener.auto_login.login_to_server.mock_calls), 1)
+
+    def test_send_request(self):
+        self.opener.locale = locale.LOCALE["en"]
+        self.opener.auto_login = Mock()
+        self.opener.auto_login.login_to_server.return_value = {'sid': 'new'}
+        date = 'Sun, 10 Nov 2013 07:30:32 GMT'
+        responses = [Mock(text=text, headers={'date': date})
+                     for text in ('', 'Session expired', '<html>')]
+        self.opener._fetch = Mock(side_effect=responses)
+        result = self.opener.send_request({'url': 'u', 'headers': {}})
+        self.assertEqual(result, {'response_text': '<html>', 'response_time': date})
+        self.assertEqual(len(self.opener._fetch.mock_calls), 3)
+        self.assertEqual(self.opener.login_count, 1)
+
     def test_check_if_session_expire(self):
         self.opener.locale = locale.LOCALE["en"]
 
@@ -80,3 +121,54 @@ class TestSafeOpener(unittest.TestCase):
                        's=243efdbc3da1&small'.format(host=self.opener.host)
         check = self.opener._check_if_captcha_spawned(test_data)
         self.assertEqual(check, expected_url)
+
+
+class TestAsyncSafeOpener(unittest.TestCase):
+
+    def setUp(self):
+        self.opener = AsyncSafeOpener(host='host', cookies={},
+                                      locale=locale.LOCALE["en"],
+                                      con_attempts=3, reconnect=True,
+                                      username='name', password='pass',
+                                      antigate_key=None)
+        self.opener.auto_login = Mock()
+        self.opener.auto_login.login_to_server.return_value = {'sid': 'new'}
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    @staticmethod
+    def _response(text):
+        return Mock(text=text, headers={'date': 'Sun, 10 Nov 2013 07:30:32 GMT'})
+
+    def test_send_request(self):
+        self.opener._fetch = Mock(side_effect=[self._response(''),
+                                               self._response('<html>')])
+        request = self.opener.send_request({'url': 'u', 'headers': {}})
+        result = self.loop.run_until_complete(request)
+        self.assertEqual(result, {'response_text': '<html>',
+                                  'response_time': 'Sun, 10 Nov 2013 07:30:32 GMT'})
+        self.assertEqual(len(self.opener._fetch.mock_calls), 2)
+
+    def test_concurrent_requests_relogin_once(self):
+        expired = self._response('Session expired')
+        fine = self._response('<html>')
+        self.opener._fetch = Mock(side_effect=[expired, expired, fine, fine])
+
+        async def send_both():
+            requests = [self.opener.send_request({'url': 'u', 'headers': {}})
+                        for _ in range(2)]
+            return await asyncio.gather(*requests)
+
+        results = self.loop.run_until_complete(send_both())
+        self.assertEqual([r['response_text'] for r in results], ['<html>', '<html>'])
+        self.assertEqual(len(self.opener.auto_login.login_to_server.mock_calls), 1)
+        self.assertEqual(self.opener.session.cookies.get_dict(), {'sid': 'new'})
+
+    def test_session_expired_without_reconnect(self):
+        self.opener.reconnect = False
+        self.opener._fetch = Mock(return_value=self._response('Session expired'))
+        with self.assertRaises(SessionExpiredError):
+            request = self.opener.send_request({'url': 'u', 'headers': {}})
+            self.loop.run_until_complete(request)
@@ -1,5 +1,7 @@
 import os
 import time
+import pickle
+import random
 import unittest
 import logging
 from unittest.mock import Mock
@@ -8,6 +10,9 @@ from unittest.mock import patch
 import settings
 from bot.tests.factories import *
 from bot.libs.village_management import *
+from bot.libs.village_management import numpy
+from bot.libs.attack_management import Unit
+from bot.libs.map_tools import MapMath
 
 
 # suppress messages, generated by intentional negative
@@ -265,6 +270,27 @@ class TestVillageManager(unittest.TestCase):
         pv1.update_troops_count.assert_called_once_with(html_data='html')
         self.assertTrue(pv1.active)
 
+    def test_enable_idle_villages(self):
+        pv1 = Mock(spec=PlayerVillage, id=1000, coords=(1, 1), active=True)
+        pv2 = Mock(spec=PlayerVillage, id=2000, coords=(2, 2), active=True)
+        self.village_manager.farming_villages = {1000: pv1, 2000: pv2}
+
+        # pv1 has no targets, attack of pv2 was not sent
+        self.village_manager.disable_farming_village(1000, no_targets=True)
+        self.village_manager.disable_farming_village(2000)
+        self.assertEqual(self.village_manager.get_active_farming_villages(), {})
+
+        # only pv1 waits for targets, pv2 waits for return of its troops
+        self.assertEqual(self.village_manager.enable_idle_villages(), 1)
+        self.assertTrue(pv1.active)
+        self.assertFalse(pv2.active)
+        self.assertEqual(self.village_manager.enable_idle_villages(), 0)
+
+        # village enabled on return of its troops is not idle anymore
+        self.village_manager.disable_farming_village(1000, no_targets=True)
+        self.village_manager.refresh_village_troops(1000, 'html')
+        self.assertEqual(self.village_manager.idle_villages, set())
+
     def test_get_targets_for_attacker(self):
         self.assertEqual(self.village_manager.target_villages, {})
         attacker = PlayerVillageFactory()
@@ -273,10 +299,98 @@ class TestVillageManager(unittest.TestCase):
                                                 target in targets}
         attacker_coords = attacker.coords
         target_coords = self.village_manager.target_villages.keys()
-        with patch('bot.libs.village_management.MapMath', autospec=True) as map_math:
+        targets_index = self.village_manager.targets_index
+        with patch('bot.libs.village_management.MapMath', autospec=True) as map_math, \
+                patch('bot.libs.map_tools.numpy', None):
             self.village_manager._get_targets_for_attacker(attacker)
             map_math.get_targets_by_distance.assert_called_once_with(attacker_coords,
-                                                                     target_coords)
+                                                                     target_coords,
+                                                                     radius=None,
+                                                                     index=targets_index)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_get_targets_for_attacker_in_batch(self):
+        map_data = {(x, y): [str(x * 1000 + y), 4, 0, '78', '0', '100']
+                    for x in range(90, 130, 4) for y in range(90, 130, 5)}
+        self.village_manager.map_storage.get_saved_villages.return_value = {}
+        self.village_manager.build_target_villages(map_data, trusted_targets=[],
+                                                   untrusted_targets=[],
+                                                   server_speed=1)
+        attacker = PlayerVillage(1000, (100, 101), 'attacker')
+        targets_index = self.village_manager.targets_index
+        with patch.object(targets_index, 'get_in_radius',
+                          wraps=targets_index.get_in_radius) as get_in_radius:
+            attack_targets = self.village_manager._get_targets_for_attacker(attacker, 9)
+        # only candidates from index are measured
+        get_in_radius.assert_called_once_with((100, 101), 9)
+        expected = MapMath.get_targets_by_distance((100, 101), map_data.keys(), radius=9)
+        self.assertEqual(list(attack_targets), expected)
+        # no targets in radius
+        attacker = PlayerVillage(1001, (300, 300), 'far attacker')
+        self.assertEqual(self.village_manager._get_targets_for_attacker(attacker, 5), [])
+
+    def test_set_farming_village_within_radius(self):
+        map_data = {(100, 100): ['1', 4, 0, '78', '0', '100'],
+                    (110, 100): ['2', 4, 0, '78', '0', '100'],
+                    (150, 100): ['3', 4, 0, '78', '0', '100']}
+        self.village_manager.map_storage.get_saved_villages.return_value = {}
+        self.village_manager.build_target_villages(map_data, trusted_targets=[],
+                                                   untrusted_targets=[],
+                                                   server_speed=1)
+        attacker = PlayerVillage(1000, (100, 101), 'attacker')
+        patcher = patch.object(PlayerVillage, 'update_troops_count')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.village_manager.player_villages = {1000: attacker}
+        # light cavalry: 10 minutes per tile => 12 tiles in 2 hours
+        self.village_manager.set_farming_village(1000, 'html',
+                                                 t_limit_to_leave=2)
+        self.assertEqual(attacker.attack_targets, [((100, 100), 1.0),
+                                                   ((110, 100), 10.05)])
+        # the same without NumPy
+        with patch('bot.libs.map_tools.numpy', None):
+            self.village_manager.set_farming_village(1000, 'html',
+                                                     t_limit_to_leave=2)
+        self.assertIsInstance(attacker.attack_targets, list)
+        self.assertEqual(attacker.attack_targets, [((100, 100), 1.0),
+                                                   ((110, 100), 10.05)])
+
+    def test_apply_map_delta(self):
+        map_data = {(100, 100): ['1', 4, 0, '78', '0', '100'],
+                    (110, 100): ['2', 4, 0, '78', '0', '100'],
+                    (150, 100): ['3', 4, 0, '78', '0', '100']}
+        self.village_manager.map_storage.get_saved_villages.return_value = {}
+        self.village_manager.build_target_villages(map_data, trusted_targets=[],
+                                                   untrusted_targets=[],
+                                                   server_speed=1)
+        attacker = PlayerVillage(1000, (100, 101), 'attacker')
+        patcher = patch.object(PlayerVillage, 'update_troops_count')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.village_manager.player_villages = {1000: attacker}
+        self.village_manager.set_farming_village(1000, 'html',
+                                                 t_limit_to_leave=2)
+        known_village = self.village_manager.target_villages[(150, 100)]
+
+        # (100, 100) was conquered, (110, 100) disappeared, (105, 100)
+        # is a new barbarian village, (150, 100) has grown
+        changed = {(100, 100): ['1', 4, 'New village', '78', '9141558', '100'],
+                   (105, 100): ['4', 4, 0, '1.078', '0', '100'],
+                   (150, 100): ['3', 4, 0, '90', '0', '100']}
+        new_targets, removed = self.village_manager.apply_map_delta(
+            changed, [(110, 100)], trusted_targets=[], untrusted_targets=[],
+            server_speed=1)
+        self.assertEqual(list(new_targets), [(105, 100)])
+        self.assertEqual(new_targets[(105, 100)].population, 1078)
+        self.assertCountEqual(removed, [(100, 100), (110, 100)])
+        self.assertCountEqual(self.village_manager.target_villages,
+                              [(105, 100), (150, 100)])
+        self.assertIs(self.village_manager.target_villages[(150, 100)],
+                      known_village)
+        self.assertEqual(known_village.population, 90)
+        self.assertEqual(self.village_manager.targets_index.size, 2)
+        # attack targets were re-assigned within the same radius
+        self.assertEqual(list(attacker.attack_targets), [((105, 100), 5.1)])
 
     def test_get_villages_data(self):
         filename = os.path.join(settings.TEST_DATA_FOLDER,
@@ -413,6 +527,23 @@ class TestPlayerVillage(unittest.TestCase):
         self.assertEqual(troops["axe"], 13)
         self.assertEqual(troops["light"], 0)
 
+    def test_set_travel_times(self):
+        pv = PlayerVillageFactory()
+        pv.troops_to_use = ['axe', 'spy', 'light']
+        pv.set_attack_targets([((1, 1), 2.0), ((2, 2), 5.0)])
+        self.assertIsNone(pv.travel_times)
+        pv.set_travel_times(Unit.build_units())
+        # scouts are not sent alone
+        self.assertEqual(list(pv.travel_times), ['axe', 'light'])
+        self.assertEqual(list(pv.travel_times['axe']), [2.0 * 18 * 60, 5.0 * 18 * 60])
+        self.assertEqual(list(pv.travel_times['light']), [2.0 * 10 * 60, 5.0 * 10 * 60])
+        # units of faster world
+        pv.set_travel_times(Unit.build_units(speed_factor=2))
+        self.assertEqual(list(pv.travel_times['light']), [2.0 * 5 * 60, 5.0 * 5 * 60])
+        self.assertEqual(pv.get_farm_radius(1, Unit.build_units(speed_factor=2)), 12)
+        pv.set_attack_targets([])
+        self.assertIsNone(pv.travel_times)
+
     def test_get_troops_data(self):
         pv = PlayerVillageFactory()
         troops_data = pv._get_troops_data(self.data)
@@ -430,10 +561,10 @@ class TestVillage(unittest.TestCase):
         self.village = TargetVillage(coords=(1, 1), village_id=1001, population=100,
                                      bonus=None, server_speed=1)
 
-    def test_update_stats(self):
+    # stub ._set_h_rates to disable internal calls of this method
+    @patch.object(TargetVillage, '_set_h_rates', return_value=[100, 100, 100])
+    def test_update_stats(self, _):
         village = self.village
-        # stub ._set_h_rates to disable internal calls of this method
-        village._set_h_rates = Mock(return_value=[100, 100, 100])
 
         new_report = Mock()
         config = {'t_of_attack': 1000, 'defended': True,
@@ -473,8 +604,8 @@ class TestVillage(unittest.TestCase):
         self.assertEqual(village.visits_history[0],
                          (config['t_of_attack'], config['looted_capacity']))
 
-    def test_estimate_capacity(self):
-        self.village._get_default_capacity = Mock(return_value=1000)
+    @patch.object(TargetVillage, '_get_default_capacity', return_value=1000)
+    def test_estimate_capacity(self, _):
         # no h/rates, return value = default capacity
         self.assertEqual(self.village.estimate_capacity(t_of_arrival=1), 1000)
         # base scenario: village has rested 5 hours, there was no
@@ -521,6 +652,21 @@ class TestVillage(unittest.TestCase):
         self.village.remaining_capacity = 600
         self.assertFalse(self.village.has_valuable_loot(rest_interval))
 
+    def test_pickle(self):
+        self.village.visits_history = [(1000, 200)]
+        restored = pickle.loads(pickle.dumps(self.village))
+        self.assertEqual(restored.__getstate__(), self.village.__getstate__())
+        self.assertFalse(hasattr(restored, '__dict__'))
+
+        # villages pickled before __slots__ were introduced: NEWOBJ of
+        # TargetVillage followed by BUILD from a dict of attributes
+        state = dict(self.village.__getstate__(), removed_attribute=1)
+        legacy_pickle = (b'\x80\x02cbot.libs.village_management\nTargetVillage\n)\x81' +
+                         pickle.dumps(state, protocol=2)[2:-1] + b'b.')
+        restored = pickle.loads(legacy_pickle)
+        self.assertIsInstance(restored, TargetVillage)
+        self.assertEqual(restored.__getstate__(), self.village.__getstate__())
+
     def test_set_hour_rates(self):
         # call with mine_levels = None
         self.village._set_h_rates()
@@ -564,3 +710,61 @@ class TestVillage(unittest.TestCase):
         self.assertEqual(len(rates), 30)
         self.assertEqual(rates[0], 1000)
         self.assertEqual(rates[29], 400000)
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestTargetVillageStore(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.villages = TargetVillageFactory.build_batch(50)
+        for index, village in enumerate(self.villages):
+            village.id = index
+            if index % 5:
+                village.last_visited = random.randint(0, 40000)
+                village.h_rates = [random.randint(5, 300) for _ in range(3)]
+            if index % 3 == 0:
+                village.remaining_capacity = random.randint(0, 3000)
+            if index % 4 == 0:
+                village.storage_limit = random.choice([3000, 5000, 30000])
+        self.store = TargetVillageStore(size=8)
+        for village in self.villages:
+            self.store.add(village)
+
+    def test_estimate_capacity(self):
+        ids = [village.id for village in self.villages]
+        for t_of_arrival in (20000, 45000, 100000):
+            expected = [village.estimate_capacity(t_of_arrival) for village
+                        in self.villages]
+            self.assertEqual(self.store.estimate_capacity(ids, t_of_arrival).tolist(),
+                             expected)
+        times = [40000 + 1800 * index for index in range(len(ids))]
+        expected = [village.estimate_capacity(t) for village, t in zip(self.villages,
+                                                                         times)]
+        self.assertEqual(self.store.estimate_capacity(ids, times).tolist(), expected)
+
+    def test_views(self):
+        village = self.villages[1]
+        village.remaining_capacity = 1234
+        self.assertEqual(self.store.remaining_capacity[village._row], 1234)
+        # None is stored in any field (as NaN)
+        village.population = None
+        self.assertIsNone(village.population)
+        self.assertTrue(numpy.isnan(self.store.population[village._row]))
+        village.population = 150
+        self.assertEqual(self.store.population[village._row], 150)
+        state = village.__getstate__()
+        self.assertEqual(state['remaining_capacity'], 1234)
+        self.assertNotIn('_store', state)
+
+        row = village._row
+        self.store.remove(village)
+        self.assertNotIn(village.id, self.store)
+        self.assertEqual(len(self.store), 49)
+        self.assertIsNone(village._store)
+        self.assertEqual(village.__getstate__(), state)
+        # detached village does not write to store
+        village.remaining_capacity = 0
+        self.assertEqual(self.store.remaining_capacity[row], 1234)
+        self.assertEqual(self.store.estimate_capacity([2], 1000).tolist(),
+                         [self.villages[2].estimate_capacity(1000)])
@@ -0,0 +1,100 @@
+import os
+import json
+import unittest
+import logging
+
+import settings
+from bot.libs import attack_management
+from bot.libs.attack_management import Unit
+from bot.libs.world_config import WorldConfig, WorldConfigCache
+from bot.tests.helpers import StorageHelper
+
+
+logging.basicConfig(level=logging.CRITICAL)
+
+
+class TestWorldConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.settings_page = os.path.join(settings.TEST_DATA_FOLDER, 'html', 'misc',
+                                          'world_settings.html')
+        self.helper = StorageHelper()
+        self.storage_folder = self.helper.create_test_storage()
+
+    def tearDown(self):
+        self.helper.clean_test_storage()
+
+    def _write(self, filename, data):
+        path = os.path.join(self.storage_folder, filename)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_from_settings_page(self):
+        world_config = WorldConfig.from_file(self.settings_page)
+        self.assertEqual(world_config.speed, 2)
+        self.assertEqual(world_config.unit_speed, 0.5)
+        self.assertEqual(world_config.get_speed_factor(), 1)
+        unit_stats = world_config.get_unit_stats()
+        self.assertEqual(unit_stats['light'], (130, 10, 80))
+        self.assertEqual(unit_stats['spy'], (0, 9, 0))
+        self.assertIn('knight', unit_stats)
+
+        with self.assertRaises(ValueError):
+            WorldConfig.from_settings_page('<html><body>Bot protection</body></html>')
+
+    def test_from_config_xml(self):
+        xml = '<?xml version="1.0" encoding="UTF-8" ?>\n' \
+              '<config><speed>1.5</speed><unit_speed>1</unit_speed>' \
+              '<moral>1</moral></config>'
+        world_config = WorldConfig.from_file(self._write('config.xml', xml))
+        self.assertEqual(world_config.speed, 1.5)
+        self.assertEqual(world_config.unit_speed, 1)
+        self.assertEqual(world_config.get_unit_stats(), {})
+
+        with self.assertRaises(ValueError):
+            WorldConfig.from_config_xml('<config><moral>1</moral></config>')
+
+    def test_from_json(self):
+        data = {'speed': 3, 'unit_speed': 0.5,
+                'units': {'axe': {'attack': 40, 'speed': 18, 'carry': 10}}}
+        world_config = WorldConfig.from_file(self._write('config.json',
+                                                         json.dumps(data)))
+        self.assertEqual(world_config.to_dict(), data)
+
+        with self.assertRaises(ValueError):
+            WorldConfig.from_dict({'speed': 3})
+        with self.assertRaises(ValueError):
+            WorldConfig.from_file(self._write('broken.json', '{"speed": 1}'))
+
+    def test_cache(self):
+        cache = WorldConfigCache(os.path.join(self.storage_folder, 'world_config.json'))
+        self.assertIsNone(cache.get('en73.tribalwars.net'))
+        cache.save('en73.tribalwars.net', WorldConfig.from_file(self.settings_page))
+        cache.save('en74.tribalwars.net', WorldConfig(speed=2, unit_speed=1))
+        world_config = cache.get('en73.tribalwars.net')
+        self.assertEqual(world_config.get_speed_factor(), 1)
+        self.assertEqual(world_config.get_unit_stats()['heavy'], (150, 11, 50))
+        self.assertEqual(cache.get('en74.tribalwars.net').get_speed_factor(), 2)
+
+        # corrupted entry is ignored
+        with open(cache.cache_name) as f:
+            data = json.load(f)
+        del data['en74.tribalwars.net']['speed']
+        with open(cache.cache_name, 'w') as f:
+            json.dump(data, f)
+        self.assertIsNone(cache.get('en74.tribalwars.net'))
+
+    def test_build_units_with_world_stats(self):
+        saved_stats = dict(attack_management.UNIT_STATS)
+        units = Unit.build_units(speed_factor=2,
+                                 unit_stats={'light': (130, 8, 100),
+                                             'knight': (150, 10, 100)})
+        self.assertEqual(units['light'].speed, 4)
+        self.assertEqual(units['light'].haul, 100)
+        self.assertEqual(units['axe'].speed, 9)
+        # units that do not farm are not added
+        self.assertNotIn('knight', units)
+        # default stats are not changed
+        self.assertEqual(attack_management.UNIT_STATS, saved_stats)
+        self.assertEqual(Unit.build_units()['light'].haul, 80)
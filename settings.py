@@ -6,7 +6,11 @@ BROWSER = ''
 
 # Game host (e.g.: 'en73.tribalwars.net')
 HOST = ''
+# Game & unit speeds of world (travel times are divided by
+# HOST_SPEED * UNIT_SPEED). Used only if world settings could not be
+# loaded (see WORLD_SETTINGS_FILE & WORLD_CONFIG_FILE)
 HOST_SPEED = 1
+UNIT_SPEED = 1
 
 # Set to True to disable time.sleep() calls inside the code
 # (e.g. to run tests or to receive game-ban)
@@ -17,6 +21,9 @@ DEBUG = False
 USER = ''
 PASSWORD = ''
 
+# Max number of keep-alive connections kept open to game host
+CONNECTION_POOL_SIZE = 4
+
 # Antigate service API key
 ANTIGATE_KEY = ''
 
@@ -44,12 +51,41 @@ USE_DEF_TO_FARM = False
 # Whether Heavy Cavalry should be considered as def unit
 HEAVY_IS_DEF = False
 
+# How often bot should re-read rally point to refresh session
+# tokens (hours)
+SESSION_REFRESH_INTERVAL = 0.5
+
 # Maximum allowed time for troops to leave their villages (hours)
 T_LIMIT_TO_LEAVE = 4
 
+# Whether attacks of all farming villages should be planned at once
+# (see AttackPlanner) instead of attacking from a random village
+PLAN_ATTACKS = False
+
 # Test & source data location
 DATA_FOLDER = 'bot/runtime_data'
 TEST_DATA_FOLDER = 'bot/tests/test_data'
 
 DATA_FILE = 'bot_data'
+# 'local_file' (shelve) or 'sqlite' (DATA_FILE + '.sqlite', data of shelve
+# DATA_FILE is migrated on the first run)
 DATA_TYPE = 'local_file'
+# Radius (tiles) around farming villages where map is collected
+MAP_RADIUS = 40
+
+# Map sectors are saved to MAP_CACHE_FILE & re-fetched when they are
+# older than MAP_CACHE_TTL (hours)
+MAP_CACHE_FILE = 'map_cache'
+MAP_CACHE_TTL = 24
+# World dump of villages (village.txt, may be gzipped), which is used
+# instead of map overviews on a cold start (if given)
+WORLD_DATA_FILE = None
+# Attacks & targets updated since the last save of DATA_FILE
+JOURNAL_FILE = 'bot_journal'
+# Settings of each game host (speeds, stats of units) are saved to
+# WORLD_CONFIG_FILE (JSON) after the first load
+WORLD_CONFIG_FILE = 'world_config.json'
+# Local copy of world settings page (stat.php?mode=settings), world
+# config (interface.php?func=get_config) or JSON; if not given, world
+# settings page is requested from HOST
+WORLD_SETTINGS_FILE = None